@@ -1,33 +1,381 @@
+# En premier : l'import de utils.startup fixe l'origine des temps de démarrage
+from utils.startup import Startup
+
+import asyncio
+import hmac
+import json
+import logging
+import os
+import time
 from contextlib import asynccontextmanager
 from dataclasses import asdict
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
 
-from utils.prepare import prepare
-from utils.embedding_search import search
-from utils.rerank_with_crossencoder import rerank
+from utils.prepare import (
+    configure_threads, load_catalog, load_search_settings, load_rerank_settings, resolve_device, BACKEND, DATA_DIR,
+)
+from utils.metrics import Metrics
+from utils.micro_batching import BatchPipeline, DeadlineExceeded, MicroBatcher, QueueFull
+from utils.profiling import Profiler, ProfileRunning
+from utils.stages import make_stages
 from utils.types import Candidate
 
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger("utils").setLevel(logging.INFO)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    candidates, search_settings, rerank_settings = prepare()
-    app.state.candidates = candidates
+# Micro-batching des requêtes concurrentes
+BATCH_WINDOW_MS = float(os.environ.get("TRAVERSE_BATCH_WINDOW_MS", "5"))
+MAX_BATCH_SIZE = int(os.environ.get("TRAVERSE_MAX_BATCH_SIZE", "32"))
+
+# Contre-pression : requêtes en attente au plus avant de répondre 503,
+# et échéance par requête (au-delà, 504 sans passer par le reranker)
+MAX_QUEUE_SIZE = int(os.environ.get("TRAVERSE_MAX_QUEUE_SIZE", "128"))
+REQUEST_TIMEOUT_MS = float(os.environ.get("TRAVERSE_REQUEST_TIMEOUT_MS", "5000"))
+RETRY_AFTER_S = os.environ.get("TRAVERSE_RETRY_AFTER_S", "1")
+
+# POST /search/batch : requêtes au plus par appel, et échéance de l'appel entier
+MAX_BATCH_QUERIES = int(os.environ.get("TRAVERSE_MAX_BATCH_QUERIES", "256"))
+BATCH_TIMEOUT_MS = float(os.environ.get("TRAVERSE_BATCH_TIMEOUT_MS", "60000"))
+
+# Requêtes passées dans le pipeline avant de se déclarer prêt (compilation des
+# kernels, croissance de l'allocateur), une seule puis toutes en un batch
+WARMUP = os.environ.get("TRAVERSE_WARMUP", "1") == "1"
+WARMUP_QUERIES = [
+    "où manger",
+    "parking vélo",
+    "distributeur de billets",
+    "toilettes accessibles en fauteuil roulant",
+    "pharmacie de garde",
+    "aire de jeux pour enfants",
+    "boulangerie ouverte le dimanche",
+    "borne de recharge pour voiture électrique",
+]
+
+STAGES = ["catalog", "search_model", "rerank_model", "warmup"]
+
+# Métriques Prometheus sur /metrics ; sans elles, les hooks de mesure ne coûtent qu'un test.
+# DEBUG_TIMINGS : ?debug=1 renvoie la répartition de la requête (en-tête Server-Timing)
+METRICS = os.environ.get("TRAVERSE_METRICS", "1") == "1"
+DEBUG_TIMINGS = os.environ.get("TRAVERSE_DEBUG_TIMINGS", "0") == "1"
+metrics = Metrics() if METRICS else None
+
+# Profil à la demande (/admin/profile, en-tête X-Admin-Token) : désactivé sans jeton.
+# Une capture s'arrête après ?requests=N requêtes ou ?seconds=T, au premier atteint
+ADMIN_TOKEN = os.environ.get("TRAVERSE_ADMIN_TOKEN")
+PROFILE_DIR = os.environ.get("TRAVERSE_PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+PROFILE_SECONDS = float(os.environ.get("TRAVERSE_PROFILE_SECONDS", "30"))
+MAX_PROFILE_SECONDS = float(os.environ.get("TRAVERSE_MAX_PROFILE_SECONDS", "300"))
+
+
+class BatchRequest(BaseModel):
+    queries: list[str]
+
+
+def load(app: FastAPI, startup: Startup):
+    """Chargement en fond : chaque étape alimente /ready."""
+    configure_threads()
+    candidates = startup.run_stage("catalog", load_catalog)
+    search_settings = startup.run_stage("search_model", lambda: load_search_settings(candidates=candidates))
     app.state.search_settings = search_settings
+    rerank_settings = startup.run_stage("rerank_model", load_rerank_settings)
+
+    if WARMUP:
+        # Sans les caches, pour que les modèles calculent vraiment
+        search_stage, rerank_stage = make_stages(
+            candidates,
+            {**search_settings, "embedding_cache": None},
+            {**rerank_settings, "score_cache": None},
+        )
+        startup.run_stage("warmup", lambda: [
+            rerank_stage(search_stage([queries])) for queries in (WARMUP_QUERIES[:1], WARMUP_QUERIES)
+        ])
+    else:
+        startup.stages["warmup"] = "skipped"
+
+    # Après le warm-up, pour ne mesurer que le trafic
+    timer = metrics.timer if metrics is not None else None
+    search_settings["timer"] = rerank_settings["timer"] = timer
+    app.state.candidates = candidates
     app.state.rerank_settings = rerank_settings
+    search_stage, rerank_stage = make_stages(candidates, search_settings, rerank_settings, metrics)
+    pipeline = BatchPipeline([
+        # Batches bornés en requêtes (item_size=len), pas en items : un appel /search/batch n'y pèse que ses requêtes
+        MicroBatcher(search_stage, window_ms=BATCH_WINDOW_MS, max_batch_size=MAX_BATCH_SIZE,
+                     max_queue_size=MAX_QUEUE_SIZE, name="search", timer=timer, item_size=len),
+        # Petite file devant le GPU : quand il sature, c'est la file d'entrée qui se remplit
+        MicroBatcher(rerank_stage, window_ms=1, max_batch_size=MAX_BATCH_SIZE,
+                     max_queue_size=2 * MAX_BATCH_SIZE, name="rerank", timer=timer, item_size=len),
+    ])
+    pipeline.start()
+    # torch.profiler ne suit que le thread qui le démarre : celui de l'étage GPU (rerank)
+    profiler = Profiler(PROFILE_DIR, "cpu" if BACKEND == "onnx" else resolve_device(), run_on=pipeline.stages[-1].call)
+    search_settings["profiler"] = rerank_settings["profiler"] = profiler
+    app.state.pipeline = pipeline
+    app.state.profiler = profiler
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.startup = Startup(STAGES)
+    app.state.pipeline = None
+    app.state.search_settings = None
+    app.state.rerank_settings = None
+    app.state.profiler = None
+    app.state.profile_timer = None
+    app.state.profile_save = None
+    app.state.startup.start(lambda startup: load(app, startup))
     yield
+    if app.state.profiler is not None and app.state.profiler.stop():
+        app.state.profiler.save()
+    if app.state.pipeline is not None:
+        app.state.pipeline.stop()
+    if app.state.search_settings is not None and app.state.search_settings["embedding_cache"] is not None:
+        app.state.search_settings["embedding_cache"].save()
 
 
 app = FastAPI(title="Traverse", lifespan=lifespan)
 
 
+def reject(endpoint: str, reason: str, status_code: int, detail: str, retry_after: str) -> HTTPException:
+    if metrics is not None:
+        metrics.rejected.inc(endpoint, reason)
+    return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": retry_after})
+
+
+def submit_queries(queries: list[str], timeout_ms: float, endpoint: str, trace: dict | None = None) -> tuple[list, float]:
+    """
+    Soumet les requêtes au pipeline : (un Future par étage, échéance).
+    503 tant que le service charge ou quand la file d'entrée est pleine.
+    """
+    if not app.state.startup.ready.is_set():
+        raise reject(endpoint, "loading", 503, "Chargement en cours", "2")
+
+    deadline = time.monotonic() + timeout_ms / 1000
+    try:
+        return app.state.pipeline.submit_stages(queries, deadline=deadline, trace=trace), deadline
+    except QueueFull:
+        raise reject(endpoint, "queue_full", 503, "Service saturé", RETRY_AFTER_S)
+
+
+async def wait_stage(future, deadline: float, endpoint: str):
+    """Sans bloquer la boucle. En cas de timeout, wait_for annule le Future : les étages suivants ne le traitent pas."""
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), max(0.0, deadline - time.monotonic()))
+    except (asyncio.TimeoutError, DeadlineExceeded):
+        raise reject(endpoint, "timeout", 504, "Délai dépassé", RETRY_AFTER_S)
+
+
+async def run_pipeline(queries: list[str], timeout_ms: float, endpoint: str,
+                       trace: dict | None = None) -> list[list[Candidate]]:
+    """
+    Requêtes découpées en items d'au plus MAX_BATCH_SIZE : un gros appel
+    /search/batch se répartit sur plusieurs batches, entre lesquels les
+    requêtes /search en attente trouvent leur place.
+    """
+    t0 = time.perf_counter()
+    finals = []
+    try:
+        for start in range(0, len(queries), MAX_BATCH_SIZE):
+            futures, deadline = submit_queries(queries[start:start + MAX_BATCH_SIZE], timeout_ms, endpoint, trace)
+            finals.append(futures[-1])
+        results = await asyncio.gather(*(wait_stage(future, deadline, endpoint) for future in finals))
+    except BaseException:
+        # File pleine en cours de route, timeout ou déconnexion : les autres items sont retirés des files
+        for future in finals:
+            future.cancel()
+        raise
+    if metrics is not None:
+        metrics.request_seconds.observe(time.perf_counter() - t0, endpoint)
+    profile_request_done()
+    return [reranked for chunk in results for reranked in chunk]
+
+
+def debug_trace(debug: bool) -> dict | None:
+    """Dict rempli par les étages du pipeline, si la répartition est demandée et disponible."""
+    return {} if debug and DEBUG_TIMINGS and metrics is not None else None
+
+
+def server_timing(trace: dict) -> str:
+    """En-tête Server-Timing (ms) : attente, batch entier et étapes de chaque étage, p. ex. rerank_forward."""
+    entries = []
+    for batcher, timings in list(trace.items()):  # le rerank peut encore écrire (stream)
+        for name, value in timings.items():
+            if name == "batch_size":
+                entries.append(f'{batcher}_batch_size;desc="{value}"')
+            else:
+                entries.append(f"{batcher}_{name};dur={value * 1000:.2f}")
+    return ", ".join(entries)
+
+
+def with_timings(content, trace: dict | None):
+    if trace is None:
+        return content
+    return JSONResponse(content, headers={"Server-Timing": server_timing(trace)})
+
+
 @app.get("/search")
-def search_tags(query: str) -> list[Candidate]:
-    results = search(query, app.state.candidates, app.state.search_settings)
-    reranked = rerank(query, results, app.state.rerank_settings)
-    return [asdict(c) for c in reranked]
+async def search_tags(query: str, debug: bool = False) -> list[Candidate]:
+    trace = debug_trace(debug)
+    reranked = (await run_pipeline([query], REQUEST_TIMEOUT_MS, "search", trace))[0]
+    return with_timings([asdict(c) for c in reranked], trace)
+
+
+@app.get("/search/stream")
+async def search_tags_stream(query: str, debug: bool = False) -> StreamingResponse:
+    """
+    NDJSON en deux lignes : {"phase": "search"} avec la liste courte FAISS dès
+    qu'elle est prête, puis {"phase": "rerank"} avec la sortie du reranker
+    (ou {"phase": "error"}). Si le client se déconnecte (frappe abandonnée),
+    la requête est retirée de la file du reranker. Avec debug, chaque ligne
+    porte aussi "timings" (même format que Server-Timing).
+    """
+    t0 = time.perf_counter()
+    trace = debug_trace(debug)
+    (search_future, rerank_future), deadline = submit_queries([query], REQUEST_TIMEOUT_MS, "search_stream", trace)
+    candidates = app.state.candidates
+
+    def line(phase: str, results: list[Candidate]) -> str:
+        payload = {"phase": phase, "results": [asdict(c) for c in results]}
+        if trace is not None:
+            payload["timings"] = server_timing(trace)
+        return json.dumps(payload, ensure_ascii=False) + "\n"
+
+    async def phases():
+        try:
+            # Sortie de l'étage de recherche pour cet item : [(requête, (ids, scores))]
+            [(_, (ids, scores))] = await wait_stage(search_future, deadline, "search_stream")
+            yield line("search", candidates.materialize(ids, scores))
+
+            [reranked] = await wait_stage(rerank_future, deadline, "search_stream")
+            if metrics is not None:
+                metrics.request_seconds.observe(time.perf_counter() - t0, "search_stream")
+            profile_request_done()
+            yield line("rerank", reranked)
+        except HTTPException as e:
+            yield json.dumps({"phase": "error", "status": e.status_code, "detail": e.detail}, ensure_ascii=False) + "\n"
+        except Exception:
+            # Les en-têtes sont déjà partis : l'erreur ne peut plus être un code HTTP
+            logging.getLogger(__name__).exception("Échec de /search/stream")
+            yield json.dumps({"phase": "error", "status": 500, "detail": "Erreur interne"}) + "\n"
+        finally:
+            # Déconnexion (le générateur est fermé) ou erreur : on libère le GPU
+            rerank_future.cancel()
+
+    return StreamingResponse(phases(), media_type="application/x-ndjson")
+
+
+@app.post("/search/batch")
+async def search_tags_batch(request: BatchRequest, debug: bool = False) -> list[list[Candidate]]:
+    """
+    Plusieurs requêtes en un appel, pour les traitements hors ligne : items
+    d'au plus TRAVERSE_MAX_BATCH_SIZE requêtes dans le pipeline, résultats
+    dans l'ordre des requêtes, chacun identique à /search.
+    """
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=413, detail=f"{MAX_BATCH_QUERIES} requêtes au plus par appel")
+    if not request.queries:
+        return []
+    trace = debug_trace(debug)
+    results = await run_pipeline(request.queries, BATCH_TIMEOUT_MS, "search_batch", trace)
+    return with_timings([[asdict(c) for c in reranked] for reranked in results], trace)
+
+
+@app.get("/metrics")
+def prometheus_metrics() -> PlainTextResponse:
+    """Format texte Prometheus : histogrammes par étape et par catégorie, files, caches, padding."""
+    if metrics is None:
+        raise HTTPException(status_code=404, detail="Métriques désactivées (TRAVERSE_METRICS=0)")
+    pipeline = app.state.pipeline
+    return PlainTextResponse(
+        metrics.render(app.state.search_settings, app.state.rerank_settings, pipeline.stages if pipeline else None),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+def check_admin(token: str | None):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Administration désactivée (TRAVERSE_ADMIN_TOKEN)")
+    if token is None or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Jeton d'administration invalide")
+
+
+def profile_request_done():
+    profiler = app.state.profiler
+    if profiler is not None and profiler.active and profiler.request_done():
+        finish_profile()
+
+
+def finish_profile():
+    """Arrête la capture en cours ; les fichiers sont écrits hors de la boucle asyncio."""
+    if app.state.profile_timer is not None:
+        app.state.profile_timer.cancel()
+        app.state.profile_timer = None
+    if app.state.profiler.stop():
+        app.state.profile_save = asyncio.create_task(save_profile(app.state.profiler))
+
+
+async def save_profile(profiler: Profiler):
+    try:
+        await asyncio.to_thread(profiler.save)
+    except Exception:
+        logging.getLogger(__name__).exception("Échec de l'écriture du profil")
+
+
+@app.post("/admin/profile", status_code=202)
+async def start_profile(
+    requests: int | None = Query(None, gt=0),
+    seconds: float = Query(PROFILE_SECONDS, gt=0),
+    x_admin_token: str | None = Header(None),
+):
+    """
+    Profile les requêtes suivantes sans redéployer : torch.profiler sur GPU
+    (kernels, shapes des batches du reranker), cProfile sur CPU. Trace Chrome
+    dans TRAVERSE_PROFILE_DIR ; GET /admin/profile donne l'état et les fichiers.
+    """
+    check_admin(x_admin_token)
+    if app.state.profiler is None:
+        raise HTTPException(status_code=503, detail="Chargement en cours", headers={"Retry-After": "2"})
+    seconds = min(seconds, MAX_PROFILE_SECONDS)
+    try:
+        # Avec torch, attend la fin du batch en cours sur le thread du rerank
+        status = await asyncio.to_thread(app.state.profiler.start, max_requests=requests, max_seconds=seconds)
+    except ProfileRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    app.state.profile_timer = asyncio.get_running_loop().call_later(seconds, finish_profile)
+    return status
+
+
+@app.get("/admin/profile")
+def profile_status(x_admin_token: str | None = Header(None)):
+    check_admin(x_admin_token)
+    profiler = app.state.profiler
+    return profiler.status if profiler is not None else None
+
+
+@app.delete("/admin/profile")
+async def stop_profile(x_admin_token: str | None = Header(None)):
+    """Arrête la capture en cours avant son terme."""
+    check_admin(x_admin_token)
+    if app.state.profiler is None or not app.state.profiler.active:
+        raise HTTPException(status_code=409, detail="Aucune capture en cours")
+    finish_profile()
+    return app.state.profiler.status
 
 
 @app.get("/health")
 def health():
+    """Vivacité : le processus répond ; en erreur seulement si le démarrage a échoué."""
+    startup = app.state.startup
+    if startup.failed:
+        return JSONResponse({"status": "error", "error": startup.error}, status_code=500)
     return {"status": "ok"}
+
+
+@app.get("/ready")
+def ready():
+    """Disponibilité : 200 une fois modèles chargés et warm-up fait, 503 avant, avec l'état de chaque étape."""
+    report = app.state.startup.report()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
@@ -0,0 +1,155 @@
+"""
+Étiquetage en masse : requêtes JSONL en entrée, tags OSM en JSONL en sortie.
+
+Pipeline par étages, chacun sur son thread, reliés par des files bornées :
+lecture → encodage E5 + FAISS (par batch) → rerank (par batch) → écriture.
+Le reranker traite un batch pendant que l'étage de recherche prépare le
+suivant et que l'écriture vide le précédent ; la mémoire reste constante
+quelle que soit la taille de l'entrée (fichier lu et écrit au fil de l'eau).
+
+Entrée : une ligne JSON par requête, objet avec un champ --field (par défaut
+"query") ou simple chaîne. Sortie, dans l'ordre de l'entrée :
+    {"line": n, ...champs de l'entrée..., "tags": [{"tag", "category", "score", "visibility"}]}
+Les lignes vides sont ignorées ; les lignes illisibles, sans requête (chaîne)
+ou dont le traitement échoue donnent {"line": n, "error": ...}.
+
+--resume reprend après la dernière ligne écrite dans --output (une ligne
+incomplète, p. ex. après un arrêt brutal, est retirée) ; --offset part
+d'une ligne donnée de l'entrée.
+
+Usage: uv run bulk-tag.py requetes.jsonl --output tags.jsonl [--field query]
+                          [--batch-size 64] [--resume | --offset N] [--report-every 10]
+"""
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+from utils.micro_batching import BatchPipeline, MicroBatcher
+from utils.prepare import prepare
+from utils.stages import make_stages
+
+_DONE = object()
+
+
+def resume_offset(output_path: str) -> int:
+    """Ligne d'entrée suivant la dernière écrite ; tronque une dernière ligne incomplète."""
+    if not os.path.exists(output_path):
+        return 0
+    last, complete_bytes = None, 0
+    with open(output_path, "rb") as f:
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            last, complete_bytes = raw, complete_bytes + len(raw)
+    if complete_bytes < os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(complete_bytes)
+    return json.loads(last)["line"] + 1 if last is not None else 0
+
+
+def make_pipeline(candidates, search_settings: dict, rerank_settings: dict, batch_size: int) -> BatchPipeline:
+    """Mêmes étages que l'API (utils/stages.py), une requête par item."""
+    search_stage, rerank_stage = make_stages(candidates, search_settings, rerank_settings)
+    return BatchPipeline([
+        MicroBatcher(search_stage, window_ms=5, max_batch_size=batch_size,
+                     max_queue_size=4 * batch_size, name="bulk-search"),
+        MicroBatcher(rerank_stage, window_ms=5, max_batch_size=batch_size,
+                     max_queue_size=2 * batch_size, name="bulk-rerank"),
+    ])
+
+
+def read_records(input_path: str, field: str, offset: int, pipeline: BatchPipeline, pending: queue.Queue):
+    """
+    Thread de lecture : soumet chaque requête au pipeline (en attendant une
+    place) et file (ligne, enregistrement, Future) dans l'ordre de l'entrée.
+    """
+    try:
+        with open(input_path, "r", encoding="utf-8") as f:
+            for line, raw in enumerate(f):
+                if line < offset or not raw.strip():
+                    continue
+                try:
+                    record = json.loads(raw)
+                    query = record if isinstance(record, str) else record[field]
+                    if not isinstance(query, str):
+                        raise TypeError(f"{field} doit être une chaîne, pas {type(query).__name__}")
+                except (ValueError, KeyError, TypeError) as e:
+                    pending.put((line, {"error": f"{type(e).__name__}: {e}"}, None))
+                    continue
+                record = {field: record} if isinstance(record, str) else record
+                pending.put((line, record, pipeline.submit([query], block=True)))
+    finally:
+        pending.put(_DONE)
+
+
+def tag_file(input_path: str, output_path: str, field: str, batch_size: int, offset: int, report_every: float):
+    candidates, search_settings, rerank_settings = prepare()
+    # Pas de cache : ils servent les requêtes interactives, et un lot de
+    # millions de requêtes uniques les ferait croître sans profit
+    pipeline = make_pipeline(
+        candidates,
+        {**search_settings, "embedding_cache": None},
+        {**rerank_settings, "score_cache": None},
+        batch_size,
+    )
+    pipeline.start()
+
+    # Borne les requêtes en vol (soumises, pas encore écrites)
+    pending = queue.Queue(8 * batch_size)
+    reader = threading.Thread(
+        target=read_records, args=(input_path, field, offset, pipeline, pending), name="bulk-reader", daemon=True,
+    )
+    reader.start()
+
+    done = 0
+    t0 = last_report = time.perf_counter()
+    last_done = 0
+    with open(output_path, "a" if offset else "w", encoding="utf-8") as out:
+        while (entry := pending.get()) is not _DONE:
+            line, record, future = entry
+            if future is not None:
+                try:
+                    [reranked] = future.result()
+                except Exception as e:
+                    # Le batch entier a échoué (voir le log de MicroBatcher) : on le note et on continue
+                    record = {"error": f"{type(e).__name__}: {e}"}
+                else:
+                    record = {**record, "tags": [
+                        {"tag": c.tag, "category": c.category, "score": round(c.score, 4), "visibility": c.visibility}
+                        for c in reranked
+                    ]}
+            out.write(json.dumps({"line": line, **record}, ensure_ascii=False) + "\n")
+            done += 1
+
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                out.flush()
+                print(f"ligne {line + 1} : {done} requêtes, {(done - last_done) / (now - last_report):.1f} req/s "
+                      f"(moyenne {done / (now - t0):.1f} req/s)")
+                last_report, last_done = now, done
+
+    pipeline.stop()
+    elapsed = time.perf_counter() - t0
+    print(f"{done} requêtes en {elapsed:.1f}s ({done / elapsed if elapsed else 0:.1f} req/s) → {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="Fichier JSONL de requêtes")
+    parser.add_argument("--output", required=True, help="Fichier JSONL de sortie")
+    parser.add_argument("--field", default="query", help="Champ contenant la requête")
+    parser.add_argument("--batch-size", type=int, default=64, help="Requêtes par batch de chaque étage")
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument("--resume", action="store_true", help="Reprend après la dernière ligne de --output")
+    start.add_argument("--offset", type=int, default=0, help="Première ligne de l'entrée à traiter (0 = début)")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Intervalle des mesures de débit (s)")
+    args = parser.parse_args()
+
+    offset = resume_offset(args.output) if args.resume else args.offset
+    if offset:
+        print(f"Reprise à la ligne {offset}")
+    tag_file(args.input, args.output, args.field, args.batch_size, offset, args.report_every)
@@ -1,49 +1,250 @@
-from sentence_transformers import SentenceTransformer
-import faiss
+"""
+Génération des index FAISS.
+
+Par défaut, un index par catégorie (poi.index, attributes.index).
+Avec --combined, un seul index catalog.index pour toutes les catégories,
+accompagné de catalog_list.json (tag et catégorie de chaque vecteur) :
+la recherche fait une seule requête FAISS et applique les quotas par catégorie.
+
+Avec --shards (implique --combined), un index par préfixe de clé OSM dans data/shards/
+(clés de moins de --min-shard-size tags regroupées dans "misc"), avec le centroïde de
+chaque shard : une requête n'est cherchée (et le shard chargé) que dans les
+TRAVERSE_PROBE_SHARDS shards les plus proches ;
+catalog_list.json contient alors tout le catalogue sauf les descriptions naturelles,
+rangées par shard.
+
+Le catalogue est lu dans data/catalog/, snapshot binaire recompilé depuis les JSON
+quand ceux-ci changent (voir utils/snapshot.py).
+
+Hors --shards, écrit aussi data/bundle/ (embeddings, table des candidats en binaire,
+manifeste avec empreintes) que prepare() ouvre en mmap, partagé entre workers.
+
+Avec --index-types, construit aussi des index compressés (sq8, pq, binary),
+re-scorés à la recherche avec les vecteurs float32 de <nom>.vectors.npy ;
+le type utilisé par le service est choisi par TRAVERSE_INDEX_TYPE.
+
+Les embeddings des descriptions sont gardés dans data/cache/passage_embeddings.npz,
+par empreinte (modèle + texte) : seules les descriptions nouvelles ou modifiées
+sont ré-encodées, le modèle n'est chargé que s'il y en a.
+
+Usage: uv run create-index.py [--combined] [--shards] [--categories poi attribute other]
+                              [--index-types flat sq8 pq binary hnsw ivf]
+                              [--processes 4] [--batch-size 64] [--no-cache]
+"""
+
+import argparse
+import functools
 import json
+import os
+import time
+from collections import defaultdict
+
 import numpy as np
 
-from utils.prepare import load_candidates, EMBEDDING_MODEL, DATA_DIR
+from utils.bundle import write_bundle
+from utils.embedding_cache import PassageEmbeddingCache
+from utils.faiss_index import INDEX_TYPES, build_index, shard_key, write_centroids, write_index
+from utils.prepare import load_candidates, catalog_version, EMBEDDING_MODEL, CATEGORIES, DATA_DIR, BUNDLE_DIR
+
+
+@functools.cache
+def load_model():
+    # Import ici : une reconstruction entièrement en cache ne charge ni torch ni le modèle
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL)
 
-def index(tags, descriptions, filename):
-    model = SentenceTransformer(EMBEDDING_MODEL)
-    # Ajouter le préfixe "passage: " pour E5
-    descriptions_with_prefix = [f"passage: {d}" for d in descriptions]
-    embeddings = model.encode(descriptions_with_prefix, show_progress_bar=True, normalize_embeddings=True)
 
-    # Construire l'index FAISS
-    index = faiss.IndexFlatIP(embeddings.shape[1])
-    index.add(embeddings.astype("float32"))
+def encode(texts, processes, batch_size):
+    """Textes triés par longueur : batches homogènes, y compris répartis entre processus."""
+    model = load_model()
+    if processes > 1:
+        pool = model.start_multi_process_pool(["cpu"] * processes)
+        try:
+            return model.encode(texts, pool=pool, batch_size=batch_size, show_progress_bar=True,
+                                normalize_embeddings=True)
+        finally:
+            model.stop_multi_process_pool(pool)
+    return model.encode(texts, batch_size=batch_size, show_progress_bar=True, normalize_embeddings=True)
 
-    # Sauvegarder l'index et les tags
-    faiss.write_index(index, f"data/{filename}.index")
+
+class Embedder:
+    """Encode les descriptions en ne passant par le modèle que pour celles absentes du cache."""
+
+    def __init__(self, cache, processes=0, batch_size=64):
+        self.cache = cache
+        self.processes = processes
+        self.batch_size = batch_size
+
+    def __call__(self, descriptions):
+        # Ajouter le préfixe "passage: " pour E5
+        texts = [f"passage: {d}" for d in descriptions]
+        vectors = self.cache.get_many(texts)
+        missing = sorted({t for t, v in zip(texts, vectors) if v is None}, key=len)
+
+        if missing:
+            t0 = time.perf_counter()
+            self.cache.put_many(missing, encode(missing, self.processes, self.batch_size))
+            self.cache.save()
+            vectors = self.cache.get_many(texts)
+            print(f"  {len(missing)} descriptions encodées en {time.perf_counter() - t0:.1f}s, "
+                  f"{len(texts) - len(missing)} en cache")
+        else:
+            print(f"  {len(texts)} descriptions en cache")
+        return np.stack(vectors).astype("float32")
+
+
+def write_indexes(embeddings, filename, index_types, data_dir=DATA_DIR):
+    for index_type in index_types:
+        write_index(build_index(embeddings, index_type), embeddings, data_dir, filename, index_type)
+
+
+def index(embed, tags, descriptions, filename, index_types):
+    embeddings = embed(descriptions)
+
+    # Construire et sauvegarder les index FAISS, puis les tags
+    write_indexes(embeddings, filename, index_types)
     with open(f"data/{filename}_list.json", "w") as f:
         json.dump(tags, f)
 
     with open(f"data/{filename}_list_desc.json", "w") as f:
         json.dump(descriptions, f)
 
-candidates = load_candidates()
+    return embeddings
+
 
-poi_tags = []
-poi_descriptions = []
-attribute_tags = []
-attribute_descriptions = []
+def combined_index(embed, tags, descriptions, categories, index_types):
+    """Un seul index ; la catégorie de chaque vecteur est dans catalog_list.json."""
+    embeddings = embed(descriptions)
 
-for c in candidates:
+    write_indexes(embeddings, "catalog", index_types)
+    with open("data/catalog_list.json", "w") as f:
+        json.dump({"tags": tags, "categories": categories, **listing_version()}, f)
+
+    return embeddings
+
+
+def sharded_index(embed, candidates, index_types, min_shard_size):
+    """Un index par préfixe de clé ; catalogue réordonné par shard."""
+    groups = defaultdict(list)
+    for c in candidates:
+        groups[shard_key(c.tag)].append(c)
+
+    shards = defaultdict(list)
+    for key, group in groups.items():
+        shards[key if len(group) >= min_shard_size else "misc"].extend(group)
+
+    ordered = [c for group in shards.values() for c in group]
+    embeddings = embed([indexed_description(c) for c in ordered])
+
+    shard_dir = os.path.join(DATA_DIR, "shards")
+    os.makedirs(shard_dir, exist_ok=True)
+    start = 0
+    for name, group in shards.items():
+        print(f"  {name}: {len(group)}")
+        write_indexes(embeddings[start:start + len(group)], name, index_types, shard_dir)
+        with open(os.path.join(shard_dir, f"{name}_desc.json"), "w") as f:
+            json.dump([c.description_natural for c in group], f)
+        start += len(group)
+    # Routage des requêtes vers les shards les plus proches (TRAVERSE_PROBE_SHARDS)
+    offsets = np.cumsum([0] + [len(group) for group in shards.values()])
+    write_centroids(shard_dir, np.stack([embeddings[a:b].mean(axis=0) for a, b in zip(offsets[:-1], offsets[1:])]))
+
+    with open("data/catalog_list.json", "w") as f:
+        json.dump({
+            "tags": [c.tag for c in ordered],
+            "categories": [c.category for c in ordered],
+            "descriptions_fr": [c.description_fr for c in ordered],
+            "usage_count": [c.usage_count for c in ordered],
+            "shards": [{"name": name, "size": len(group)} for name, group in shards.items()],
+            "dim": int(embeddings.shape[1]),
+            **listing_version(),
+        }, f)
+
+
+def listing_version():
+    """Versions vérifiées au chargement : un index combiné obsolète est ignoré."""
+    return {"catalog_version": catalog_version(), "model": EMBEDDING_MODEL}
+
+
+def bundle(candidates, embeddings):
+    manifest = write_bundle(os.path.join(DATA_DIR, BUNDLE_DIR), candidates, embeddings,
+                            EMBEDDING_MODEL, catalog_version())
+    print(f"Bundle {manifest['version']} : {manifest['count']} tags")
+
+
+def indexed_description(c):
     # Construire la description indexée avec le préfixe description_fr
     desc = c.description_natural
     if c.description_fr and not desc.lower().startswith(c.description_fr.lower()):
         desc = f"{c.description_fr}. {desc}"
+    return desc
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--combined", action="store_true", help="Un seul index pour toutes les catégories")
+    parser.add_argument("--categories", nargs="+", default=list(CATEGORIES),
+                        help="Catégories indexées avec --combined (ex. poi attribute other)")
+    parser.add_argument("--shards", action="store_true", help="Un index par préfixe de clé OSM (implique --combined)")
+    parser.add_argument("--min-shard-size", type=int, default=1000,
+                        help="Taille min d'un shard, les petites clés vont dans \"misc\"")
+    parser.add_argument("--index-types", nargs="+", default=["flat"], choices=INDEX_TYPES,
+                        help="Types d'index à construire (mêmes embeddings)")
+    parser.add_argument("--processes", type=int, default=0, help="Encodage sur N processus CPU (0 = un seul)")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--no-cache", action="store_true", help="Ré-encode toutes les descriptions")
+    args = parser.parse_args()
+
+    cache = PassageEmbeddingCache(
+        EMBEDDING_MODEL,
+        path=None if args.no_cache else os.path.join(DATA_DIR, "cache", "passage_embeddings"),
+    )
+    embed = Embedder(cache, args.processes, args.batch_size)
+
+    if args.shards:
+        candidates = load_candidates(categories=tuple(args.categories))
+        print(f"{len(candidates)} tags")
+        sharded_index(embed, candidates, args.index_types, args.min_shard_size)
+    elif args.combined:
+        candidates = load_candidates(categories=tuple(args.categories))
+        print(" | ".join(f"{cat}: {sum(c.category == cat for c in candidates)}" for cat in args.categories))
+        embeddings = combined_index(
+            embed,
+            [c.tag for c in candidates],
+            [indexed_description(c) for c in candidates],
+            [c.category for c in candidates],
+            args.index_types,
+        )
+        bundle(candidates, embeddings)
+    else:
+        candidates = load_candidates()
+
+        poi_tags = []
+        poi_descriptions = []
+        attribute_tags = []
+        attribute_descriptions = []
+
+        for c in candidates:
+            if c.category == "poi":
+                poi_tags.append(c.tag)
+                poi_descriptions.append(indexed_description(c))
+            elif c.category == "attribute":
+                attribute_tags.append(c.tag)
+                attribute_descriptions.append(indexed_description(c))
+
+        print(f"POI: {len(poi_tags)} | Attributes: {len(attribute_tags)}")
 
-    if c.category == "poi":
-        poi_tags.append(c.tag)
-        poi_descriptions.append(desc)
-    elif c.category == "attribute":
-        attribute_tags.append(c.tag)
-        attribute_descriptions.append(desc)
+        poi_embeddings = index(embed, poi_tags, poi_descriptions, "poi", args.index_types)
+        attribute_embeddings = index(embed, attribute_tags, attribute_descriptions, "attributes", args.index_types)
 
-print(f"POI: {len(poi_tags)} | Attributes: {len(attribute_tags)}")
+        # Bundle dans l'ordre du catalogue (celui de load_candidates)
+        is_poi = np.array([c.category == "poi" for c in candidates])
+        embeddings = np.empty((len(candidates), poi_embeddings.shape[1]), dtype="float32")
+        embeddings[is_poi] = poi_embeddings
+        embeddings[~is_poi] = attribute_embeddings
+        bundle(candidates, embeddings)
 
-index(poi_tags, poi_descriptions, "poi")
-index(attribute_tags, attribute_descriptions, "attributes")
+    # Fin du build : le cache ne garde que les descriptions de ce catalogue, il ne grossit pas d'un build à l'autre
+    pruned = cache.save(prune=True)
+    if pruned:
+        print(f"{pruned} embeddings obsolètes retirés du cache")
@@ -0,0 +1,141 @@
+"""
+Export ONNX des modèles d'embedding et de reranking, pour le backend
+ONNX Runtime (TRAVERSE_BACKEND=onnx).
+
+- data/onnx/e5/       : E5 avec mean pooling + normalisation dans le graphe
+- data/onnx/reranker/ : Qwen3-Reranker réduit à la tête yes/no (probabilité "yes"),
+                        ou logits complets de la dernière position avec --full-head
+
+Chaque dossier contient model.fp32.onnx, model.int8.onnx (avec --int8) et tokenizer.json.
+
+Usage: uv run export-onnx.py --int8
+"""
+
+import argparse
+import json
+import os
+
+import torch
+from transformers import AutoModel, AutoModelForCausalLM, AutoTokenizer
+
+from utils.prepare import EMBEDDING_MODEL, RERANKER_MODEL, ONNX_DIR, RERANK_PREFIX, RERANK_SUFFIX
+
+OPSET = 18
+
+
+class E5Encoder(torch.nn.Module):
+    """Mean pooling + normalisation L2, comme SentenceTransformer.encode(normalize_embeddings=True)."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        hidden = self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return torch.nn.functional.normalize(pooled, dim=-1)
+
+
+class YesNoReranker(torch.nn.Module):
+    """Probabilité "yes" à la dernière position, via les deux seules lignes no/yes de la tête LM."""
+
+    def __init__(self, model, score_head):
+        super().__init__()
+        self.decoder = model.model
+        self.register_buffer("score_head", score_head)
+
+    def forward(self, input_ids, attention_mask):
+        hidden = self.decoder(input_ids=input_ids, attention_mask=attention_mask, use_cache=False).last_hidden_state
+        logits = hidden[:, -1, :] @ self.score_head.T
+        return torch.softmax(logits, dim=-1)[:, 1]
+
+
+class LastLogitsReranker(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, use_cache=False).logits[:, -1, :]
+
+
+def export(module, tokenizer, output_name: str, out_dir: str, int8: bool):
+    os.makedirs(out_dir, exist_ok=True)
+    fp32_path = os.path.join(out_dir, "model.fp32.onnx")
+
+    sample = tokenizer(["query: exemple", "query: un exemple plus long"], padding=True, return_tensors="pt")
+    torch.onnx.export(
+        module.eval(),
+        (sample["input_ids"], sample["attention_mask"]),
+        fp32_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=[output_name],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            output_name: {0: "batch"},
+        },
+        opset_version=OPSET,
+        # Qwen3-0.6B en float32 dépasse la limite de 2 Go d'un protobuf
+        external_data=True,
+    )
+    tokenizer.backend_tokenizer.save(os.path.join(out_dir, "tokenizer.json"))
+    print(f"  {fp32_path}")
+
+    if int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = os.path.join(out_dir, "model.int8.onnx")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8, use_external_data_format=True)
+        print(f"  {int8_path}")
+
+
+@torch.no_grad()
+def export_embedding(int8: bool):
+    print(f"Export {EMBEDDING_MODEL}...")
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+    model = AutoModel.from_pretrained(EMBEDDING_MODEL, torch_dtype=torch.float32)
+    export(E5Encoder(model), tokenizer, "embeddings", os.path.join(ONNX_DIR, "e5"), int8)
+
+
+@torch.no_grad()
+def export_reranker(int8: bool, full_head: bool):
+    print(f"Export {RERANKER_MODEL}...")
+    tokenizer = AutoTokenizer.from_pretrained(RERANKER_MODEL, padding_side="left")
+    model = AutoModelForCausalLM.from_pretrained(RERANKER_MODEL, torch_dtype=torch.float32)
+
+    token_true_id = tokenizer.convert_tokens_to_ids("yes")
+    token_false_id = tokenizer.convert_tokens_to_ids("no")
+    out_dir = os.path.join(ONNX_DIR, "reranker")
+
+    if full_head:
+        module, output_name = LastLogitsReranker(model), "logits"
+    else:
+        score_head = model.get_output_embeddings().weight[[token_false_id, token_true_id]].detach().clone()
+        module, output_name = YesNoReranker(model, score_head), "scores"
+    export(module, tokenizer, output_name, out_dir, int8)
+
+    # Tokens du prompt, pour que le backend ONNX n'ait pas besoin de transformers
+    with open(os.path.join(out_dir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "model": RERANKER_MODEL,
+            "token_true_id": token_true_id,
+            "token_false_id": token_false_id,
+            "pad_token_id": tokenizer.pad_token_id,
+            "prefix_tokens": tokenizer.encode(RERANK_PREFIX, add_special_tokens=False),
+            "suffix_tokens": tokenizer.encode(RERANK_SUFFIX, add_special_tokens=False),
+        }, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--int8", action="store_true", help="Ajoute une version quantifiée int8 (poids dynamiques)")
+    parser.add_argument("--full-head", action="store_true", help="Reranker avec logits complets au lieu de la tête yes/no")
+    parser.add_argument("--only", choices=["embedding", "reranker"], help="N'exporter qu'un des deux modèles")
+    args = parser.parse_args()
+
+    if args.only in (None, "embedding"):
+        export_embedding(args.int8)
+    if args.only in (None, "reranker"):
+        export_reranker(args.int8, args.full_head)
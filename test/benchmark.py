@@ -1,21 +1,42 @@
 """
-Benchmark du temps d'inférence search + rerank.
+Benchmark search + rerank, sur CPU ou GPU (TRAVERSE_DEVICE, TRAVERSE_BACKEND).
 
-Lance 10 recherches avec torch.cuda.synchronize() entre chaque
-pour mesurer le temps réel GPU.
+- cold : premier passage sur les requêtes juste après le chargement,
+  sans warm-up ni caches (compilation des kernels, croissance de l'allocateur)
+- warm : --repeat passages après warm-up, caches désactivés (on mesure les modèles)
 
-Usage: switcherooctl launch uv run test/benchmark.py
+Pour chacun, latence par requête p50 / p95 / p99 et répartition par étape
+(encode, faiss, tokenize, forward, postprocess, voir utils/timing.py ;
+"other" = reste : cache, préparation des paires, création des Candidate).
+Puis le débit à plusieurs tailles de batch (appels batchés directs) et à
+plusieurs niveaux de concurrence (clients parallèles à travers le pipeline
+micro-batché de l'API).
+
+Résultats en JSON avec --output. Avec --baseline (un JSON produit par --output),
+compare et sort en erreur (code 1) si une mesure régresse de plus de --threshold.
+
+Usage: uv run test/benchmark.py [--queries test/test_data.json] [--repeat 3]
+                                [--batch-sizes 1 8 32] [--concurrency 1 4 16]
+                                [--output bench.json] [--baseline base.json --threshold 0.1]
 """
 
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import argparse
+import json
+import threading
 import time
-import torch
-from utils.prepare import prepare
-from utils.embedding_search import search
-from utils.rerank_with_crossencoder import rerank
+
+from utils.embedding_search import search_ids_batch
+from utils.micro_batching import BatchPipeline, MicroBatcher
+from utils.prepare import (
+    prepare, catalog_version, resolve_device, BACKEND, EMBEDDING_MODEL, INDEX_TYPE, RERANKER_MODEL,
+)
+from utils.rerank_with_crossencoder import rerank_ids_batch, padding_efficiency, token_stats
+from utils.stages import make_stages
+from utils.timing import STAGES, StageTimer, device_sync
 
 QUERIES = [
     "où manger",
@@ -31,52 +52,222 @@ QUERIES = [
 ]
 
 
-def benchmark():
-    candidates, search_settings, rerank_settings = prepare()
+def load_queries(path: str | None) -> list[str]:
+    """Fichier .json (liste), .jsonl ou texte (une requête par ligne) ; chaînes ou objets {"query"}."""
+    if path is None:
+        return QUERIES
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".json"):
+            items = json.load(f)
+        elif path.endswith(".jsonl"):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = [line.strip() for line in f if line.strip()]
+    return [item if isinstance(item, str) else item["query"] for item in items]
+
+
+def percentile(values: list[float], p: float) -> float:
+    s = sorted(values)
+    return s[min(len(s) - 1, round(p / 100 * (len(s) - 1)))]
+
 
-    # Warmup (le premier appel est toujours plus lent)
-    torch.cuda.synchronize()
-    search_results = search(QUERIES[0], candidates, search_settings)
-    rerank(QUERIES[0], search_results, rerank_settings)
-    torch.cuda.synchronize()
-    print("Warmup done.\n")
+def summarize(values: list[float]) -> dict:
+    return {
+        "p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+        "mean": sum(values) / len(values),
+    }
 
-    search_times = []
-    rerank_times = []
-    total_times = []
 
-    for i, query in enumerate(QUERIES):
-        # Search
-        torch.cuda.synchronize()
+def run_queries(queries: list[str], candidates, search_settings: dict, rerank_settings: dict) -> dict:
+    """Requête par requête (comme le service) : latence totale et par étape, en ms."""
+    timer = search_settings["timer"]
+    rows = {name: [] for name in ("total", *STAGES, "other")}
+    for query in queries:
+        timer.reset()
+        if timer.sync is not None:
+            timer.sync()
         t0 = time.perf_counter()
-        search_results = search(query, candidates, search_settings)
-        torch.cuda.synchronize()
-        t1 = time.perf_counter()
+        hits = search_ids_batch([query], candidates, search_settings)
+        ranked = rerank_ids_batch([query], hits, candidates, rerank_settings)
+        candidates.materialize(*ranked[0])
+        if timer.sync is not None:
+            timer.sync()
+        total = (time.perf_counter() - t0) * 1000
+
+        stages = timer.snapshot(reset=True)
+        rows["total"].append(total)
+        for name in STAGES:
+            rows[name].append(stages.get(name, 0.0) * 1000)
+        rows["other"].append(total - sum(stages.values()) * 1000)
+    return {name: summarize(values) for name, values in rows.items()}
+
+
+def batch_throughput(queries: list[str], batch_size: int, candidates, search_settings: dict, rerank_settings: dict) -> dict:
+    """Requêtes/s en appels batchés directs (un encode et un flux de batches du reranker par batch)."""
+    t0 = time.perf_counter()
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        hits = search_ids_batch(batch, candidates, search_settings)
+        for ids, scores, visibility in rerank_ids_batch(batch, hits, candidates, rerank_settings):
+            candidates.materialize(ids, scores, visibility)
+    elapsed = time.perf_counter() - t0
+    return {"qps": len(queries) / elapsed}
+
+
+def concurrent_throughput(queries: list[str], clients: int, candidates, search_settings: dict, rerank_settings: dict) -> dict:
+    """Clients parallèles, une requête à la fois chacun, à travers le pipeline micro-batché de l'API."""
+    search_stage, rerank_stage = make_stages(candidates, search_settings, rerank_settings)
+    pipeline = BatchPipeline([
+        MicroBatcher(search_stage, window_ms=5, max_batch_size=32, name="bench-search"),
+        MicroBatcher(rerank_stage, window_ms=1, max_batch_size=32, name="bench-rerank"),
+    ])
+    pipeline.start()
+
+    latencies = []
+    lock = threading.Lock()
+    remaining = iter(queries)
+
+    def client():
+        while True:
+            with lock:
+                query = next(remaining, None)
+            if query is None:
+                return
+            t0 = time.perf_counter()
+            pipeline.submit([query]).result()
+            with lock:
+                latencies.append((time.perf_counter() - t0) * 1000)
 
-        # Rerank
-        rerank_results = rerank(query, search_results, rerank_settings)
-        torch.cuda.synchronize()
-        t2 = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    pipeline.stop()
+    return {"qps": len(queries) / elapsed, **summarize(latencies)}
 
-        s_ms = (t1 - t0) * 1000
-        r_ms = (t2 - t1) * 1000
-        total_ms = (t2 - t0) * 1000
 
-        search_times.append(s_ms)
-        rerank_times.append(r_ms)
-        total_times.append(total_ms)
+def benchmark(queries: list[str], repeat: int, batch_sizes: list[int], concurrency: list[int]) -> dict:
+    candidates, search_settings, rerank_settings = prepare()
+    device = "cpu" if BACKEND == "onnx" else resolve_device()
+    timer = StageTimer(sync=device_sync(device))
+    # On mesure les modèles, pas les caches
+    search_settings.update(embedding_cache=None, timer=timer)
+    rerank_settings.update(score_cache=None, timer=timer)
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "device": device, "backend": BACKEND, "index_type": INDEX_TYPE,
+            "embedding_model": EMBEDDING_MODEL, "reranker_model": RERANKER_MODEL,
+            "catalog_version": catalog_version(), "queries": len(queries), "repeat": repeat,
+        },
+    }
+
+    print("Cold...")
+    results["cold"] = run_queries(queries, candidates, search_settings, rerank_settings)
+
+    print("Warm...")
+    run_queries(queries[:1], candidates, search_settings, rerank_settings)
+    token_stats(rerank_settings, reset=True)
+    results["warm"] = run_queries(queries * repeat, candidates, search_settings, rerank_settings)
+    results["padding_efficiency"] = padding_efficiency(rerank_settings)
+
+    # Sans mesure par étape : les synchronisations fausseraient le débit
+    search_settings["timer"] = rerank_settings["timer"] = None
+    workload = queries * repeat
+    results["batch"] = {}
+    for batch_size in batch_sizes:
+        print(f"Batch {batch_size}...")
+        results["batch"][str(batch_size)] = batch_throughput(workload, batch_size, candidates, search_settings, rerank_settings)
+    results["concurrency"] = {}
+    for clients in concurrency:
+        print(f"Concurrence {clients}...")
+        results["concurrency"][str(clients)] = concurrent_throughput(workload, clients, candidates, search_settings, rerank_settings)
+
+    return results
+
 
-        print(f"[{i+1:2d}/10] {query:<30s}  search={s_ms:6.1f}ms  rerank={r_ms:6.1f}ms  total={total_ms:6.1f}ms  ({len(rerank_results)} results)")
+def print_results(results: dict):
+    meta = results["meta"]
+    print(f"\n{'='*78}")
+    print(f"{meta['device']} / {meta['backend']} / index {meta['index_type']}, "
+          f"{meta['queries']} requêtes × {meta['repeat']}")
+    print(f"{'='*78}")
+    print(f"{'Étape':<14} {'cold p50':>10} {'warm p50':>10} {'warm p95':>10} {'warm p99':>10}")
+    print(f"{'-'*78}")
+    for name in ("total", *STAGES, "other"):
+        cold, warm = results["cold"][name], results["warm"][name]
+        print(f"{name:<14} {cold['p50']:>8.1f}ms {warm['p50']:>8.1f}ms {warm['p95']:>8.1f}ms {warm['p99']:>8.1f}ms")
+    print(f"Efficacité du padding : {results['padding_efficiency']:.1%}")
 
-    print(f"\n{'='*70}")
-    print(f"{'Étape':<10} {'Min':>8} {'Max':>8} {'Avg':>8} {'Median':>8}")
-    print(f"{'-'*70}")
-    for name, times in [("Search", search_times), ("Rerank", rerank_times), ("Total", total_times)]:
-        s = sorted(times)
-        avg = sum(s) / len(s)
-        median = s[len(s) // 2]
-        print(f"{name:<10} {s[0]:>7.1f}ms {s[-1]:>7.1f}ms {avg:>7.1f}ms {median:>7.1f}ms")
+    print(f"\n{'Batch':<14} {'req/s':>10}")
+    for batch_size, row in results["batch"].items():
+        print(f"{batch_size:<14} {row['qps']:>10.1f}")
+    print(f"\n{'Clients':<14} {'req/s':>10} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for clients, row in results["concurrency"].items():
+        print(f"{clients:<14} {row['qps']:>10.1f} {row['p50']:>8.1f}ms {row['p95']:>8.1f}ms {row['p99']:>8.1f}ms")
+
+
+def comparable_metrics(results: dict) -> dict[str, tuple[float, bool]]:
+    """Mesures comparées à la référence : nom → (valeur, plus haut = mieux)."""
+    metrics = {}
+    for run in ("cold", "warm"):
+        for name, summary in results[run].items():
+            for p in ("p50", "p95", "p99"):
+                metrics[f"{run}.{name}.{p}"] = (summary[p], False)
+    for batch_size, row in results["batch"].items():
+        metrics[f"batch.{batch_size}.qps"] = (row["qps"], True)
+    for clients, row in results["concurrency"].items():
+        metrics[f"concurrency.{clients}.qps"] = (row["qps"], True)
+        metrics[f"concurrency.{clients}.p95"] = (row["p95"], False)
+    return metrics
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_ms: float = 1.0) -> list[str]:
+    """
+    Mesures qui régressent de plus de threshold (fraction) face à la référence.
+    Les latences sous min_ms sont ignorées (bruit de mesure).
+    """
+    current = comparable_metrics(results)
+    regressions = []
+    for name, (base, higher_is_better) in comparable_metrics(baseline).items():
+        if name not in current or (not higher_is_better and base < min_ms):
+            continue
+        value = current[name][0]
+        change = (value - base) / base if base else 0.0
+        if (-change if higher_is_better else change) > threshold:
+            regressions.append(f"{name:<32} {base:>10.2f} → {value:>10.2f} ({change:+.1%})")
+    return regressions
 
 
 if __name__ == "__main__":
-    benchmark()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", help="Fichier de requêtes (.json, .jsonl ou texte) ; défaut : 10 requêtes intégrées")
+    parser.add_argument("--repeat", type=int, default=3, help="Passages warm et débit sur les requêtes")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--output", help="Écrit les résultats en JSON")
+    parser.add_argument("--baseline", help="Résultats de référence (JSON de --output)")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Régression tolérée (0.10 = 10 %%)")
+    args = parser.parse_args()
+
+    results = benchmark(load_queries(args.queries), args.repeat, args.batch_sizes, args.concurrency)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nRésultats : {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        print(f"\nComparaison à {args.baseline} ({baseline['meta']['time']}), seuil {args.threshold:.0%}")
+        if regressions:
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("Aucune régression.")
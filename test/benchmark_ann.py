@@ -0,0 +1,189 @@
+"""
+Benchmark des index FAISS sur des catalogues synthétiques (10k, 100k, 500k tags).
+
+Pour chaque taille : construction (temps, taille des codes), latence par requête
+(p50, p95) et rappel@k face à la recherche exacte, pour flat, hnsw (plusieurs
+efSearch) et ivf (plusieurs nprobe). Puis le même catalogue découpé par
+préfixe de clé (ShardedIndex) : temps de la première requête (chargement
+des shards) et latence ensuite, en cherchant tous les shards puis en routant
+chaque requête vers les --probe-shards shards au centroïde le plus proche
+(shards lus : part du catalogue chargée en mémoire à la fin).
+Vérifie d'abord qu'une recherche routée vers des shards de moins de k tags
+renvoie bien k colonnes (complétées par -1), comme FAISS.
+
+Les vecteurs sont normalisés et regroupés par clé OSM synthétique (loi de Zipf),
+pour imiter la structure du catalogue ; aucun modèle n'est chargé.
+
+Usage: uv run test/benchmark_ann.py --sizes 10000 100000 500000
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from utils.faiss_index import ShardedIndex, build_index, index_size, tune, write_centroids, write_index
+
+EF_SEARCH_VALUES = [16, 32, 64, 128, 256]
+NPROBE_VALUES = [1, 4, 16, 64]
+
+
+def percentile(values: list[float], p: float) -> float:
+    s = sorted(values)
+    return s[min(len(s) - 1, round(p / 100 * (len(s) - 1)))]
+
+
+def synthetic_catalog(n: int, dim: int, n_keys: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """Embeddings normalisés groupés autour d'un centre par clé, et clé de chaque tag."""
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, n_keys + 1)
+    keys = np.sort(rng.choice(n_keys, size=n, p=weights / weights.sum()))
+    centers = rng.standard_normal((n_keys, dim)).astype("float32")
+    vectors = centers[keys] + 1.5 * rng.standard_normal((n, dim)).astype("float32")
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors, keys
+
+
+def synthetic_queries(vectors: np.ndarray, n_queries: int, seed: int = 1) -> np.ndarray:
+    """Requêtes proches de tags existants."""
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), n_queries, replace=False)]
+    queries = queries + 0.5 * rng.standard_normal(queries.shape).astype("float32") / np.sqrt(queries.shape[1])
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype("float32")
+
+
+def measure(index, queries: np.ndarray, truth: np.ndarray, k: int) -> dict:
+    """Latence requête par requête (comme le service) et rappel@k."""
+    index.search(queries[:1], k)  # Warmup
+    times = []
+    found = []
+    for q in queries:
+        t0 = time.perf_counter()
+        _, positions = index.search(q[None], k)
+        times.append((time.perf_counter() - t0) * 1000)
+        found.append(positions[0])
+    recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+    return {"p50": percentile(times, 50), "p95": percentile(times, 95), "recall": recall}
+
+
+def benchmark_size(n: int, dim: int, n_queries: int, k: int, types: list[str], n_keys: int,
+                   probe_values: list[int]) -> list[dict]:
+    vectors, keys = synthetic_catalog(n, dim, n_keys)
+    queries = synthetic_queries(vectors, n_queries)
+    rows = []
+
+    built = {}
+    build_times = {}
+    for index_type in types:
+        t0 = time.perf_counter()
+        built[index_type] = build_index(vectors, index_type)
+        build_times[index_type] = time.perf_counter() - t0
+
+    # Vérité terrain : recherche exacte
+    flat = built["flat"] if "flat" in built else build_index(vectors, "flat")
+    _, truth = flat.search(queries, k)
+
+    for index_type, index in built.items():
+        settings = {"hnsw": ("efSearch", EF_SEARCH_VALUES), "ivf": ("nprobe", NPROBE_VALUES)}.get(index_type)
+        for value in (settings[1] if settings else [None]):
+            if index_type == "hnsw":
+                tune(index, ef_search=value)
+            elif index_type == "ivf":
+                tune(index, nprobe=value)
+            label = f"{index_type} {settings[0]}={value}" if settings else index_type
+            rows.append({
+                "n": n, "index": label, "build_s": build_times[index_type], "size": index_size(index),
+                **measure(index, queries, truth, k),
+            })
+
+    # Même catalogue découpé par clé, shards écrits sur disque puis lus au premier search
+    with tempfile.TemporaryDirectory() as shard_dir:
+        for index_type in types:
+            shards = []
+            centroids = []
+            t0 = time.perf_counter()
+            for key in np.unique(keys):
+                shard = vectors[keys == key]
+                write_index(build_index(shard, index_type), shard, shard_dir, f"k{key}", index_type)
+                shards.append({"name": f"k{key}", "size": len(shard)})
+                centroids.append(shard.mean(axis=0))
+            write_centroids(shard_dir, np.stack(centroids))
+            build_s = time.perf_counter() - t0
+
+            for probe in [0, *probe_values]:
+                sharded = ShardedIndex(shard_dir, shards, dim, index_type, probe_shards=probe)
+                t0 = time.perf_counter()
+                sharded.search(queries[:1], k)
+                first_ms = (time.perf_counter() - t0) * 1000
+                result = measure(sharded, queries, truth, k)
+                loaded = sharded.loaded() / len(shards)  # Avant index_size, qui lit tous les shards
+                rows.append({
+                    "n": n, "index": f"sharded {index_type} ({len(shards)}, probe {probe or 'tous'})",
+                    "build_s": build_s, "size": index_size(sharded), "first_ms": first_ms, "loaded": loaded,
+                    **result,
+                })
+
+    return rows
+
+
+def check_routed_width(dim: int, n_shards: int = 4, shard_size: int = 40, probe: int = 2):
+    """Shards routés plus petits que k : k colonnes quand même, sinon embedding_search lit hors du tableau."""
+    vectors, keys = synthetic_catalog(n_shards * shard_size, dim, n_shards)
+    k = 3 * shard_size
+    with tempfile.TemporaryDirectory() as shard_dir:
+        shards, centroids = [], []
+        for i in range(n_shards):
+            shard = vectors[i * shard_size:(i + 1) * shard_size]
+            write_index(build_index(shard, "flat"), shard, shard_dir, f"s{i}", "flat")
+            shards.append({"name": f"s{i}", "size": shard_size})
+            centroids.append(shard.mean(axis=0))
+        write_centroids(shard_dir, np.stack(centroids))
+        sharded = ShardedIndex(shard_dir, shards, dim, "flat", probe_shards=probe)
+        scores, positions = sharded.search(synthetic_queries(vectors, 8), k)
+
+    found = int((positions[:, probe * shard_size:] >= 0).sum())
+    if scores.shape[1] != k or found:
+        sys.exit(f"Recherche routée : {scores.shape[1]} colonnes au lieu de {k}, {found} résultats hors des shards routés")
+    print(f"Recherche routée ({probe}/{n_shards} shards de {shard_size}, k={k}) : {k} colonnes, complétées par -1")
+
+
+def benchmark(sizes: list[int], dim: int, n_queries: int, k: int, types: list[str], n_keys: int,
+              probe_values: list[int]):
+    check_routed_width(dim)
+    rows = []
+    for n in sizes:
+        print(f"\n{n} tags...")
+        rows.extend(benchmark_size(n, dim, n_queries, k, types, n_keys, probe_values))
+
+    print(f"\n{'='*118}")
+    print(f"INDEX ANN ({n_queries} requêtes, rappel@{k} face à la recherche exacte)")
+    print(f"{'='*118}")
+    print(f"{'Tags':>8} {'Index':<34} {'Construction':>12} {'Mémoire':>10} {'p50':>9} {'p95':>9} {'Rappel':>8} "
+          f"{'1re req.':>10} {'Shards lus':>10}")
+    print(f"{'-'*118}")
+    for r in rows:
+        first = f"{r['first_ms']:>8.0f}ms" if "first_ms" in r else f"{'-':>10}"
+        loaded = f"{r['loaded']:>10.0%}" if "loaded" in r else f"{'-':>10}"
+        print(f"{r['n']:>8} {r['index']:<34} {r['build_s']:>11.1f}s {r['size'] / 1e6:>8.1f}Mo "
+              f"{r['p50']:>7.2f}ms {r['p95']:>7.2f}ms {r['recall']:>8.1%} {first} {loaded}")
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 100_000, 500_000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=30)
+    parser.add_argument("--types", nargs="+", default=["flat", "hnsw", "ivf"], choices=["flat", "hnsw", "ivf"])
+    parser.add_argument("--keys", type=int, default=200, help="Nombre de clés OSM synthétiques")
+    parser.add_argument("--probe-shards", nargs="+", type=int, default=[4, 16],
+                        help="Shards cherchés par requête (routage par centroïde)")
+    args = parser.parse_args()
+    benchmark(args.sizes, args.dim, args.queries, args.k, args.types, args.keys, args.probe_shards)
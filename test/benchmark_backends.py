@@ -0,0 +1,120 @@
+"""
+Compare les backends d'inférence PyTorch et ONNX Runtime.
+
+Chaque backend tourne dans son propre processus (le temps de démarrage inclut
+les imports), sur les cas de data/search_cases.json : temps de chargement,
+latences search / rerank (p50, p95) et recall/MRR après rerank, et si
+torch a été importé (jamais avec le backend onnx : erreur sinon).
+Les caches d'embeddings et de scores sont désactivés.
+
+Prérequis ONNX : uv run export-onnx.py --int8
+
+Usage: uv run test/benchmark_backends.py --backends torch onnx
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import subprocess
+import time
+
+
+def percentile(values: list[float], p: float) -> float:
+    s = sorted(values)
+    return s[min(len(s) - 1, round(p / 100 * (len(s) - 1)))]
+
+
+def run_backend(backend: str, test_file: str) -> dict:
+    """Exécuté dans le processus fils : charge tout avec ce backend et mesure."""
+    t0 = time.perf_counter()
+    from utils.prepare import load_catalog, load_search_settings, load_rerank_settings, configure_threads
+    from utils.embedding_search import search
+    from utils.rerank_with_crossencoder import rerank
+    t_import = time.perf_counter()
+    from evaluate import compute_metrics
+
+    configure_threads(backend=backend)
+    candidates = load_catalog()
+    search_settings = load_search_settings(backend=backend, candidates=candidates)
+    rerank_settings = load_rerank_settings(backend=backend)
+    search_settings["embedding_cache"] = None
+    rerank_settings["score_cache"] = None
+    t_load = time.perf_counter()
+
+    with open(test_file, "r", encoding="utf-8") as f:
+        cases = json.load(f)
+
+    # Warmup
+    rerank(cases[0]["query"], search(cases[0]["query"], candidates, search_settings), rerank_settings)
+
+    search_times = []
+    rerank_times = []
+    recall_total = 0
+    mrr_total = 0
+    for case in cases:
+        t1 = time.perf_counter()
+        results = search(case["query"], candidates, search_settings)
+        t2 = time.perf_counter()
+        reranked = rerank(case["query"], results, rerank_settings)
+        t3 = time.perf_counter()
+        search_times.append((t2 - t1) * 1000)
+        rerank_times.append((t3 - t2) * 1000)
+
+        expected = {tag[4:] if tag.startswith("tag:") else tag for tag in case["expected"]}
+        recall, mrr = compute_metrics(expected, [r.tag for r in reranked])
+        recall_total += recall
+        mrr_total += mrr
+
+    n = len(cases)
+    return {
+        "backend": f"{backend} {rerank_settings['precision']}",
+        "import_s": t_import - t0,
+        "load_s": t_load - t_import,
+        "search_p50": percentile(search_times, 50),
+        "search_p95": percentile(search_times, 95),
+        "rerank_p50": percentile(rerank_times, 50),
+        "rerank_p95": percentile(rerank_times, 95),
+        "recall": recall_total / n,
+        "mrr": mrr_total / n,
+        "torch": "torch" in sys.modules,
+    }
+
+
+def benchmark(backends: list[str], test_file: str):
+    rows = []
+    for backend in backends:
+        print(f"{backend}...")
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", backend, "--test-file", test_file],
+            capture_output=True, text=True, check=True,
+        )
+        rows.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    print(f"\n{'='*100}")
+    print(f"{'Backend':<18} {'Import':>8} {'Chargement':>11} {'Search p50':>11} {'p95':>8} "
+          f"{'Rerank p50':>11} {'p95':>8} {'Recall':>8} {'MRR':>6} {'torch':>6}")
+    print(f"{'-'*100}")
+    for r in rows:
+        print(f"{r['backend']:<18} {r['import_s']:>7.1f}s {r['load_s']:>10.1f}s "
+              f"{r['search_p50']:>9.1f}ms {r['search_p95']:>6.1f}ms "
+              f"{r['rerank_p50']:>9.1f}ms {r['rerank_p95']:>6.1f}ms {r['recall']:>8.1%} {r['mrr']:>6.2f} "
+              f"{'oui' if r['torch'] else 'non':>6}")
+    if any(r["torch"] for r, backend in zip(rows, backends) if backend == "onnx"):
+        sys.exit("Le backend onnx a importé torch")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx"], choices=["torch", "onnx"])
+    parser.add_argument("--test-file", default="data/search_cases.json")
+    parser.add_argument("--child", choices=["torch", "onnx"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_backend(args.child, args.test_file)))
+    else:
+        benchmark(args.backends, args.test_file)
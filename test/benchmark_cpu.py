@@ -0,0 +1,117 @@
+"""
+Benchmark du reranker sur CPU (int8, bf16, fp32) face à la référence GPU float16.
+
+Mesure la latence du rerank par requête (p50/p95) et le recall/MRR sur
+data/search_cases.json. La recherche par embedding est faite une seule fois,
+pour que toutes les configurations rerankent exactement les mêmes candidats.
+
+Usage: uv run test/benchmark_cpu.py --threads 8 --dtypes int8 bf16
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import gc
+import json
+import time
+import torch
+from utils.prepare import load_catalog, load_search_settings, load_rerank_settings, configure_threads
+from utils.embedding_search import search
+from utils.rerank_with_crossencoder import rerank
+from evaluate import compute_metrics
+
+
+def percentile(values: list[float], p: float) -> float:
+    s = sorted(values)
+    return s[min(len(s) - 1, round(p / 100 * (len(s) - 1)))]
+
+
+def run(label: str, device: str, cpu_dtype: str, cases: list[dict], search_results: list) -> dict:
+    rerank_settings = load_rerank_settings(device=device, cpu_dtype=cpu_dtype)
+    # On mesure le modèle, pas le cache de scores
+    rerank_settings["score_cache"] = None
+
+    def synchronize():
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    # Warmup
+    rerank(cases[0]["query"], search_results[0], rerank_settings)
+    synchronize()
+
+    times = []
+    recall_total = 0
+    mrr_total = 0
+    for case, results in zip(cases, search_results):
+        t0 = time.perf_counter()
+        reranked = rerank(case["query"], results, rerank_settings)
+        synchronize()
+        times.append((time.perf_counter() - t0) * 1000)
+
+        expected = {tag[4:] if tag.startswith("tag:") else tag for tag in case["expected"]}
+        recall, mrr = compute_metrics(expected, [r.tag for r in reranked])
+        recall_total += recall
+        mrr_total += mrr
+
+    del rerank_settings
+    gc.collect()
+    if device.startswith("cuda"):
+        torch.cuda.empty_cache()
+
+    n = len(cases)
+    return {
+        "config": label,
+        "recall": recall_total / n,
+        "mrr": mrr_total / n,
+        "p50": percentile(times, 50),
+        "p95": percentile(times, 95),
+        "avg": sum(times) / n,
+    }
+
+
+def benchmark(test_file: str, dtypes: list[str], threads: int):
+    configure_threads(threads)
+    print(f"Threads PyTorch: {torch.get_num_threads()}")
+
+    with open(test_file, "r", encoding="utf-8") as f:
+        cases = json.load(f)
+
+    candidates = load_catalog()
+    search_settings = load_search_settings(device="cpu", candidates=candidates)
+    search_results = [search(case["query"], candidates, search_settings) for case in cases]
+
+    configs = [("cuda", "fp16")] if torch.cuda.is_available() else []
+    configs += [("cpu", dtype) for dtype in dtypes]
+
+    rows = []
+    for device, cpu_dtype in configs:
+        label = f"{device} {'fp16' if device == 'cuda' else cpu_dtype}"
+        print(f"\n{label}...")
+        rows.append(run(label, device, cpu_dtype, cases, search_results))
+
+    baseline = rows[0] if configs[0][0] == "cuda" else None
+
+    print(f"\n{'='*78}")
+    print(f"RERANK ({len(cases)} cas)")
+    print(f"{'='*78}")
+    print(f"{'Config':<12} {'Recall':>8} {'MRR':>6} {'p50':>10} {'p95':>10} {'Avg':>10} {'Δ recall':>10}")
+    print(f"{'-'*78}")
+    for row in rows:
+        delta = f"{row['recall'] - baseline['recall']:>+10.1%}" if baseline else f"{'-':>10}"
+        print(f"{row['config']:<12} {row['recall']:>8.1%} {row['mrr']:>6.2f} "
+              f"{row['p50']:>8.1f}ms {row['p95']:>8.1f}ms {row['avg']:>8.1f}ms {delta}")
+    if baseline is None:
+        print("\n(pas de GPU : référence float16 non mesurée)")
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--test-file", default="data/search_cases.json")
+    parser.add_argument("--dtypes", nargs="+", default=["int8", "bf16"], choices=["int8", "bf16", "fp32"])
+    parser.add_argument("--threads", type=int, default=0, help="Threads PyTorch (0 = défaut)")
+    args = parser.parse_args()
+    benchmark(args.test_file, args.dtypes, args.threads)
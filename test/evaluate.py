@@ -2,16 +2,20 @@
 Script d'évaluation de la recherche de tags
 
 Usage: uv run test/evaluate.py
+       uv run test/evaluate.py --index-types flat sq8 pq binary   (search seul, par type d'index)
 """
 
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import argparse
 import json
+import time
 from utils.prepare import prepare
 from utils.embedding_search import search
 from utils.rerank_with_crossencoder import rerank
+from utils.faiss_index import INDEX_TYPES
 
 
 def compute_metrics(expected: set, found_tags: list) -> tuple[float, float]:
@@ -106,5 +110,93 @@ def evaluate(test_file: str = "data/search_cases.json", search_top_k_per_index:
     }
 
 
+def evaluate_index_types(index_types: list[str], test_file: str = "data/search_cases.json",
+                         search_top_k_per_index: int = 30, search_top_k_total: int = 50):
+    """
+    Compare les types d'index FAISS sur l'étape search seule :
+    recall/MRR, taille des codes de l'index et latence par requête.
+    Les embeddings des requêtes sont calculés une fois : la latence mesurée
+    est celle de la recherche dans l'index (+ re-scoring).
+    """
+    from utils.embedding_cache import QueryEmbeddingCache
+    from utils.embedding_search import _encode_queries
+    from utils.faiss_index import RESCORED_TYPES, index_size, vectors_path
+    from utils.prepare import DATA_DIR, EMBEDDING_MODEL, load_catalog, load_indexes, load_embedding_model
+
+    with open(test_file, "r", encoding="utf-8") as f:
+        cases = json.load(f)
+
+    candidates = load_catalog()
+    base = {
+        "model": load_embedding_model(),
+        "top_k_per_index": search_top_k_per_index,
+        "top_k_total": search_top_k_total,
+        "min_score": 0.0,
+    }
+
+    rows = []
+    for index_type in index_types:
+        try:
+            settings = {**base, **load_indexes(candidates=candidates, index_type=index_type)}
+        except (RuntimeError, FileNotFoundError) as e:
+            print(f"{index_type}: index absent ({e}), lancer create-index.py --index-types {index_type}")
+            continue
+
+        if "combined_index" in settings:
+            indexes, names = [settings["combined_index"]["index"]], ["catalog"]
+        else:
+            indexes, names = [c["index"] for c in settings["indexes"]], ["poi", "attributes"]
+        size = sum(index_size(index) for index in indexes)
+        rescoring_files = [vectors_path(DATA_DIR, name) for name in names] if index_type in RESCORED_TYPES else []
+        rescoring = sum(os.path.getsize(path) for path in rescoring_files if os.path.exists(path))
+
+        # Embeddings des requêtes pré-calculés
+        settings["embedding_cache"] = QueryEmbeddingCache(EMBEDDING_MODEL, dim=indexes[0].d, capacity=len(cases) + 1)
+        _encode_queries([case["query"] for case in cases], settings)
+
+        times = []
+        recall_total = 0
+        mrr_total = 0
+        for case in cases:
+            expected = {tag[4:] if tag.startswith("tag:") else tag for tag in case["expected"]}
+            t0 = time.perf_counter()
+            results = search(case["query"], candidates, settings)
+            times.append((time.perf_counter() - t0) * 1000)
+            recall, mrr = compute_metrics(expected, [r.tag for r in results])
+            recall_total += recall
+            mrr_total += mrr
+
+        n = len(cases)
+        rows.append({
+            "type": index_type,
+            "recall": recall_total / n,
+            "mrr": mrr_total / n,
+            "size": size,
+            "rescoring": rescoring,
+            "avg_ms": sum(times) / n,
+            "p95_ms": sorted(times)[min(n - 1, round(0.95 * (n - 1)))],
+        })
+
+    print(f"\n{'='*78}")
+    print(f"SEARCH PAR TYPE D'INDEX ({len(cases)} cas)")
+    print(f"{'='*78}")
+    print(f"{'Type':<8} {'Recall':>8} {'MRR':>6} {'Index':>10} {'Re-scoring':>11} {'Avg':>9} {'p95':>9}")
+    print(f"{'-'*78}")
+    for r in rows:
+        print(f"{r['type']:<8} {r['recall']:>8.1%} {r['mrr']:>6.2f} {r['size'] / 1e6:>8.2f}Mo "
+              f"{r['rescoring'] / 1e6:>9.2f}Mo {r['avg_ms']:>7.2f}ms {r['p95_ms']:>7.2f}ms")
+
+    return rows
+
+
 if __name__ == "__main__":
-    evaluate()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test-file", default="data/search_cases.json")
+    parser.add_argument("--index-types", nargs="+", choices=INDEX_TYPES,
+                        help="Compare les types d'index (search seul)")
+    args = parser.parse_args()
+
+    if args.index_types:
+        evaluate_index_types(args.index_types, args.test_file)
+    else:
+        evaluate(args.test_file)
@@ -0,0 +1,316 @@
+"""
+Test de charge HTTP de l'API (/search).
+
+Lance api.py en local avec uvicorn (ou vise --url), attend /ready, puis
+enchaîne des paliers :
+- boucle ouverte : débit d'arrivée fixe (--rates, req/s), indépendant des
+  réponses ; la latence est comptée depuis l'instant d'envoi prévu, pour
+  que la file d'attente côté client soit mesurée aussi
+- boucle fermée : nombre fixe de clients (--concurrency), chacun envoie
+  sa requête suivante dès la réponse à la précédente
+
+Les requêtes sont tirées de data/search_cases.json selon une loi de Zipf
+(quelques requêtes très fréquentes, une longue traîne), comme le trafic réel.
+Ces quelques requêtes distinctes seraient presque toutes servies par les
+caches de scores et d'embeddings après le premier palier : l'API lancée ici
+l'est sans eux (--caches pour les garder), et le taux de succès de chaque
+cache pendant chaque palier est relevé sur /metrics (avec --url notamment).
+
+Pour chaque palier : débit, taux d'erreur (503 saturation, 504 délai, autres),
+latences p50 / p95 / p99 / max et histogramme. Puis le point d'inflexion :
+dernier palier tenu (débit servi ≥ 95 % du débit offert, p99 sous --slo-ms,
+moins de 1 % d'erreurs) en boucle ouverte ; palier à partir duquel ajouter
+des clients ne fait plus gagner 10 % de débit en boucle fermée.
+
+Usage: uv run test/load_test.py [--rates 1 2 5 10 20] [--concurrency 1 2 4 8 16]
+                                [--duration 30] [--slo-ms 1000] [--url http://127.0.0.1:8000]
+                                [--caches] [--output load.json]
+"""
+
+import sys
+import os
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import argparse
+import json
+import random
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+REQUEST_TIMEOUT_S = 30
+
+
+def percentile(values: list[float], p: float) -> float:
+    s = sorted(values)
+    return s[min(len(s) - 1, round(p / 100 * (len(s) - 1)))]
+
+
+class QueryMix:
+    """Tirage des requêtes selon une loi de Zipf sur un ordre aléatoire (fixé par seed)."""
+
+    def __init__(self, path: str, exponent: float = 1.1, seed: int = 0):
+        with open(path, "r", encoding="utf-8") as f:
+            queries = [case["query"] for case in json.load(f)]
+        self.random = random.Random(seed)
+        self.random.shuffle(queries)
+        self.queries = queries
+        self.weights = [1 / rank ** exponent for rank in range(1, len(queries) + 1)]
+        self._lock = threading.Lock()
+
+    def sample(self) -> str:
+        with self._lock:
+            return self.random.choices(self.queries, self.weights)[0]
+
+
+class Client:
+    """Un requests.Session par thread (Session n'est pas thread-safe)."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._local = threading.local()
+
+    def search(self, query: str) -> int:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        try:
+            return session.get(f"{self.url}/search", params={"query": query}, timeout=REQUEST_TIMEOUT_S).status_code
+        except requests.RequestException:
+            return 0  # Connexion refusée, timeout client...
+
+
+def cache_counts(url: str) -> dict[str, tuple[float, float]]:
+    """(succès, échecs) de chaque cache d'après /metrics ; vide sans métriques ou sans cache."""
+    try:
+        response = requests.get(f"{url}/metrics", timeout=5)
+    except requests.RequestException:
+        return {}
+    if response.status_code != 200:
+        return {}
+    counts = {}
+    for kind, cache, value in re.findall(r'^traverse_cache_(hits|misses)_total\{cache="([^"]+)"\} (\S+)$',
+                                         response.text, re.MULTILINE):
+        hits, misses = counts.get(cache, (0.0, 0.0))
+        counts[cache] = (float(value), misses) if kind == "hits" else (hits, float(value))
+    return counts
+
+
+def cache_hit_ratio(before: dict, after: dict) -> dict[str, float]:
+    """Taux de succès de chaque cache entre deux relevés de cache_counts."""
+    ratios = {}
+    for cache, (hits, misses) in after.items():
+        hits -= before.get(cache, (0.0, 0.0))[0]
+        misses -= before.get(cache, (0.0, 0.0))[1]
+        if hits + misses:
+            ratios[cache] = hits / (hits + misses)
+    return ratios
+
+
+def step_report(results: list[tuple[float, int]], elapsed: float) -> dict:
+    """results : (latence ms, code HTTP) de chaque requête du palier."""
+    ok = [latency for latency, status in results if status == 200]
+    errors = {
+        "503": sum(status == 503 for _, status in results),
+        "504": sum(status == 504 for _, status in results),
+        "other": sum(status not in (200, 503, 504) for _, status in results),
+    }
+    histogram = [0] * (len(BUCKETS_MS) + 1)
+    for latency in ok:
+        histogram[next((i for i, bound in enumerate(BUCKETS_MS) if latency <= bound), len(BUCKETS_MS))] += 1
+    report = {
+        "sent": len(results), "ok": len(ok), "errors": errors,
+        "error_rate": 1 - len(ok) / len(results) if results else 0.0,
+        "throughput": len(ok) / elapsed,
+        "histogram": histogram,
+    }
+    if ok:
+        report.update(p50=percentile(ok, 50), p95=percentile(ok, 95), p99=percentile(ok, 99), max=max(ok))
+    return report
+
+
+def open_loop(client: Client, mix: QueryMix, rate: float, duration: float) -> dict:
+    """Arrivées à débit fixe ; assez de threads pour ne jamais retarder un envoi."""
+    n = max(1, int(rate * duration))
+    results = []
+    lock = threading.Lock()
+
+    def send(scheduled: float, query: str):
+        status = client.search(query)
+        with lock:
+            results.append(((time.perf_counter() - scheduled) * 1000, status))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(1024, n)) as pool:
+        for i in range(n):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, scheduled, mix.sample())
+    return {"rate": rate, **step_report(results, time.perf_counter() - start)}
+
+
+def closed_loop(client: Client, mix: QueryMix, clients: int, duration: float) -> dict:
+    results = []
+    lock = threading.Lock()
+    end = time.perf_counter() + duration
+
+    def run():
+        while time.perf_counter() < end:
+            t0 = time.perf_counter()
+            status = client.search(mix.sample())
+            with lock:
+                results.append(((time.perf_counter() - t0) * 1000, status))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {"concurrency": clients, **step_report(results, time.perf_counter() - start)}
+
+
+def open_loop_knee(steps: list[dict], slo_ms: float) -> dict | None:
+    """Dernier palier tenu avant la première dégradation."""
+    held = None
+    for step in steps:
+        if (step["throughput"] < 0.95 * step["rate"] or step["error_rate"] > 0.01
+                or step.get("p99", float("inf")) > slo_ms):
+            break
+        held = step
+    return held
+
+
+def closed_loop_knee(steps: list[dict]) -> dict | None:
+    """Palier au-delà duquel le palier suivant ajoute moins de 10 % de débit."""
+    for step, following in zip(steps, steps[1:]):
+        if following["throughput"] < 1.10 * step["throughput"]:
+            return step
+    return steps[-1] if steps else None
+
+
+def print_step(label: str, step: dict):
+    errors = step["errors"]
+    latencies = (f"{step['p50']:>7.0f} {step['p95']:>7.0f} {step['p99']:>7.0f} {step['max']:>7.0f}"
+                 if "p50" in step else f"{'-':>7} {'-':>7} {'-':>7} {'-':>7}")
+    print(f"{label:<12} {step['sent']:>6} {step['throughput']:>8.1f} {errors['503']:>5} {errors['504']:>5} "
+          f"{errors['other']:>5} {latencies}")
+    total = max(1, step["ok"])
+    bounds = [f"≤{b}" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}"]
+    print("             " + "  ".join(
+        f"{bound}:{count / total:.0%}" for bound, count in zip(bounds, step["histogram"]) if count
+    ))
+    if step["cache_hit_ratio"]:
+        print("             caches : " + "  ".join(
+            f"{cache} {ratio:.0%}" for cache, ratio in step["cache_hit_ratio"].items()
+        ))
+
+
+def print_header(title: str):
+    print(f"\n{'='*80}")
+    print(title)
+    print(f"{'='*80}")
+    print(f"{'Palier':<12} {'Envoi':>6} {'req/s':>8} {'503':>5} {'504':>5} {'autre':>5} "
+          f"{'p50':>7} {'p95':>7} {'p99':>7} {'max':>7}  (ms)")
+    print(f"{'-'*80}")
+
+
+def start_server(port: int, startup_timeout: float, caches: bool = False) -> tuple[subprocess.Popen, str]:
+    """uvicorn api:app en sous-processus, sans les caches sauf caches=True ; attend que /ready réponde 200."""
+    url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ)
+    if not caches:
+        env.update(TRAVERSE_SCORE_CACHE="0", TRAVERSE_EMBEDDING_CACHE="0")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port), "--log-level", "warning"], cwd=ROOT, env=env,
+    )
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"uvicorn s'est arrêté (code {server.returncode})")
+        try:
+            if requests.get(f"{url}/ready", timeout=2).status_code == 200:
+                return server, url
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    server.terminate()
+    raise TimeoutError(f"API pas prête après {startup_timeout:.0f}s")
+
+
+def load_test(url: str, mix: QueryMix, rates: list[float], concurrency: list[int], duration: float, slo_ms: float) -> dict:
+    client = Client(url)
+    for _ in range(10):
+        client.search(mix.sample())  # Warm-up côté client (connexions) et serveur
+
+    results = {"duration": duration, "slo_ms": slo_ms, "open_loop": [], "closed_loop": []}
+    if rates:
+        print_header(f"BOUCLE OUVERTE ({duration:.0f}s par palier)")
+        for rate in rates:
+            before = cache_counts(url)
+            step = open_loop(client, mix, rate, duration)
+            step["cache_hit_ratio"] = cache_hit_ratio(before, cache_counts(url))
+            results["open_loop"].append(step)
+            print_step(f"{rate:g} req/s", step)
+        knee = open_loop_knee(results["open_loop"], slo_ms)
+        results["open_loop_knee"] = knee["rate"] if knee else None
+        print("\nCapacité (boucle ouverte) : "
+              + (f"{knee['rate']:g} req/s tenus (p99 {knee['p99']:.0f}ms)" if knee else "aucun palier tenu"))
+
+    if concurrency:
+        print_header(f"BOUCLE FERMÉE ({duration:.0f}s par palier)")
+        for clients in concurrency:
+            before = cache_counts(url)
+            step = closed_loop(client, mix, clients, duration)
+            step["cache_hit_ratio"] = cache_hit_ratio(before, cache_counts(url))
+            results["closed_loop"].append(step)
+            print_step(f"{clients} clients", step)
+        knee = closed_loop_knee(results["closed_loop"])
+        results["closed_loop_knee"] = knee["concurrency"] if knee else None
+        if knee:
+            print(f"\nInflexion (boucle fermée) : {knee['concurrency']} clients, "
+                  f"{knee['throughput']:.1f} req/s" + (f", p95 {knee['p95']:.0f}ms" if "p95" in knee else ""))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rates", nargs="*", type=float, default=[1, 2, 5, 10, 20, 50], help="Paliers en boucle ouverte (req/s)")
+    parser.add_argument("--concurrency", nargs="*", type=int, default=[1, 2, 4, 8, 16, 32], help="Paliers en boucle fermée (clients)")
+    parser.add_argument("--duration", type=float, default=30, help="Durée de chaque palier (s)")
+    parser.add_argument("--slo-ms", type=float, default=1000, help="p99 maximal d'un palier tenu")
+    parser.add_argument("--cases", default=os.path.join(ROOT, "data", "search_cases.json"))
+    parser.add_argument("--zipf", type=float, default=1.1, help="Exposant de la loi de Zipf")
+    parser.add_argument("--url", help="API déjà lancée (sinon uvicorn est lancé en local)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--caches", action="store_true",
+                        help="Garde les caches de scores et d'embeddings de l'API lancée en local")
+    parser.add_argument("--output", help="Écrit les résultats en JSON")
+    args = parser.parse_args()
+
+    mix = QueryMix(args.cases, args.zipf)
+    server = None
+    url = args.url
+    if url is None:
+        print("Démarrage de l'API...")
+        server, url = start_server(args.port, args.startup_timeout, args.caches)
+    try:
+        results = load_test(url, mix, args.rates, args.concurrency, args.duration, args.slo_ms)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nRésultats : {args.output}")
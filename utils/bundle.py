@@ -0,0 +1,207 @@
+"""
+Bundle d'artefacts versionné, produit par create-index.py et ouvert en mmap :
+N workers uvicorn partagent une seule copie physique via le cache de pages,
+et le démarrage ne relit plus les JSON du catalogue.
+
+data/bundle/
+    manifest.json                    schéma, modèle, version du catalogue source,
+                                     taille et sha256 de chaque fichier
+    embeddings.npy                   float32 (n, d), dans l'ordre du catalogue
+    <colonne>.bin / .offsets.npy     chaînes UTF-8 concaténées + offsets int64 (n + 1)
+                                     pour tags, descriptions_fr, descriptions_natural
+    category_codes.npy               int8 (noms dans le manifeste)
+    usage_count.npy                  int64
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Sequence
+
+import numpy as np
+
+from .candidate_store import CandidateStore
+from .types import Candidate
+
+SCHEMA_VERSION = 1
+STRING_COLUMNS = ("tags", "descriptions_fr", "descriptions_natural")
+
+
+class MappedStrings(Sequence):
+    """Colonne de chaînes lue dans un blob UTF-8 en mmap, décodée à l'accès."""
+
+    def __init__(self, prefix: str):
+        offsets = np.load(f"{prefix}.offsets.npy", mmap_mode="r")
+        # np.memmap refuse les fichiers vides
+        if offsets[-1] > 0:
+            self._blob = np.memmap(f"{prefix}.bin", dtype=np.uint8, mode="r")
+        else:
+            self._blob = np.empty(0, dtype=np.uint8)
+        self._starts = offsets[:-1]
+        self._ends = offsets[1:]
+
+    def take(self, ids: np.ndarray) -> "MappedStrings":
+        """Sous-colonne aux positions ids, sur le même blob (sans copie des chaînes)."""
+        view = MappedStrings.__new__(MappedStrings)
+        view._blob = self._blob
+        view._starts = self._starts[ids]
+        view._ends = self._ends[ids]
+        return view
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, i: int) -> str:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._blob[self._starts[i]:self._ends[i]].tobytes().decode("utf-8")
+
+
+def _write_strings(prefix: str, values: list[str]):
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    with open(f"{prefix}.bin", "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(f"{prefix}.offsets.npy", offsets)
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_columns(out_dir: str, candidates: list[Candidate]) -> list[str]:
+    """Colonnes du catalogue en binaire ; renvoie les noms de catégories (ordre des codes)."""
+    _write_strings(os.path.join(out_dir, "tags"), [c.tag for c in candidates])
+    _write_strings(os.path.join(out_dir, "descriptions_fr"), [c.description_fr for c in candidates])
+    _write_strings(os.path.join(out_dir, "descriptions_natural"), [c.description_natural for c in candidates])
+
+    category_names = list(dict.fromkeys(c.category for c in candidates))
+    codes = {name: code for code, name in enumerate(category_names)}
+    np.save(os.path.join(out_dir, "category_codes.npy"), np.array([codes[c.category] for c in candidates], dtype=np.int8))
+    np.save(os.path.join(out_dir, "usage_count.npy"), np.array([c.usage_count for c in candidates], dtype=np.int64))
+    return category_names
+
+
+def read_columns(in_dir: str, category_names: tuple[str, ...]) -> CandidateStore:
+    """Catalogue en colonnes ouvertes en mmap (écrites par write_columns)."""
+    return CandidateStore.from_columns(
+        tags=MappedStrings(os.path.join(in_dir, "tags")),
+        descriptions_fr=MappedStrings(os.path.join(in_dir, "descriptions_fr")),
+        descriptions_natural=MappedStrings(os.path.join(in_dir, "descriptions_natural")),
+        category_names=category_names,
+        category_codes=np.load(os.path.join(in_dir, "category_codes.npy"), mmap_mode="r"),
+        usage_count=np.load(os.path.join(in_dir, "usage_count.npy"), mmap_mode="r"),
+    )
+
+
+def file_entries(out_dir: str) -> dict:
+    """Taille et sha256 de chaque fichier du dossier, pour le manifeste."""
+    return {
+        name: {"bytes": os.path.getsize(os.path.join(out_dir, name)), "sha256": _sha256(os.path.join(out_dir, name))}
+        for name in sorted(os.listdir(out_dir))
+    }
+
+
+def missing_file(in_dir: str, manifest: dict) -> str | None:
+    """Premier fichier du manifeste absent ou tronqué (contrôle de taille seulement)."""
+    for name, info in manifest["files"].items():
+        path = os.path.join(in_dir, name)
+        if not os.path.exists(path) or os.path.getsize(path) != info["bytes"]:
+            return name
+    return None
+
+
+def replace_dir(tmp_dir: str, target_dir: str):
+    """
+    Met tmp_dir à la place de target_dir. L'ancien est renommé de côté avant
+    d'être supprimé : un lecteur ne voit jamais un dossier à moitié effacé (au
+    pire absent), et les fichiers qu'il a déjà en mmap restent valides. Si un
+    autre processus met le sien en place entre-temps, il gagne et tmp_dir est supprimé.
+    """
+    old_dir = f"{target_dir}.old{os.getpid()}"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    try:
+        os.rename(target_dir, old_dir)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rename(tmp_dir, target_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def write_bundle(bundle_dir: str, candidates: list[Candidate], embeddings: np.ndarray,
+                 model_name: str, catalog_version: str) -> dict:
+    """
+    Écrit le bundle dans un dossier temporaire puis le met en place d'un coup.
+    Les workers qui ont encore l'ancien en mmap gardent leurs fichiers (supprimés mais ouverts).
+    """
+    tmp_dir = f"{bundle_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, "embeddings.npy"), np.ascontiguousarray(embeddings, dtype="float32"))
+    category_names = write_columns(tmp_dir, candidates)
+
+    files = file_entries(tmp_dir)
+    manifest = {
+        "schema": SCHEMA_VERSION,
+        # Empreinte du contenu : change dès qu'un fichier change
+        "version": hashlib.sha256("".join(f["sha256"] for f in files.values()).encode()).hexdigest()[:16],
+        "embedding_model": model_name,
+        "catalog_version": catalog_version,
+        "count": len(candidates),
+        "dim": int(embeddings.shape[1]),
+        "category_names": category_names,
+        "files": files,
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    replace_dir(tmp_dir, bundle_dir)
+    return manifest
+
+
+def load_bundle(bundle_dir: str, model_name: str, catalog_version: str) -> dict | None:
+    """
+    Ouvre le bundle en mmap : {"manifest", "candidates", "embeddings"}.
+    None s'il est absent, incomplet, d'un autre schéma, d'un autre modèle
+    ou construit sur une autre version du catalogue source.
+    """
+    manifest_path = os.path.join(bundle_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if (manifest.get("schema") != SCHEMA_VERSION or manifest["embedding_model"] != model_name
+            or manifest["catalog_version"] != catalog_version):
+        print(f"Bundle {bundle_dir} obsolète, relancer create-index.py")
+        return None
+    missing = missing_file(bundle_dir, manifest)
+    if missing is not None:
+        print(f"Bundle {bundle_dir} incomplet ({missing}), relancer create-index.py")
+        return None
+
+    return {
+        "manifest": manifest,
+        "candidates": read_columns(bundle_dir, tuple(manifest["category_names"])),
+        "embeddings": np.load(os.path.join(bundle_dir, "embeddings.npy"), mmap_mode="r"),
+    }
+
+
+def verify_bundle(bundle_dir: str) -> list[str]:
+    """Fichiers dont le sha256 ne correspond plus au manifeste (lecture complète, hors démarrage)."""
+    with open(os.path.join(bundle_dir, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    return [
+        name for name, info in manifest["files"].items()
+        if not os.path.exists(os.path.join(bundle_dir, name)) or _sha256(os.path.join(bundle_dir, name)) != info["sha256"]
+    ]
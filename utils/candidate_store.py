@@ -0,0 +1,137 @@
+"""
+Catalogue des candidats en colonnes.
+
+Construit une fois dans prepare() : search et rerank manipulent des ids
+(positions dans le catalogue) et des tableaux de scores, les objets
+Candidate ne sont créés qu'à la sortie (API, affichage).
+"""
+
+import json
+import os
+import sys
+import threading
+from collections.abc import Sequence
+
+import numpy as np
+
+from .types import Candidate
+
+
+class CandidateStore(Sequence):
+    __slots__ = (
+        "tags", "descriptions_fr", "descriptions_natural",
+        "category_names", "category_codes", "usage_count", "_positions",
+    )
+
+    def __init__(self, tags: list[str], descriptions_fr: list[str], descriptions_natural: Sequence[str],
+                 categories: list[str], usage_count: list[int]):
+        self.tags = [sys.intern(t) for t in tags]
+        self.descriptions_fr = [sys.intern(d) for d in descriptions_fr]
+        self.descriptions_natural = descriptions_natural
+
+        self.category_names = tuple(dict.fromkeys(categories))
+        codes = {name: code for code, name in enumerate(self.category_names)}
+        self.category_codes = np.array([codes[c] for c in categories], dtype=np.int8)
+        self.usage_count = np.array(usage_count, dtype=np.int64)
+        self._index_categories()
+
+    def _index_categories(self):
+        # ids de chaque catégorie, dans l'ordre du catalogue (= ordre des index FAISS par catégorie)
+        self._positions = {
+            name: np.flatnonzero(self.category_codes == code)
+            for code, name in enumerate(self.category_names)
+        }
+
+    @classmethod
+    def from_columns(cls, tags: Sequence[str], descriptions_fr: Sequence[str], descriptions_natural: Sequence[str],
+                     category_names: tuple[str, ...], category_codes: np.ndarray,
+                     usage_count: np.ndarray) -> "CandidateStore":
+        """Colonnes déjà construites (p. ex. en mmap, voir bundle.py), gardées sans copie."""
+        store = cls.__new__(cls)
+        store.tags = tags
+        store.descriptions_fr = descriptions_fr
+        store.descriptions_natural = descriptions_natural
+        store.category_names = category_names
+        store.category_codes = category_codes
+        store.usage_count = usage_count
+        store._index_categories()
+        return store
+
+    @classmethod
+    def from_candidates(cls, candidates: list[Candidate]) -> "CandidateStore":
+        return cls(
+            tags=[c.tag for c in candidates],
+            descriptions_fr=[c.description_fr for c in candidates],
+            descriptions_natural=[c.description_natural for c in candidates],
+            categories=[c.category for c in candidates],
+            usage_count=[c.usage_count for c in candidates],
+        )
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def __getitem__(self, i: int) -> Candidate:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return Candidate(
+            tag=self.tags[i],
+            description_fr=self.descriptions_fr[i],
+            description_natural=self.descriptions_natural[i],
+            category=self.category(i),
+            usage_count=int(self.usage_count[i]),
+        )
+
+    def category(self, i: int) -> str:
+        return self.category_names[self.category_codes[i]]
+
+    def ids(self, category: str) -> np.ndarray:
+        """ids des candidats d'une catégorie, dans l'ordre de son index FAISS."""
+        return self._positions.get(category, np.empty(0, dtype=np.intp))
+
+    def materialize(self, ids, scores, visibility: list[str] | None = None) -> list[Candidate]:
+        """Crée les Candidate de sortie pour des ids et leurs scores."""
+        visibility = visibility or [""] * len(ids)
+        return [
+            Candidate(
+                tag=self.tags[i],
+                description_fr=self.descriptions_fr[i],
+                description_natural=self.descriptions_natural[i],
+                category=self.category(i),
+                usage_count=int(self.usage_count[i]),
+                score=float(score),
+                visibility=vis,
+            )
+            for i, score, vis in zip(ids, scores, visibility)
+        ]
+
+
+class ShardedTexts(Sequence):
+    """
+    Colonne de textes lue par shard au premier accès (<shard_dir>/<nom>_desc.json),
+    pour les catalogues découpés par create-index.py --shards.
+    """
+
+    def __init__(self, shard_dir: str, names: list[str], sizes: list[int]):
+        self.shard_dir = shard_dir
+        self.names = names
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self._texts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i: int) -> str:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        texts = self._texts.get(shard)
+        if texts is None:
+            with self._lock:
+                if shard not in self._texts:
+                    path = os.path.join(self.shard_dir, f"{self.names[shard]}_desc.json")
+                    with open(path, "r", encoding="utf-8") as f:
+                        self._texts[shard] = json.load(f)
+                texts = self._texts[shard]
+        return texts[i - self.offsets[shard]]
@@ -0,0 +1,222 @@
+"""
+Caches d'embeddings.
+
+QueryEmbeddingCache : cache LRU des embeddings de requêtes.
+
+Les vecteurs (normalisés) sont rangés dans un tableau de `capacity` lignes,
+éventuellement mappé en mémoire depuis un fichier .npy pour survivre aux
+redémarrages. Une requête déjà vue ne repasse pas par l'encodeur.
+
+Chaque ligne garde aussi l'empreinte de sa clé, vérifiée à chaque lecture :
+une ligne réécrite depuis (arrêt brutal avant save) compte comme un échec.
+Chaque processus (worker uvicorn) prend ses propres fichiers : le premier
+<path>, <path>.1, <path>.2... dont il obtient le verrou exclusif.
+
+PassageEmbeddingCache : embeddings des descriptions indexées, par empreinte
+(modèle + texte encodé), pour que create-index.py ne ré-encode que les
+descriptions nouvelles ou modifiées.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows : pas de verrou, un seul processus supposé
+    fcntl = None
+
+# Fichiers de cache distincts au plus (un par worker) ; au-delà, cache en mémoire
+MAX_CACHE_FILES = 64
+
+
+def _claim(path: str):
+    """(préfixe de fichiers libre, fichier de verrou à garder ouvert), ou (None, None) si tous sont pris."""
+    if fcntl is None:
+        return path, None
+    for i in range(MAX_CACHE_FILES):
+        candidate = path if i == 0 else f"{path}.{i}"
+        lock_file = open(f"{candidate}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        return candidate, lock_file
+    return None, None
+
+
+def _fingerprint(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class QueryEmbeddingCache:
+    def __init__(self, model_name: str, dim: int, capacity: int = 10_000, path: str | None = None):
+        """
+        Args:
+            model_name: Modèle d'embedding, fait partie de la clé
+            dim: Dimension des vecteurs
+            capacity: Nombre max de requêtes gardées
+            path: Préfixe des fichiers de persistance (<path>.npy + <path>.json), ou None
+        """
+        self.model_name = model_name
+        self.dim = dim
+        self.capacity = capacity
+        self._slots = OrderedDict()  # clé → ligne dans _vectors, de la moins à la plus récemment utilisée
+        self._free = []  # Lignes libérées (empreinte invalide au rechargement ou à la lecture)
+        self._next_slot = 0  # Première ligne jamais utilisée
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._lock_file = None  # Gardé ouvert : le verrou réserve les fichiers à ce processus
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            path, self._lock_file = _claim(path)
+        self.path = path
+        if path is None:
+            self._vectors = np.zeros((capacity, dim), dtype="float32")
+            self._fingerprints = np.zeros(capacity, dtype="uint64")
+            return
+
+        vectors_path, fingerprints_path, keys_path = f"{path}.npy", f"{path}.keys.npy", f"{path}.json"
+        if all(os.path.exists(p) for p in (vectors_path, fingerprints_path, keys_path)):
+            self._vectors = np.load(vectors_path, mmap_mode="r+")
+            self._fingerprints = np.load(fingerprints_path, mmap_mode="r+")
+            with open(keys_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if self._vectors.shape == (capacity, dim) and saved.get("model") == model_name:
+                self._slots.update(
+                    (key, slot) for key, slot in saved["slots"]
+                    if self._fingerprints[slot] == _fingerprint(key)
+                )
+                used = set(self._slots.values())
+                self._next_slot = max(used, default=-1) + 1
+                self._free = [i for i in range(self._next_slot) if i not in used]
+                return
+        self._vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype="float32", shape=(capacity, dim))
+        self._fingerprints = np.lib.format.open_memmap(fingerprints_path, mode="w+", dtype="uint64", shape=(capacity,))
+
+    def _key(self, query: str) -> str:
+        return f"{self.model_name}\0{query}"
+
+    def get(self, query: str) -> np.ndarray | None:
+        key = self._key(query)
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None and self._fingerprints[slot] != _fingerprint(key):
+                # Ligne réécrite sous une autre clé : jamais le vecteur d'une autre requête
+                del self._slots[key]
+                self._free.append(slot)
+                slot = None
+            if slot is None:
+                self.misses += 1
+                return None
+            self._slots.move_to_end(key)
+            self.hits += 1
+            return np.array(self._vectors[slot])
+
+    def put(self, query: str, vector: np.ndarray):
+        key = self._key(query)
+        with self._lock:
+            if key in self._slots:
+                slot = self._slots.pop(key)
+            elif len(self._slots) < self.capacity:
+                slot = self._free_slot()
+            else:
+                _, slot = self._slots.popitem(last=False)
+            self._vectors[slot] = vector
+            self._fingerprints[slot] = _fingerprint(key)
+            self._slots[key] = slot
+
+    def _free_slot(self) -> int:
+        if self._free:
+            return self._free.pop()
+        self._next_slot += 1
+        return self._next_slot - 1
+
+    def save(self):
+        """Écrit l'index des clés et vide le memmap sur disque (sans effet sans path)."""
+        if self.path is None:
+            return
+        with self._lock:
+            self._vectors.flush()
+            self._fingerprints.flush()
+            with open(f"{self.path}.json", "w", encoding="utf-8") as f:
+                json.dump({"model": self.model_name, "slots": list(self._slots.items())}, f)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._slots),
+                "capacity": self.capacity,
+            }
+
+
+class PassageEmbeddingCache:
+    def __init__(self, model_name: str, path: str | None = None):
+        """
+        Args:
+            model_name: Modèle d'embedding, fait partie de l'empreinte
+            path: Fichier de persistance (<path>.npz : empreintes + vecteurs), ou None
+        """
+        self.model_name = model_name
+        self.path = path
+        self._vectors = {}  # empreinte hex → vecteur
+        self._seen = set()  # Empreintes demandées pendant ce run (les autres sont purgées par save(prune=True))
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None and os.path.exists(f"{path}.npz"):
+            with np.load(f"{path}.npz") as saved:
+                if str(saved["model"]) == model_name:
+                    self._vectors = dict(zip(saved["keys"].tolist(), saved["vectors"]))
+
+    def _key(self, text: str) -> str:
+        return hashlib.blake2b(f"{self.model_name}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def get_many(self, texts: list[str]) -> list[np.ndarray | None]:
+        keys = [self._key(t) for t in texts]
+        self._seen.update(keys)
+        vectors = [self._vectors.get(key) for key in keys]
+        misses = sum(v is None for v in vectors)
+        self.hits += len(texts) - misses
+        self.misses += misses
+        return vectors
+
+    def put_many(self, texts: list[str], vectors: np.ndarray):
+        for text, vector in zip(texts, vectors):
+            key = self._key(text)
+            self._seen.add(key)
+            self._vectors[key] = np.asarray(vector, dtype="float32")
+
+    def save(self, prune: bool = False) -> int:
+        """
+        Écrit le cache ; avec prune, seulement les empreintes vues pendant ce run
+        (descriptions supprimées ou modifiées depuis : purgées). Renvoie le nombre d'entrées purgées.
+        """
+        pruned = 0
+        if prune:
+            pruned = len(self._vectors) - len(self._seen & self._vectors.keys())
+            self._vectors = {key: vector for key, vector in self._vectors.items() if key in self._seen}
+        if self.path is None or not self._vectors:
+            return pruned
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Fichier temporaire puis remplacement : jamais de cache à moitié écrit
+        tmp_path = f"{self.path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            model=np.array(self.model_name),
+            keys=np.array(list(self._vectors)),
+            vectors=np.stack(list(self._vectors.values())),
+        )
+        os.replace(tmp_path, f"{self.path}.npz")
+        return pruned
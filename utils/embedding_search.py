@@ -1,43 +1,152 @@
-from dataclasses import replace
+import numpy as np
 
+from .candidate_store import CandidateStore
+from .timing import stage
 from .types import Candidate
 
 
-def search(query: str, candidates: list[Candidate], settings: dict) -> list[Candidate]:
+def search(query: str, candidates: CandidateStore, settings: dict) -> list[Candidate]:
     """
     Recherche par embedding dans les index FAISS.
 
     Args:
         query: Requête en français
-        candidates: Liste complète de candidats (même ordre que les index FAISS)
-        settings: {"model", "indexes", "top_k_per_index", "top_k_total", "min_score"}
+        candidates: Catalogue complet (prepare), même ordre que les index FAISS par catégorie
+        settings: {"model", "indexes" ou "combined_index" + "categories", "top_k_per_index",
+                   "top_k_total", "min_score", "embedding_cache", "timer"}
 
     Returns:
         Sous-ensemble de candidats avec score rempli, triés par score décroissant
     """
-    model = settings["model"]
-    top_k_per_index = settings.get("top_k_per_index", 30)
+    return search_batch([query], candidates, settings)[0]
+
+
+def _encode_queries(queries: list[str], settings: dict) -> np.ndarray:
+    """Encode les requêtes, en ne passant par le modèle que pour celles absentes du cache."""
+    cache = settings.get("embedding_cache")
+    vectors = [cache.get(q) if cache is not None else None for q in queries]
+    missing = [i for i, v in enumerate(vectors) if v is None]
+
+    if missing:
+        with stage(settings, "encode"):
+            encoded = settings["model"].encode(
+                [f"query: {queries[i]}" for i in missing], normalize_embeddings=True
+            ).astype("float32")
+        for i, vector in zip(missing, encoded):
+            vectors[i] = vector
+            if cache is not None:
+                cache.put(queries[i], vector)
+
+    return np.stack(vectors)
+
+
+def search_ids_batch(queries: list[str], candidates: CandidateStore, settings: dict) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Recherche batchée sur ids : un seul encode et un index.search multi-lignes
+    pour toutes les requêtes (par index, ou une seule avec l'index combiné).
+
+    Returns:
+        Par requête, (ids dans le catalogue, scores), triés par score décroissant
+    """
+    if not queries:
+        return []
+
     top_k_total = settings.get("top_k_total", 50)
-    min_score = settings.get("min_score", 0.0)
 
-    query_embedding = model.encode(
-        [f"query: {query}"], normalize_embeddings=True
-    ).astype("float32")
+    query_embeddings = _encode_queries(queries, settings)
+
+    with stage(settings, "faiss"):
+        if "combined_index" in settings:
+            found_ids, found_scores = _search_combined(query_embeddings, candidates, settings)
+        else:
+            found_ids, found_scores = _search_per_index(query_embeddings, candidates, settings)
+
+        results = []
+        for ids, scores in zip(found_ids, found_scores):
+            ids, scores = np.concatenate(ids), np.concatenate(scores)
+            order = np.argsort(-scores, kind="stable")[:top_k_total]
+            results.append((ids[order], scores[order]))
+    return results
+
+
+def _search_per_index(query_embeddings: np.ndarray, candidates: CandidateStore, settings: dict):
+    """Un index FAISS par catégorie : une recherche par index."""
+    top_k_per_index = settings.get("top_k_per_index", 30)
+    min_score = settings.get("min_score", 0.0)
 
-    results = []
+    found_ids = [[] for _ in query_embeddings]
+    found_scores = [[] for _ in query_embeddings]
 
     for index_config in settings["indexes"]:
-        index = index_config["index"]
-        category = index_config["category"]
+        # Position dans l'index FAISS de la catégorie → id dans le catalogue
+        positions = candidates.ids(index_config["category"])
+
+        scores, indices = index_config["index"].search(query_embeddings, top_k_per_index)
+
+        for row, (row_indices, row_scores) in enumerate(zip(indices, scores)):
+            keep = (row_indices >= 0) & (row_scores >= min_score)
+            found_ids[row].append(positions[row_indices[keep]])
+            found_scores[row].append(row_scores[keep])
+
+    return found_ids, found_scores
+
+
+def _search_combined(query_embeddings: np.ndarray, candidates: CandidateStore, settings: dict):
+    """
+    Index combiné : une seule recherche sur-dimensionnée, puis top_k_per_index
+    par catégorie. Si une catégorie n'a pas son quota dans la liste courte,
+    on complète par une recherche restreinte à ses vecteurs (les lignes
+    concernées en un seul appel). Le résultat est celui des index séparés.
+    """
+    top_k_per_index = settings.get("top_k_per_index", 30)
+    min_score = settings.get("min_score", 0.0)
+    combined = settings["combined_index"]
+    index, ids, positions = combined["index"], combined["ids"], combined["positions"]
+    categories = [c for c in settings["categories"] if c in positions]
+
+    k = min(index.ntotal, top_k_per_index * len(categories) * combined["overfetch"])
+    scores, indices = index.search(query_embeddings, k)
+
+    found_ids = [[] for _ in query_embeddings]
+    found_scores = [[] for _ in query_embeddings]
+
+    for category in categories:
+        in_category = np.isin(indices, positions[category])
+        quota = min(top_k_per_index, len(positions[category]))
+        short = []
+
+        for row in range(len(query_embeddings)):
+            row_indices = indices[row][in_category[row]][:top_k_per_index]
+            row_scores = scores[row][in_category[row]][:top_k_per_index]
+            # Liste courte = tout l'index, ou déjà sous min_score : rien de mieux ailleurs
+            exhausted = k == index.ntotal or scores[row][k - 1] < min_score
+            if len(row_indices) < quota and not exhausted:
+                short.append(row)
+                continue
+            _keep(found_ids[row], found_scores[row], ids, row_indices, row_scores, min_score)
 
-        # Filtrer les candidats de cette catégorie (même ordre que le FAISS index)
-        cat_candidates = [c for c in candidates if c.category == category]
+        if short:
+            params, _ = combined["params"][category]
+            short_scores, short_indices = index.search(query_embeddings[short], top_k_per_index, params=params)
+            for row, row_indices, row_scores in zip(short, short_indices, short_scores):
+                _keep(found_ids[row], found_scores[row], ids, row_indices, row_scores, min_score)
 
-        scores, indices = index.search(query_embedding, top_k_per_index)
+    return found_ids, found_scores
 
-        for idx, score in zip(indices[0], scores[0]):
-            if score >= min_score:
-                results.append(replace(cat_candidates[idx], score=float(score)))
 
-    results.sort(key=lambda c: c.score, reverse=True)
-    return results[:top_k_total]
+def _keep(found_ids: list, found_scores: list, ids: np.ndarray, row_indices: np.ndarray, row_scores: np.ndarray,
+          min_score: float):
+    """Ajoute les résultats valides (position connue du catalogue, score ≥ min_score)."""
+    valid = row_indices >= 0
+    row_ids = np.where(valid, ids[row_indices], -1)
+    keep = (row_ids >= 0) & (row_scores >= min_score)
+    found_ids.append(row_ids[keep])
+    found_scores.append(row_scores[keep])
+
+
+def search_batch(queries: list[str], candidates: CandidateStore, settings: dict) -> list[list[Candidate]]:
+    """
+    Version batchée de search. Le résultat de chaque requête est identique
+    à celui de search().
+    """
+    return [candidates.materialize(ids, scores) for ids, scores in search_ids_batch(queries, candidates, settings)]
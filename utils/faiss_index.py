@@ -0,0 +1,311 @@
+"""
+Types d'index FAISS : exact (flat), compressés avec re-scoring, ou approchés (ANN).
+
+- flat   : IndexFlatIP, vecteurs float32 complets (3 Ko par tag)
+- sq8    : quantification scalaire 8 bits (768 o par tag)
+- pq     : quantification produit, PQ_M sous-vecteurs de 8 bits (64 o par tag)
+- binary : signe de chaque composante, distance de Hamming (96 o par tag)
+- hnsw   : graphe HNSW (HNSW_M voisins), précision réglée par efSearch
+- ivf    : IVF à ~4·√n listes (≥ 39 vecteurs par liste), précision réglée par nprobe
+
+Les index compressés ne servent qu'à produire une liste courte (k × RESCORE_FACTOR)
+re-scorée par produit scalaire exact avec les vecteurs float32 de <nom>.vectors.npy,
+ouverts en mmap (partagés entre workers via le cache de pages).
+
+MappedFlatIndex cherche exactement sur les embeddings du bundle en mmap (bundle.py).
+ShardedIndex répartit le catalogue en un index par préfixe de clé OSM, chargé
+au premier accès. Une requête ne porte pas de clé OSM : elle est routée vers
+les probe_shards shards dont le centroïde est le plus proche (comme un IVF à
+gros grain), les autres ne sont ni lus ni cherchés ; probe_shards=0 cherche
+partout (résultat exact, mais tous les shards sont chargés dès la 1re requête).
+"""
+
+import os
+import threading
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "sq8", "pq", "binary", "hnsw", "ivf")
+RESCORED_TYPES = ("sq8", "pq", "binary")
+PQ_M = 64
+RESCORE_FACTOR = 4
+HNSW_M = 32
+EF_SEARCH = 64
+NPROBE = 16
+
+
+def index_path(data_dir: str, name: str, index_type: str) -> str:
+    """<nom>.index pour flat (fichiers historiques), <nom>.<type>.index sinon."""
+    suffix = "index" if index_type == "flat" else f"{index_type}.index"
+    return os.path.join(data_dir, f"{name}.{suffix}")
+
+
+def vectors_path(data_dir: str, name: str) -> str:
+    return os.path.join(data_dir, f"{name}.vectors.npy")
+
+
+def binarize(vectors: np.ndarray) -> np.ndarray:
+    return np.packbits(vectors > 0, axis=1)
+
+
+def build_index(embeddings: np.ndarray, index_type: str):
+    """Construit (et entraîne si besoin) un index sur des embeddings normalisés."""
+    d = embeddings.shape[1]
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(d)
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "pq":
+        # 8 bits par sous-vecteur demandent au moins 256 vecteurs d'entraînement
+        nbits = min(8, max(1, int(np.log2(len(embeddings)))))
+        index = faiss.IndexPQ(d, PQ_M, nbits, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 200
+    elif index_type == "ivf":
+        # FAISS demande ~39 vecteurs d'entraînement par liste
+        nlist = max(1, min(int(4 * np.sqrt(len(embeddings))), len(embeddings) // 39))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(d), d, nlist, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "binary":
+        index = faiss.IndexBinaryFlat(d)
+        index.add(binarize(embeddings))
+        return index
+    else:
+        raise ValueError(f"Type d'index inconnu : {index_type}")
+
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add(embeddings)
+    return index
+
+
+def write_index(index, embeddings: np.ndarray, data_dir: str, name: str, index_type: str):
+    """Écrit l'index, et les vecteurs float32 de re-scoring pour les types compressés."""
+    path = index_path(data_dir, name, index_type)
+    if isinstance(index, faiss.IndexBinary):
+        faiss.write_index_binary(index, path)
+    else:
+        faiss.write_index(index, path)
+    if index_type in RESCORED_TYPES:
+        np.save(vectors_path(data_dir, name), embeddings.astype("float32"))
+
+
+def tune(index, ef_search: int = EF_SEARCH, nprobe: int = NPROBE):
+    """Compromis vitesse / rappel des index ANN (sans effet sur les autres)."""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = nprobe
+    return index
+
+
+def read_index(data_dir: str, name: str, index_type: str = "flat", rescore_factor: int = RESCORE_FACTOR,
+               ef_search: int = EF_SEARCH, nprobe: int = NPROBE):
+    """
+    Index flat / ANN tel quel (réglé par ef_search / nprobe), ou index compressé
+    enveloppé dans un RescoredIndex.
+    """
+    path = index_path(data_dir, name, index_type)
+    if index_type not in RESCORED_TYPES:
+        return tune(faiss.read_index(path), ef_search, nprobe)
+
+    index = faiss.read_index_binary(path) if index_type == "binary" else faiss.read_index(path)
+    vectors = np.load(vectors_path(data_dir, name), mmap_mode="r")
+    return RescoredIndex(index, vectors, rescore_factor)
+
+
+def subset_params(index, positions: np.ndarray) -> tuple:
+    """
+    Paramètres de recherche restreinte à certaines positions de l'index,
+    sous la forme (params, référence à garder en vie) attendue par index.search.
+    """
+    if isinstance(index, (RescoredIndex, ShardedIndex, MappedFlatIndex)):
+        return positions, None
+    selector = faiss.IDSelectorBatch(positions)
+    # Les index ANN exigent leur propre type de paramètres
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch), selector
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe), selector
+    return faiss.SearchParameters(sel=selector), selector
+
+
+def index_size(index) -> int:
+    """Octets occupés par les codes de l'index (sans les vecteurs de re-scoring)."""
+    if isinstance(index, ShardedIndex):
+        return sum(index_size(shard) for shard in index.shards())
+    if isinstance(index, MappedFlatIndex):
+        return int(index.vectors.nbytes)
+    if isinstance(index, RescoredIndex):
+        index = index.index
+    if isinstance(index, faiss.IndexBinary):
+        return int(faiss.serialize_index_binary(index).nbytes)
+    return int(faiss.serialize_index(index).nbytes)
+
+
+class RescoredIndex:
+    """
+    Index compressé + re-scoring exact de la liste courte.
+    Même interface de recherche qu'un index FAISS : search(queries, k) → (scores, positions).
+    """
+
+    def __init__(self, index, vectors: np.ndarray, rescore_factor: int = RESCORE_FACTOR):
+        self.index = index
+        self.vectors = vectors
+        self.rescore_factor = rescore_factor
+        self.binary = isinstance(index, faiss.IndexBinary)
+        self.ntotal = index.ntotal
+        self.d = vectors.shape[1]
+
+    def search(self, queries: np.ndarray, k: int, params=None) -> tuple[np.ndarray, np.ndarray]:
+        if params is not None:
+            # Restreint à des positions (subset_params) : produit scalaire exact sur ce sous-ensemble
+            scores = queries @ self.vectors[params].T
+            order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+            return np.take_along_axis(scores, order, axis=1), params[order]
+
+        k_short = min(self.ntotal, k * self.rescore_factor)
+        if self.binary:
+            _, short = self.index.search(binarize(queries), k_short)
+        else:
+            _, short = self.index.search(queries, k_short)
+
+        scores = np.einsum("bd,bkd->bk", queries, self.vectors[np.maximum(short, 0)])
+        scores[short < 0] = -np.inf
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(short, order, axis=1)
+
+
+class MappedFlatIndex:
+    """
+    Recherche exacte (produit scalaire) directement sur des vecteurs en mmap,
+    p. ex. les embeddings du bundle : pas de copie privée par processus.
+    """
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+        self.ntotal, self.d = vectors.shape
+
+    def search(self, queries: np.ndarray, k: int, params=None) -> tuple[np.ndarray, np.ndarray]:
+        # params : positions (subset_params) auxquelles restreindre la recherche
+        vectors = self.vectors if params is None else self.vectors[params]
+        scores = queries @ vectors.T
+        k = min(k, scores.shape[1])
+        if k == 0:
+            return np.empty((len(queries), 0), dtype="float32"), np.empty((len(queries), 0), dtype=np.int64)
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        positions = np.take_along_axis(top, order, axis=1)
+        if params is not None:
+            positions = params[positions]
+        return np.take_along_axis(top_scores, order, axis=1), positions
+
+
+def shard_key(tag: str) -> str:
+    """Préfixe de clé OSM : "addr:street=*" → "addr", "amenity=cafe" → "amenity"."""
+    return tag.split("=", 1)[0].split(":", 1)[0]
+
+
+def write_centroids(shard_dir: str, centroids: np.ndarray):
+    """Centroïdes normalisés des shards (ordre du catalogue), pour le routage des requêtes."""
+    centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    np.save(os.path.join(shard_dir, "centroids.npy"), centroids.astype("float32"))
+
+
+class ShardedIndex:
+    """
+    Un index par shard (<shard_dir>/<nom>[.<type>].index), lu au premier search
+    qui y est routé. Les positions sont globales : shards concaténés dans
+    l'ordre de `shards`.
+    """
+
+    def __init__(self, shard_dir: str, shards: list[dict], dim: int, index_type: str = "flat",
+                 probe_shards: int = 0, **read_options):
+        """
+        Args:
+            shards: [{"name", "size"}] dans l'ordre du catalogue
+            probe_shards: shards cherchés par requête (0 = tous, ou sans centroids.npy)
+            read_options: rescore_factor, ef_search, nprobe (voir read_index)
+        """
+        self.shard_dir = shard_dir
+        self.names = [shard["name"] for shard in shards]
+        self.offsets = np.concatenate([[0], np.cumsum([shard["size"] for shard in shards])]).astype(np.int64)
+        self.index_type = index_type
+        self.read_options = read_options
+        self.ntotal = int(self.offsets[-1])
+        self.d = dim
+        self._indexes = [None] * len(shards)
+        self._lock = threading.Lock()
+
+        centroids_path = os.path.join(shard_dir, "centroids.npy")
+        self.centroids = None
+        self.probe_shards = 0
+        if 0 < probe_shards < len(shards) and os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+            self.probe_shards = probe_shards
+
+    def shard(self, i: int):
+        if self._indexes[i] is None:
+            with self._lock:
+                if self._indexes[i] is None:
+                    self._indexes[i] = read_index(self.shard_dir, self.names[i], self.index_type, **self.read_options)
+        return self._indexes[i]
+
+    def shards(self) -> list:
+        """Tous les shards (chargés si besoin), p. ex. pour préchauffer."""
+        return [self.shard(i) for i in range(len(self.names))]
+
+    def loaded(self) -> int:
+        """Nombre de shards lus jusqu'ici."""
+        return sum(index is not None for index in self._indexes)
+
+    def route(self, queries: np.ndarray) -> list[np.ndarray] | None:
+        """Par shard, les lignes de queries qui y sont routées ; None = tous les shards pour toutes."""
+        if self.centroids is None:
+            return None
+        nearest = np.argpartition(-(queries @ self.centroids.T), self.probe_shards - 1, axis=1)[:, :self.probe_shards]
+        return [np.flatnonzero((nearest == i).any(axis=1)) for i in range(len(self.names))]
+
+    def search(self, queries: np.ndarray, k: int, params=None) -> tuple[np.ndarray, np.ndarray]:
+        all_scores = []
+        all_positions = []
+        routes = self.route(queries)
+
+        for i, (start, end) in enumerate(zip(self.offsets[:-1], self.offsets[1:])):
+            rows = None if routes is None else routes[i]
+            if rows is not None and not len(rows):
+                continue
+            shard_params, selector = None, None
+            if params is not None:
+                # Restreint à des positions (subset_params) : celles de ce shard, en local
+                local = params[(params >= start) & (params < end)] - start
+                if not len(local):
+                    continue
+                shard_params, selector = subset_params(self.shard(i), local)
+            if end == start:
+                continue
+
+            shard_k = int(min(k, end - start))
+            scores, positions = self.shard(i).search(queries if rows is None else queries[rows], shard_k,
+                                                     params=shard_params)
+            positions = np.where(positions >= 0, positions + start, -1)
+            if rows is not None:
+                # Lignes non routées vers ce shard : résultats vides (-inf, -1)
+                block_scores = np.full((len(queries), shard_k), -np.inf, dtype="float32")
+                block_positions = np.full((len(queries), shard_k), -1, dtype=np.int64)
+                block_scores[rows], block_positions[rows] = scores, positions
+                scores, positions = block_scores, block_positions
+            all_scores.append(scores)
+            all_positions.append(positions)
+
+        # Comme FAISS, toujours k colonnes : les shards routés peuvent en compter moins que k (-inf, -1)
+        all_scores.append(np.full((len(queries), k), -np.inf, dtype="float32"))
+        all_positions.append(np.full((len(queries), k), -1, dtype=np.int64))
+        scores = np.concatenate(all_scores, axis=1)
+        positions = np.concatenate(all_positions, axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(positions, order, axis=1)
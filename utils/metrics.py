@@ -0,0 +1,157 @@
+"""
+Métriques au format texte Prometheus, pour /metrics.
+
+Histogrammes alimentés par les hooks de timing.py (durée par étape, taille
+des batches, attente en file) et par api.py (durée des requêtes, candidats
+par catégorie), plus les compteurs des caches et du reranker lus au moment
+de l'export. Sans dépendance : quelques histogrammes et compteurs suffisent.
+"""
+
+import bisect
+import threading
+
+import numpy as np
+
+from .rerank_with_crossencoder import token_stats
+from .timing import StageTimer
+
+# Bornes des histogrammes (secondes, puis nombres)
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 30, 50, 100)
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple = SECONDS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # valeurs des labels → [comptes par borne (non cumulés) + +Inf, somme]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {values: ([*counts], total) for values, (counts, total) in self._series.items()}
+        for values, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        lines += [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in sorted(values.items())]
+        return lines
+
+
+def _sampled(name: str, kind: str, help_text: str, samples: list[tuple[str, float]]) -> list[str]:
+    """Métrique lue au moment de l'export : [(labels déjà formatés, valeur)]."""
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + [f"{name}{labels} {value}" for labels, value in samples]
+
+
+class Metrics:
+    """Métriques du service ; timer est à mettre dans les settings et les MicroBatcher."""
+
+    def __init__(self):
+        self.request_seconds = Histogram(
+            "traverse_request_seconds", "Durée des requêtes, attente comprise", ("endpoint",))
+        self.rejected = Counter(
+            "traverse_rejected_total", "Requêtes refusées (saturation, délai dépassé)", ("endpoint", "reason"))
+        self.stage_seconds = Histogram(
+            "traverse_stage_seconds", "Durée de chaque passage dans une étape (par batch)", ("stage",))
+        self.queue_seconds = Histogram(
+            "traverse_queue_seconds", "Attente en file avant chaque étage du pipeline", ("batcher",))
+        self.batch_size = Histogram(
+            "traverse_batch_size", "Items par micro-batch", ("batcher",), SIZE_BUCKETS)
+        self.candidates = Histogram(
+            "traverse_candidates", "Candidats par requête et par catégorie", ("phase", "category"), COUNT_BUCKETS)
+        self.timer = StageTimer(on_record=self._on_record, on_batch=self._on_batch)
+
+    def _on_record(self, stage: str, seconds: float):
+        self.stage_seconds.observe(seconds, stage)
+
+    def _on_batch(self, batcher: str, size: int, waits: list[float]):
+        self.batch_size.observe(size, batcher)
+        for wait in waits:
+            self.queue_seconds.observe(wait, batcher)
+
+    def observe_candidates(self, phase: str, store, ids_per_query: list[np.ndarray]):
+        """Candidats par catégorie de chaque requête (zéro compris), sortie de search_ids_batch ou du rerank."""
+        for ids in ids_per_query:
+            counts = np.bincount(store.category_codes[ids], minlength=len(store.category_names))
+            for category, count in zip(store.category_names, counts):
+                self.candidates.observe(int(count), phase, category)
+
+    def render(self, search_settings: dict | None = None, rerank_settings: dict | None = None,
+               batchers: list | None = None) -> str:
+        lines = []
+        for metric in (self.request_seconds, self.rejected, self.stage_seconds, self.queue_seconds,
+                       self.batch_size, self.candidates):
+            lines += metric.render()
+
+        if batchers:
+            lines += _sampled("traverse_queue_depth", "gauge", "Items en attente par étage",
+                              [(_labels(("batcher",), (b.name,)), b.qsize()) for b in batchers])
+
+        caches = []
+        if search_settings is not None and search_settings.get("embedding_cache") is not None:
+            caches.append(("query_embeddings", search_settings["embedding_cache"].stats()))
+        if rerank_settings is not None and rerank_settings.get("score_cache") is not None:
+            caches.append(("rerank_scores", rerank_settings["score_cache"].stats()))
+        if caches:
+            labels = [(_labels(("cache",), (name,)), stats) for name, stats in caches]
+            # Le cache de scores distingue mémoire et disque
+            lines += _sampled("traverse_cache_hits_total", "counter", "Succès des caches", [
+                (label, stats.get("hits", stats.get("memory_hits", 0) + stats.get("disk_hits", 0)))
+                for label, stats in labels
+            ])
+            lines += _sampled("traverse_cache_misses_total", "counter", "Échecs des caches",
+                              [(label, stats["misses"]) for label, stats in labels])
+            lines += _sampled("traverse_cache_hit_ratio", "gauge", "Taux de succès des caches",
+                              [(label, stats["hit_rate"]) for label, stats in labels])
+
+        if rerank_settings is not None and rerank_settings.get("stats") is not None:
+            stats = token_stats(rerank_settings)
+            lines += _sampled("traverse_rerank_batches_total", "counter", "Batches envoyés au reranker",
+                              [("", stats["batches"])])
+            lines += _sampled("traverse_rerank_tokens_total", "counter", "Tokens envoyés au reranker",
+                              [('{kind="real"}', stats["real_tokens"]), ('{kind="padded"}', stats["padded_tokens"])])
+            lines += _sampled("traverse_rerank_padding_ratio", "gauge", "Part de padding dans les tokens envoyés",
+                              [("", 1 - stats["real_tokens"] / stats["padded_tokens"] if stats["padded_tokens"] else 0.0)])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,251 @@
+"""
+Regroupement des requêtes concurrentes en micro-batches.
+
+Les requêtes qui arrivent dans une courte fenêtre (window_ms) sont traitées
+ensemble par un seul appel à process_batch, jusqu'à max_batch_size requêtes
+(ou, avec item_size, jusqu'à max_batch_size en cumulant la taille des items).
+
+La file est bornée (max_queue_size) : au-delà, submit lève QueueFull plutôt
+que de laisser la latence croître sans limite. Une requête dont l'échéance
+est passée avant son traitement est abandonnée (DeadlineExceeded).
+
+BatchPipeline enchaîne plusieurs MicroBatcher, chacun sur son propre thread
+(p. ex. encodage + FAISS sur CPU, puis rerank sur GPU) : l'étage suivant
+traite un batch pendant que le précédent prépare le sien.
+
+call(fn) exécute fn sur le thread d'un MicroBatcher, entre deux batches
+(p. ex. démarrer et arrêter torch.profiler, qui n'observe que son thread).
+
+Avec un timer (timing.StageTimer), chaque batch est signalé (taille, attente
+en file) et, pour les items soumis avec un dict trace, la répartition du
+batch y est notée sous le nom du MicroBatcher.
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from contextlib import nullcontext
+from typing import Any, Callable
+
+from .timing import StageTimer
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+_CALL = object()  # Réveille le worker pour exécuter les call() en attente
+
+
+class QueueFull(Exception):
+    """File d'attente pleine : la requête est refusée tout de suite."""
+
+
+class DeadlineExceeded(Exception):
+    """Échéance de la requête passée avant son traitement."""
+
+
+class MicroBatcher:
+    """
+    Worker unique qui collecte les requêtes et appelle process_batch(items),
+    qui doit retourner un résultat par item, dans le même ordre.
+    """
+
+    def __init__(self, process_batch: Callable[[list], list], window_ms: float = 5.0, max_batch_size: int = 32,
+                 max_queue_size: int = 0, name: str = "micro-batcher", timer: StageTimer | None = None,
+                 item_size: Callable[[Any], int] | None = None):
+        """
+        max_queue_size : requêtes en attente au plus (0 = sans limite).
+        item_size : taille d'un item (p. ex. len pour une liste de requêtes) ; un batch
+        cumule alors au plus max_batch_size, sauf un premier item plus gros, traité seul.
+        """
+        self.process_batch = process_batch
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.name = name
+        self.timer = timer
+        self.item_size = item_size or (lambda item: 1)
+        self._queue = queue.Queue(max_queue_size)
+        self._pending = None  # Item qui ne tenait plus dans le batch précédent
+        self._calls = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, item, deadline: float | None = None, block: bool = False, trace: dict | None = None) -> Future:
+        """
+        Ajoute un item à la file. Le Future reçoit le résultat de cet item.
+
+        Args:
+            deadline: échéance (time.monotonic()) au-delà de laquelle l'item n'est plus traité
+            block: file pleine, attendre une place au lieu de lever QueueFull
+            trace: reçoit sous self.name l'attente, la taille et la répartition du batch (avec un timer)
+        """
+        future = Future()
+        try:
+            self._queue.put((item, future, deadline, time.monotonic(), trace), block=block)
+        except queue.Full:
+            raise QueueFull(f"{self._queue.maxsize} requêtes en attente") from None
+        return future
+
+    def call(self, fn: Callable[[], Any]) -> Future:
+        """Exécute fn sur le thread du worker, après le batch en cours ; le Future reçoit son résultat."""
+        future = Future()
+        self._calls.put((fn, future))
+        try:
+            self._queue.put_nowait(_CALL)
+        except queue.Full:
+            pass  # File pleine : le worker est occupé et passera par _run_calls après ce batch
+        return future
+
+    def _run_calls(self):
+        while True:
+            try:
+                fn, future = self._calls.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+
+    def _collect(self) -> tuple[list, bool]:
+        """Bloque jusqu'au premier item puis collecte pendant window_ms, et ce qui attend déjà."""
+        first, self._pending = self._pending or self._queue.get(), None
+        if first is _STOP:
+            return [], True
+        if first is _CALL:
+            return [], False
+
+        batch = [first]
+        size = self.item_size(first[0])
+        deadline = time.monotonic() + self.window_ms / 1000
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                # Fenêtre écoulée : on prend encore ce qui attend déjà
+                entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                return batch, True
+            if entry is _CALL:
+                continue
+            entry_size = self.item_size(entry[0])
+            if size + entry_size > self.max_batch_size:
+                self._pending = entry  # Ouvre le batch suivant
+                break
+            batch.append(entry)
+            size += entry_size
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            self._run_calls()
+            batch, stopping = self._collect()
+            now = time.monotonic()
+            live = []
+            for item, future, deadline, enqueued, trace in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if deadline is not None and deadline <= now:
+                    future.set_exception(DeadlineExceeded())
+                    continue
+                live.append((item, future, now - enqueued, trace))
+            batch = live
+            if not batch:
+                continue
+            if self.timer is not None:
+                self.timer.record_batch(self.name, len(batch), [wait for _, _, wait, _ in batch])
+
+            try:
+                with self.timer.collect() if self.timer is not None else nullcontext({}) as breakdown:
+                    results = self.process_batch([item for item, _, _, _ in batch])
+            except Exception as e:
+                logger.exception("Échec du micro-batch (%d requêtes)", len(batch))
+                for _, future, _, _ in batch:
+                    future.set_exception(e)
+                continue
+            elapsed = time.monotonic() - now
+
+            for (_, future, wait, trace), result in zip(batch, results):
+                if trace is not None and self.timer is not None:
+                    trace[self.name] = {"queue": wait, "batch_size": len(batch), "batch": elapsed, **breakdown}
+                future.set_result(result)
+        self._run_calls()
+
+
+class BatchPipeline:
+    """
+    Étages de micro-batching enchaînés : le résultat d'un item à l'étage i
+    est soumis à l'étage i + 1, avec la même échéance.
+
+    Seul le premier étage refuse les requêtes (QueueFull, sauf avec block=True) ;
+    les suivants bloquent quand leur file est pleine, ce qui ralentit l'étage précédent
+    et remplit sa file : la saturation remonte jusqu'à l'entrée.
+    """
+
+    def __init__(self, stages: list[MicroBatcher]):
+        self.stages = stages
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def submit(self, item, deadline: float | None = None, block: bool = False, trace: dict | None = None) -> Future:
+        """Comme MicroBatcher.submit ; le Future reçoit le résultat du dernier étage."""
+        return self.submit_stages(item, deadline, block, trace)[-1]
+
+    def submit_stages(self, item, deadline: float | None = None, block: bool = False,
+                      trace: dict | None = None) -> list[Future]:
+        """
+        Un Future par étage, qui reçoit le résultat de l'item à cet étage
+        (résultats intermédiaires). Annuler le dernier retire l'item des
+        files des étages restants ; un batch déjà en cours va à son terme.
+        """
+        results = [Future() for _ in self.stages]
+        self._chain(self.stages[0].submit(item, deadline, block, trace), 0, deadline, results, trace)
+        return results
+
+    def _chain(self, future: Future, stage: int, deadline: float | None, results: list[Future], trace: dict | None):
+        def cancel(result: Future):
+            if result.cancelled():
+                future.cancel()  # Sans effet si l'étage a déjà pris l'item
+
+        def done(f: Future):
+            # Appelé dans le thread de l'étage qui vient de finir
+            remaining = results[stage:]
+            if results[-1].cancelled() or f.cancelled():
+                for result in remaining:
+                    result.cancel()
+            elif f.exception() is not None:
+                for result in remaining:
+                    _settle(result.set_exception, f.exception())
+            else:
+                _settle(results[stage].set_result, f.result())
+                if stage + 1 < len(self.stages):
+                    self._chain(self.stages[stage + 1].submit(f.result(), deadline, block=True, trace=trace),
+                                stage + 1, deadline, results, trace)
+
+        results[-1].add_done_callback(cancel)
+        future.add_done_callback(done)
+
+
+def _settle(setter: Callable, value):
+    try:
+        setter(value)
+    except InvalidStateError:
+        pass  # Annulé entre-temps
@@ -0,0 +1,84 @@
+"""
+Backend ONNX Runtime pour l'encodeur E5 et le reranker Qwen3.
+
+Les modèles sont produits par export-onnx.py. Ce module n'importe ni torch
+ni transformers : seulement onnxruntime, tokenizers et numpy.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+def _session(path: str, num_threads: int = 0):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def _model_path(model_dir: str, variant: str) -> str:
+    """model.int8.onnx si demandé et présent, sinon model.fp32.onnx."""
+    path = os.path.join(model_dir, f"model.{variant}.onnx")
+    return path if os.path.exists(path) else os.path.join(model_dir, "model.fp32.onnx")
+
+
+class OnnxEncoder:
+    """
+    Encodeur E5 exporté (mean pooling + normalisation inclus dans le graphe).
+    Expose la partie de SentenceTransformer.encode utilisée par search.
+    """
+
+    def __init__(self, model_dir: str, variant: str = "int8", num_threads: int = 0, max_length: int = 512):
+        from tokenizers import Tokenizer
+
+        self.session = _session(_model_path(model_dir, variant), num_threads)
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        pad_token = "<pad>"
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token), pad_token=pad_token)
+
+    def encode(self, texts: list[str], normalize_embeddings: bool = True, batch_size: int = 32, **_) -> np.ndarray:
+        embeddings = []
+        for i in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[i:i + batch_size])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            (batch,) = self.session.run(None, {"input_ids": input_ids, "attention_mask": attention_mask})
+            embeddings.append(batch)
+        # Les embeddings sortent déjà normalisés du graphe
+        return np.concatenate(embeddings)
+
+
+class OnnxReranker:
+    """
+    Reranker exporté. Selon l'export, le graphe sort directement la probabilité
+    "yes" ("scores") ou les logits de la dernière position ("logits").
+    """
+
+    def __init__(self, model_dir: str, variant: str = "int8", num_threads: int = 0):
+        from tokenizers import Tokenizer
+
+        self.session = _session(_model_path(model_dir, variant), num_threads)
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        with open(os.path.join(model_dir, "config.json"), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.output = self.session.get_outputs()[0].name
+
+    def tokenize(self, texts: list[str], max_length: int) -> list[list[int]]:
+        return [e.ids[:max_length] for e in self.tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+    def scores(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> list[float]:
+        (out,) = self.session.run(None, {"input_ids": input_ids, "attention_mask": attention_mask})
+        if self.output == "scores":
+            return out.tolist()
+
+        # Logits complets : softmax sur les seules colonnes no/yes
+        logits = out[:, [self.config["token_false_id"], self.config["token_true_id"]]].astype(np.float32)
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        return (probs[:, 1] / probs.sum(axis=1)).tolist()
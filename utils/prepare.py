@@ -2,22 +2,61 @@
 Fonctions de démarrage : chargement des données, modèles et index.
 """
 
+import functools
+import hashlib
 import json
 import os
-import faiss
-import torch
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import numpy as np
 
+from .bundle import load_bundle
+from .candidate_store import CandidateStore, ShardedTexts
+from .embedding_cache import QueryEmbeddingCache
+from .score_cache import ScoreCache
+from .snapshot import load_snapshot, write_snapshot
 from .types import Candidate
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+BUNDLE_DIR = "bundle"  # dans data_dir, produit par create-index.py (voir bundle.py)
+SNAPSHOT_DIR = "catalog"  # dans data_dir, catalogue compilé au premier chargement (voir snapshot.py)
+CATALOG_FILES = ("osm_wiki_tags_cleaned.json", "osm_wiki_tags_natural_desc.json")
 
 # Modèles
 EMBEDDING_MODEL = "intfloat/multilingual-e5-base"
 RERANKER_MODEL = "Qwen/Qwen3-Reranker-0.6B"
 #RERANKER_MODEL = "Qwen/Qwen3-Reranker-4B"
 
+# Catégories chargées dans le catalogue (create-index.py peut aussi indexer "other")
+CATEGORIES = ("poi", "attribute")
+
+# Type d'index FAISS : "flat" (exact), "sq8", "pq" ou "binary" (compressés, re-scorés),
+# construits par create-index.py --index-types
+INDEX_TYPE = os.environ.get("TRAVERSE_INDEX_TYPE", "flat")
+# Réglages des index ANN ("hnsw", "ivf") : plus haut = meilleur rappel, plus lent
+EF_SEARCH = int(os.environ.get("TRAVERSE_EF_SEARCH", "64"))
+NPROBE = int(os.environ.get("TRAVERSE_NPROBE", "16"))
+# Catalogue découpé (--shards) : shards cherchés par requête, les plus proches (0 = tous)
+PROBE_SHARDS = int(os.environ.get("TRAVERSE_PROBE_SHARDS", "0"))
+
+# Backend d'inférence : "torch" (PyTorch / transformers) ou "onnx" (ONNX Runtime,
+# modèles produits par export-onnx.py dans ONNX_DIR, variante "int8" ou "fp32").
+BACKEND = os.environ.get("TRAVERSE_BACKEND", "torch")
+ONNX_DIR = os.path.join(DATA_DIR, "onnx")
+ONNX_VARIANT = os.environ.get("TRAVERSE_ONNX_VARIANT", "int8")
+
+# Matériel (backend torch) : "cuda" si disponible, sinon CPU avec poids int8
+# (quantification dynamique), "bf16" ou "fp32".
+# TRAVERSE_NUM_THREADS limite les threads de calcul CPU (0 = défaut).
+DEVICE = os.environ.get("TRAVERSE_DEVICE")  # None = automatique
+CPU_DTYPE = os.environ.get("TRAVERSE_CPU_DTYPE", "int8")
+CPU_DTYPES = ("int8", "bf16", "fp32")
+NUM_THREADS = int(os.environ.get("TRAVERSE_NUM_THREADS", "0"))
+
+# Caches persistants des scores du reranker (data/cache/rerank_scores.sqlite) et des
+# embeddings de requêtes (data/cache/query_embeddings) ; à couper pour mesurer les
+# modèles (benchmarks, tests de charge)
+SCORE_CACHE = os.environ.get("TRAVERSE_SCORE_CACHE", "1") == "1"
+EMBEDDING_CACHE = os.environ.get("TRAVERSE_EMBEDDING_CACHE", "1") == "1"
+
 # Reranker config
 TASK_INSTRUCTION_POI = (
     "Given a French natural language query about a place or service, "
@@ -27,13 +66,25 @@ TASK_INSTRUCTION_ATTRIBUTE = (
     "Given a French natural language query, determine if the document "
     "describes a characteristic or attribute that matches what the user is looking for."
 )
+RERANK_PREFIX = '<|im_start|>system\nJudge whether the Document meets the requirements based on the Query and the Instruct provided. Note that the answer can only be "yes" or "no".<|im_end|>\n<|im_start|>user\n'
+RERANK_SUFFIX = "<|im_end|>\n<|im_start|>assistant\n<think>\n\n</think>\n\n"
+
 
+def catalog_version(data_dir: str = DATA_DIR) -> str:
+    """Empreinte des fichiers source du catalogue (change dès qu'une description change)."""
+    digest = hashlib.sha256()
+    for filename in CATALOG_FILES:
+        path = os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
 
-def load_candidates(data_dir: str = DATA_DIR) -> list[Candidate]:
+
+def parse_catalog(data_dir: str = DATA_DIR, categories: tuple[str, ...] | None = None) -> list[Candidate]:
     """
-    Charge les données et construit la liste de candidats.
-    L'ordre d'itération est identique à create-index.py pour que
-    les positions correspondent aux index FAISS.
+    Analyse les JSON source et construit la liste de candidats (toutes
+    catégories si categories est None), dans l'ordre des JSON.
     """
     with open(os.path.join(data_dir, "osm_wiki_tags_cleaned.json"), "r", encoding="utf-8") as f:
         tags_data = json.load(f)
@@ -50,7 +101,7 @@ def load_candidates(data_dir: str = DATA_DIR) -> list[Candidate]:
         for value, value_data in key_data.get("values", {}).items():
             tag = f"{key}={value}"
             category = value_data.get("category", "other")
-            if category not in ("poi", "attribute"):
+            if categories is not None and category not in categories:
                 continue
 
             description_fr = value_data.get("description_fr", "")
@@ -70,65 +121,391 @@ def load_candidates(data_dir: str = DATA_DIR) -> list[Candidate]:
     return candidates
 
 
-def load_search_settings(data_dir: str = DATA_DIR) -> dict:
-    """Charge le modèle d'embedding et les index FAISS."""
-    model = SentenceTransformer(EMBEDDING_MODEL)
+def _read_snapshot(snapshot_dir: str, sources: list[str], categories: tuple[str, ...]) -> CandidateStore | None:
+    """load_snapshot, ou None si le snapshot est remplacé pendant la lecture (un autre worker recompile)."""
+    try:
+        return load_snapshot(snapshot_dir, sources, categories)
+    except (OSError, ValueError) as e:
+        print(f"Snapshot {snapshot_dir} illisible : {e}")
+        return None
+
+
+def catalog_store(data_dir: str = DATA_DIR, categories: tuple[str, ...] = CATEGORIES) -> CandidateStore:
+    """
+    Catalogue en colonnes depuis le snapshot binaire en mmap ; absent ou
+    obsolète, il est recompilé depuis les JSON (voir snapshot.py).
+    """
+    snapshot_dir = os.path.join(data_dir, SNAPSHOT_DIR)
+    sources = [os.path.join(data_dir, filename) for filename in CATALOG_FILES]
+    store = _read_snapshot(snapshot_dir, sources, categories)
+    if store is not None:
+        return store
+
+    candidates = parse_catalog(data_dir)
+    try:
+        write_snapshot(snapshot_dir, candidates, sources)
+    except OSError as e:
+        # Dossier de données en lecture seule : on reste sur les JSON
+        print(f"Snapshot {snapshot_dir} non écrit : {e}")
+    else:
+        store = _read_snapshot(snapshot_dir, sources, categories)
+        if store is not None:
+            return store
+    return CandidateStore.from_candidates([c for c in candidates if c.category in categories])
+
+
+def load_candidates(data_dir: str = DATA_DIR, categories: tuple[str, ...] = CATEGORIES) -> list[Candidate]:
+    """
+    Liste de candidats, lue dans le snapshot du catalogue.
+    L'ordre d'itération est identique à create-index.py pour que
+    les positions correspondent aux index FAISS.
+    """
+    store = catalog_store(data_dir, categories)
+    return [store[i] for i in range(len(store))]
+
+
+@functools.cache
+def _combined_listing(data_dir: str) -> dict | None:
+    """
+    catalog_list.json (create-index.py --combined ou --shards) s'il a été produit
+    pour le catalogue et le modèle actuels ; None s'il est absent ou obsolète
+    (on retombe alors sur le bundle ou les index par catégorie).
+    """
+    listing_path = os.path.join(data_dir, "catalog_list.json")
+    if not os.path.exists(listing_path):
+        return None
+    with open(listing_path, "r", encoding="utf-8") as f:
+        listing = json.load(f)
+    if listing.get("catalog_version") != catalog_version(data_dir) or listing.get("model") != EMBEDDING_MODEL:
+        print(f"{listing_path} obsolète (catalogue ou modèle changé), ignoré : relancer create-index.py --combined")
+        return None
+    return listing
+
+
+def combined_categories(listing: dict) -> list[str]:
+    """Catégories de l'index combiné, dans l'ordre de catalog_list.json."""
+    return list(dict.fromkeys(listing["categories"]))
+
+
+@functools.cache
+def _bundle(data_dir: str) -> dict | None:
+    """
+    Bundle en mmap s'il est à jour (ouvert une fois par processus). Remplacé
+    pendant la lecture (create-index.py en cours) : pas de bundle, le
+    catalogue vient du snapshot.
+    """
+    bundle_dir = os.path.join(data_dir, BUNDLE_DIR)
+    try:
+        return load_bundle(bundle_dir, EMBEDDING_MODEL, catalog_version(data_dir))
+    except (OSError, ValueError) as e:
+        print(f"Bundle {bundle_dir} illisible : {e}")
+        return None
+
+
+def load_catalog(data_dir: str = DATA_DIR) -> CandidateStore:
+    """
+    Catalogue en colonnes. Pour un catalogue découpé (create-index.py --shards),
+    construit depuis catalog_list.json, dans l'ordre de l'index, les descriptions
+    naturelles n'étant lues que par shard, au premier accès. Sinon depuis le
+    bundle en mmap s'il est à jour, et à défaut depuis le snapshot du catalogue.
+    """
+    listing = _combined_listing(data_dir)
+    if listing is not None:
+        if "shards" in listing:
+            return CandidateStore(
+                tags=listing["tags"],
+                descriptions_fr=listing["descriptions_fr"],
+                descriptions_natural=ShardedTexts(
+                    os.path.join(data_dir, "shards"),
+                    [shard["name"] for shard in listing["shards"]],
+                    [shard["size"] for shard in listing["shards"]],
+                ),
+                categories=listing["categories"],
+                usage_count=listing["usage_count"],
+            )
+    bundle = _bundle(data_dir)
+    if bundle is not None:
+        return bundle["candidates"]
+    # Catégories de l'index combiné (p. ex. "other"), sinon celles par défaut
+    return catalog_store(data_dir, tuple(combined_categories(listing)) if listing is not None else CATEGORIES)
+
+
+def resolve_device(device: str | None = DEVICE) -> str:
+    if device:
+        return device
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def configure_threads(num_threads: int = NUM_THREADS, backend: str = BACKEND):
+    """Fixe le nombre de threads PyTorch (calcul CPU de l'encodeur et du reranker)."""
+    if num_threads > 0 and backend == "torch":
+        import torch
+        torch.set_num_threads(num_threads)
+
+
+def load_embedding_model(device: str | None = DEVICE, backend: str = BACKEND):
+    """SentenceTransformer, ou OnnxEncoder (même méthode encode) avec le backend onnx."""
+    if backend == "onnx":
+        from .onnx_backend import OnnxEncoder
+        return OnnxEncoder(os.path.join(ONNX_DIR, "e5"), ONNX_VARIANT, NUM_THREADS)
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL, device=resolve_device(device))
+
+
+def load_combined_index(data_dir: str, candidates: CandidateStore, listing: dict, index_type: str = INDEX_TYPE) -> dict:
+    """
+    Index unique produit par create-index.py --combined (listing : catalog_list.json).
+    ids : position dans l'index → id dans le catalogue (-1 si le tag n'y est pas chargé).
+    params : par catégorie, paramètres de recherche restreints à ses vecteurs
+    (utilisés quand la recherche sur-dimensionnée ne remplit pas le quota).
+    """
+    from .faiss_index import ShardedIndex, read_index, subset_params
+
+    if "shards" in listing:
+        # Catalogue découpé par préfixe de clé (create-index.py --shards) : requêtes routées
+        # vers PROBE_SHARDS shards, lus au premier search qui les vise
+        index = ShardedIndex(os.path.join(data_dir, "shards"), listing["shards"], listing["dim"], index_type,
+                             probe_shards=PROBE_SHARDS, ef_search=EF_SEARCH, nprobe=NPROBE)
+    else:
+        index = read_index(data_dir, "catalog", index_type, ef_search=EF_SEARCH, nprobe=NPROBE)
+
+    tag_ids = {tag: i for i, tag in enumerate(candidates.tags)}
+    ids = np.array([tag_ids.get(tag, -1) for tag in listing["tags"]], dtype=np.int64)
+    index_categories = np.array(listing["categories"])
 
-    poi_index = faiss.read_index(os.path.join(data_dir, "poi.index"))
-    attr_index = faiss.read_index(os.path.join(data_dir, "attributes.index"))
+    positions = {}
+    params = {}
+    for category in combined_categories(listing):
+        positions[category] = np.flatnonzero(index_categories == category).astype(np.int64)
+        params[category] = subset_params(index, positions[category])
 
     return {
-        "model": model,
+        "index": index,
+        "ids": ids,
+        "positions": positions,
+        "params": params,
+        # Taille de la recherche unique : overfetch × quotas cumulés
+        "overfetch": 2,
+    }
+
+
+def load_bundle_index(bundle: dict) -> dict:
+    """
+    Recherche exacte sur les embeddings du bundle en mmap (mémoire partagée entre
+    workers), même forme que load_combined_index ; ids = positions du catalogue.
+    """
+    from .faiss_index import MappedFlatIndex, subset_params
+
+    store = bundle["candidates"]
+    index = MappedFlatIndex(bundle["embeddings"])
+    positions = {name: store.ids(name).astype(np.int64) for name in store.category_names}
+    return {
+        "index": index,
+        "ids": np.arange(index.ntotal, dtype=np.int64),
+        "positions": positions,
+        "params": {name: subset_params(index, p) for name, p in positions.items()},
+        "overfetch": 2,
+    }
+
+
+def load_indexes(data_dir: str = DATA_DIR, candidates: CandidateStore | None = None,
+                 index_type: str = INDEX_TYPE) -> dict:
+    """
+    Index de recherche d'un type donné : {"combined_index", "categories"} si l'index
+    combiné existe et est à jour (catégories lues dans son catalog_list.json),
+    ou (type flat) si le bundle est à jour et porte le catalogue utilisé, sinon
+    {"indexes"} avec un index par catégorie.
+    """
+    # Import ici : faiss n'est chargé qu'au chargement des index
+    from .faiss_index import read_index
+
+    listing = _combined_listing(data_dir)
+    if listing is not None:
+        if candidates is None:
+            candidates = load_catalog(data_dir)
+        return {
+            "combined_index": load_combined_index(data_dir, candidates, listing, index_type),
+            "categories": combined_categories(listing),
+        }
+
+    bundle = _bundle(data_dir) if index_type == "flat" else None
+    if bundle is not None and (candidates is None or candidates is bundle["candidates"]):
+        return {
+            "combined_index": load_bundle_index(bundle),
+            "categories": list(bundle["candidates"].category_names),
+        }
+    return {
         "indexes": [
-            {"index": poi_index, "category": "poi"},
-            {"index": attr_index, "category": "attribute"},
+            {"index": read_index(data_dir, "poi", index_type, ef_search=EF_SEARCH, nprobe=NPROBE), "category": "poi"},
+            {"index": read_index(data_dir, "attributes", index_type, ef_search=EF_SEARCH, nprobe=NPROBE),
+             "category": "attribute"},
         ],
+    }
+
+
+def index_dim(settings: dict) -> int:
+    """Dimension des vecteurs des index chargés."""
+    if "combined_index" in settings:
+        return settings["combined_index"]["index"].d
+    return settings["indexes"][0]["index"].d
+
+
+def load_search_settings(data_dir: str = DATA_DIR, device: str | None = DEVICE, backend: str = BACKEND,
+                         candidates: CandidateStore | None = None, index_type: str = INDEX_TYPE,
+                         embedding_cache: bool = EMBEDDING_CACHE) -> dict:
+    """
+    Charge le modèle d'embedding, les index FAISS et le cache d'embeddings de requêtes (si embedding_cache).
+    Utilise l'index combiné (catalog) s'il existe, sinon un index par catégorie,
+    du type index_type.
+    """
+    model = load_embedding_model(device, backend)
+
+    settings = {
+        "model": model,
         "top_k_per_index": 30,
         "top_k_total": 50,
         "min_score": 0.0,
+        # StageTimer (timing.py) : durées par étape, None = pas de mesure
+        "timer": None,
+        # Profiler (profiling.py) : capture à la demande, None = jamais
+        "profiler": None,
     }
 
+    settings.update(load_indexes(data_dir, candidates, index_type))
+
+    settings["embedding_cache"] = QueryEmbeddingCache(
+        EMBEDDING_MODEL,
+        dim=index_dim(settings),
+        capacity=10_000,
+        path=os.path.join(data_dir, "cache", "query_embeddings"),
+    ) if embedding_cache else None
+    return settings
+
+
+def _load_torch_reranker(device: str, cpu_dtype: str) -> dict:
+    """
+    Sur GPU : float16. Sur CPU, selon cpu_dtype : "int8" (couches linéaires du
+    décodeur quantifiées dynamiquement, calcul en float32), "bf16" ou "fp32".
+    """
+    if cpu_dtype not in CPU_DTYPES:
+        raise ValueError(f"Précision CPU inconnue : {cpu_dtype} (attendu : {', '.join(CPU_DTYPES)})")
+
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    if device.startswith("cuda"):
+        precision = "fp16"
+        dtype = torch.float16
+    else:
+        precision = cpu_dtype
+        dtype = torch.bfloat16 if cpu_dtype == "bf16" else torch.float32
 
-def load_rerank_settings() -> dict:
-    """Charge le modèle de reranking et prépare les tokens."""
     tokenizer = AutoTokenizer.from_pretrained(RERANKER_MODEL, padding_side='left')
     model = AutoModelForCausalLM.from_pretrained(
         RERANKER_MODEL,
-        torch_dtype=torch.float16,
-    ).cuda().eval()
+        torch_dtype=dtype,
+    ).to(device).eval()
+
+    # Lignes "no"/"yes" de la tête LM (liée ou non aux embeddings selon le checkpoint) :
+    # le reranker ne calcule que ces deux logits à la dernière position
+    token_true_id = tokenizer.convert_tokens_to_ids("yes")
+    token_false_id = tokenizer.convert_tokens_to_ids("no")
+    score_head = model.get_output_embeddings().weight[[token_false_id, token_true_id]].detach().clone()
 
-    prefix = '<|im_start|>system\nJudge whether the Document meets the requirements based on the Query and the Instruct provided. Note that the answer can only be "yes" or "no".<|im_end|>\n<|im_start|>user\n'
-    suffix = "<|im_end|>\n<|im_start|>assistant\n<think>\n\n</think>\n\n"
+    if precision == "int8":
+        # Après l'extraction de score_head : la tête LM n'est jamais appelée
+        torch.ao.quantization.quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
 
     return {
+        "backend": "torch",
         "model": model,
         "tokenizer": tokenizer,
-        "token_true_id": tokenizer.convert_tokens_to_ids("yes"),
-        "token_false_id": tokenizer.convert_tokens_to_ids("no"),
-        "prefix_tokens": tokenizer.encode(prefix, add_special_tokens=False),
-        "suffix_tokens": tokenizer.encode(suffix, add_special_tokens=False),
+        "token_true_id": token_true_id,
+        "token_false_id": token_false_id,
+        "score_head": score_head,
+        "prefix_tokens": tokenizer.encode(RERANK_PREFIX, add_special_tokens=False),
+        "suffix_tokens": tokenizer.encode(RERANK_SUFFIX, add_special_tokens=False),
+        "precision": precision,
+    }
+
+
+def _load_onnx_reranker() -> dict:
+    """Reranker exporté par export-onnx.py (tokens du prompt enregistrés à l'export)."""
+    from .onnx_backend import OnnxReranker
+
+    model = OnnxReranker(os.path.join(ONNX_DIR, "reranker"), ONNX_VARIANT, NUM_THREADS)
+    return {
+        "backend": "onnx",
+        "model": model,
+        "token_true_id": model.config["token_true_id"],
+        "token_false_id": model.config["token_false_id"],
+        "prefix_tokens": model.config["prefix_tokens"],
+        "suffix_tokens": model.config["suffix_tokens"],
+        "precision": f"onnx-{ONNX_VARIANT}",
+        # Pas de cache KV ni de packing dans le graphe exporté
+        "prefix_cache": False,
+        "packing": False,
+    }
+
+
+def load_rerank_settings(data_dir: str = DATA_DIR, device: str | None = DEVICE, cpu_dtype: str = CPU_DTYPE,
+                         backend: str = BACKEND, score_cache: bool = SCORE_CACHE) -> dict:
+    """Charge le modèle de reranking, prépare les tokens et ouvre le cache de scores (si score_cache)."""
+    if backend == "onnx":
+        model_settings = _load_onnx_reranker()
+    else:
+        model_settings = _load_torch_reranker(resolve_device(device), cpu_dtype)
+    precision = model_settings["precision"]
+
+    return {
         "max_length": 8192,
         "task_instructions": {
             "poi": TASK_INSTRUCTION_POI,
             "attribute": TASK_INSTRUCTION_ATTRIBUTE,
+            # Tags hors POI / attributs, présents seulement s'ils sont indexés (create-index.py --categories)
+            "other": TASK_INSTRUCTION_POI,
         },
         "top_k": 5,
-        "batch_size": 10,
         "usage_count_threshold": 10_000,
+        # Batches triés par longueur, remplis jusqu'à max_batch_tokens (batch_size = nb max de lignes)
+        "batch_size": 64,
+        "max_batch_tokens": 4096,
+        # Cache KV du préfixe partagé (système + instruction + requête)
+        "prefix_cache": True,
+        # Séquences concaténées sans padding (flash-attention uniquement, sans prefix_cache)
+        "packing": False,
+        # Compteurs de tokens réels / paddés, voir padding_efficiency()
+        "stats": {"batches": 0, "real_tokens": 0, "padded_tokens": 0},
+        # StageTimer (timing.py) : durées par étape, None = pas de mesure
+        "timer": None,
+        # Profiler (profiling.py) : capture à la demande, None = jamais
+        "profiler": None,
+        # Scores déjà calculés, par (requête normalisée, tag, instruction, modèle + précision + catalogue)
+        "score_cache": ScoreCache(
+            os.path.join(data_dir, "cache", "rerank_scores.sqlite"),
+            version=f"{RERANKER_MODEL}:{precision}:{catalog_version(data_dir)}",
+            memory_size=100_000,
+            disk_size=5_000_000,
+        ) if score_cache else None,
+        **model_settings,
     }
 
 
-def prepare(data_dir: str = DATA_DIR) -> tuple[list[Candidate], dict, dict]:
+def prepare(data_dir: str = DATA_DIR) -> tuple[CandidateStore, dict, dict]:
     """
     Fonction de démarrage complète.
-    Retourne (candidates, search_settings, rerank_settings).
+    Retourne (candidates, search_settings, rerank_settings), candidates étant
+    le catalogue en colonnes (itérable comme une liste de Candidate).
     """
-    candidates = load_candidates(data_dir)
-    search_settings = load_search_settings(data_dir)
-    rerank_settings = load_rerank_settings()
+    configure_threads()
+    candidates = load_catalog(data_dir)
+    search_settings = load_search_settings(data_dir, candidates=candidates)
+    rerank_settings = load_rerank_settings(data_dir)
 
-    print(f"POI: {sum(1 for c in candidates if c.category == 'poi')} tags")
-    print(f"Attributes: {sum(1 for c in candidates if c.category == 'attribute')} tags")
+    print(f"POI: {len(candidates.ids('poi'))} tags")
+    print(f"Attributes: {len(candidates.ids('attribute'))} tags")
     print("Prêt.\n")
 
     return candidates, search_settings, rerank_settings
@@ -0,0 +1,180 @@
+"""
+Capture de profil à la demande sur un service en production.
+
+Un Profiler est partagé via settings["profiler"] ; inactif, il ne coûte
+qu'un test dans stage() (timing.py). Une capture à la fois :
+- sur GPU, torch.profiler (CPU + CUDA, shapes des entrées de chaque op,
+  piles Python), exporté tel quel en trace Chrome. Il n'enregistre les ops
+  CPU que du thread qui l'a démarré : il est démarré et arrêté sur le thread
+  de l'étage GPU du pipeline (run_on, MicroBatcher.call). Les kernels CUDA de
+  tous les threads y figurent ; les étapes de tous les threads sont aussi
+  notées dans une trace à part (-stages.json)
+- sinon, cProfile (depuis Python 3.12, il observe tous les threads, donc
+  les étages du pipeline) enregistré en .pstats, plus une trace Chrome des
+  étapes (encode, faiss, tokenize, forward...) avec leurs détails (shape
+  des batches du reranker)
+
+Les fichiers s'ouvrent dans chrome://tracing ou https://ui.perfetto.dev,
+les .pstats avec `python -m pstats` ou snakeviz.
+"""
+
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileRunning(RuntimeError):
+    """Une capture est déjà en cours."""
+
+
+def span(settings: dict, name: str, **args):
+    """Bloc nommé dans la trace du profil en cours (nullcontext sans capture)."""
+    profiler = settings.get("profiler")
+    if profiler is None or not profiler.active:
+        return nullcontext()
+    return profiler.span(name, args)
+
+
+def _run_here(fn: Callable) -> Future:
+    future = Future()
+    future.set_result(fn())
+    return future
+
+
+class Profiler:
+    def __init__(self, out_dir: str, device: str = "cpu", run_on: Callable[[Callable], Future] | None = None):
+        """
+        device : torch.profiler sur cuda, cProfile sinon.
+        run_on(fn) : exécute fn sur le thread à profiler avec torch.profiler (Future du résultat) ;
+        par défaut le thread appelant.
+        """
+        self.out_dir = out_dir
+        self.backend = "torch" if device.startswith("cuda") else "cprofile"
+        self.run_on = run_on or _run_here
+        self.active = False
+        self.status = None  # Capture en cours ou dernière capture
+        self._lock = threading.Lock()
+        self._control = threading.Lock()  # Sérialise start / stop, qui peuvent attendre le thread profilé
+        self._profile = None
+        self._events = []
+        self._stopped = None  # (profil, événements, statut, arrêt du profil torch) en attente de save()
+
+    def start(self, max_requests: int | None = None, max_seconds: float | None = None) -> dict:
+        """
+        Démarre une capture ; l'appelant l'arrête (stop) après max_requests requêtes ou max_seconds.
+        Avec torch, attend que le thread profilé finisse son batch en cours : à lancer hors de la boucle asyncio.
+        """
+        with self._control:
+            if self.active:
+                raise ProfileRunning(f"Capture {self.status['name']} en cours")
+            events = []
+            if self.backend == "torch":
+                from torch.profiler import ProfilerActivity, profile
+                profiler = profile(
+                    activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA], record_shapes=True, with_stack=True,
+                )
+                self.run_on(profiler.start).result()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            with self._lock:
+                self._profile = profiler
+                self._events = events
+                self.status = {
+                    "name": time.strftime("profile-%Y%m%d-%H%M%S"), "backend": self.backend,
+                    "started": time.time(), "max_requests": max_requests, "max_seconds": max_seconds,
+                    "requests": 0, "running": True, "files": [],
+                }
+                self.active = True
+                logger.info("Profil %s démarré (%s)", self.status["name"], self.backend)
+                return dict(self.status)
+
+    def request_done(self) -> bool:
+        """Compte une requête ; True quand max_requests est atteint."""
+        with self._lock:
+            if not self.active:
+                return False
+            self.status["requests"] += 1
+            limit = self.status["max_requests"]
+            return limit is not None and self.status["requests"] >= limit
+
+    def span(self, name: str, args: dict):
+        if self.backend == "torch":
+            return self._torch_span(name, args)
+        return self._trace_span(name, args)
+
+    @contextmanager
+    def _torch_span(self, name: str, args: dict):
+        # record_function ne compte que sur le thread profilé ; la trace des étapes, sur tous
+        from torch.profiler import record_function
+        with record_function(name, json.dumps(args) if args else None), self._trace_span(name, args):
+            yield
+
+    @contextmanager
+    def _trace_span(self, name: str, args: dict):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Format « Trace Event » : événement complet (ph X), temps en microsecondes
+            self._events.append({
+                "name": name, "ph": "X", "ts": t0 * 1e6, "dur": (time.perf_counter() - t0) * 1e6,
+                "pid": os.getpid(), "tid": threading.get_ident(), "args": args,
+            })
+
+    def stop(self) -> bool:
+        """
+        Arrête la collecte sans attendre (torch : l'arrêt est confié au thread profilé) ;
+        False si aucune capture n'était en cours. Puis save().
+        """
+        with self._control, self._lock:
+            if not self.active:
+                return False
+            self.active = False
+            stopped = None
+            if self.backend == "torch":
+                stopped = self.run_on(self._profile.stop)
+            else:
+                self._profile.disable()
+            self.status.update(running=False, duration=time.time() - self.status["started"])
+            self._stopped = (self._profile, self._events, self.status, stopped)
+            self._profile = None
+            return True
+
+    def save(self) -> list[str]:
+        """Écrit les fichiers de la dernière capture arrêtée (lent : à lancer hors de la boucle asyncio)."""
+        with self._lock:
+            if self._stopped is None:
+                return []
+            profile, events, status, stopped = self._stopped
+            self._stopped = None
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        base = os.path.join(self.out_dir, status["name"])
+        files = [base + ".json"]
+        if self.backend == "torch":
+            stopped.result()  # Le thread profilé a fini son batch et arrêté la collecte
+            profile.export_chrome_trace(files[0])
+            files.append(base + "-stages.json")
+            self._write_trace(files[1], events)
+        else:
+            self._write_trace(files[0], events)
+            profile.dump_stats(base + ".pstats")
+            files.append(base + ".pstats")
+        status["files"] = files
+        logger.info("Profil %s : %d requêtes en %.1fs → %s",
+                    status["name"], status["requests"], status["duration"], ", ".join(files))
+        return files
+
+    @staticmethod
+    def _write_trace(path: str, events: list):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
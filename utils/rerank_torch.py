@@ -0,0 +1,180 @@
+"""
+Calcul des scores du reranker avec PyTorch (backend "torch") : tokenisation,
+padding, cache KV du préfixe partagé, packing et tête yes/no.
+"""
+
+import torch
+from transformers import DynamicCache
+
+from .rerank_with_crossencoder import _count_tokens, _make_batches
+from .timing import stage
+
+
+def _tokenize_pairs(pairs: list[str], settings: dict) -> list[list[int]]:
+    """Tokenise les paires complètes : préfixe système + paire + suffixe."""
+    tokenizer = settings["tokenizer"]
+    prefix_tokens = settings["prefix_tokens"]
+    suffix_tokens = settings["suffix_tokens"]
+    max_length = settings["max_length"]
+
+    input_ids = tokenizer(
+        pairs, padding=False, truncation='longest_first',
+        return_attention_mask=False,
+        max_length=max_length - len(prefix_tokens) - len(suffix_tokens)
+    )["input_ids"]
+    return [prefix_tokens + ids + suffix_tokens for ids in input_ids]
+
+
+def _tokenize_docs(docs: list[str], prefix_length: int, settings: dict) -> list[list[int]]:
+    """Tokenise document + suffixe, pour le chemin avec cache de préfixe."""
+    tokenizer = settings["tokenizer"]
+    suffix_tokens = settings["suffix_tokens"]
+    max_length = settings["max_length"]
+
+    doc_ids = tokenizer(
+        docs, add_special_tokens=False, truncation=True,
+        max_length=max_length - prefix_length - len(suffix_tokens),
+    )["input_ids"]
+    return [ids + suffix_tokens for ids in doc_ids]
+
+
+def _process_inputs(input_ids: list[list[int]], settings: dict, padding_side: str = "left") -> dict:
+    """Padde un batch de séquences tokenisées et l'envoie sur le device du modèle."""
+    longest = max(len(ids) for ids in input_ids)
+    padded = torch.full((len(input_ids), longest), settings["tokenizer"].pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), longest), dtype=torch.long)
+    for i, ids in enumerate(input_ids):
+        span = slice(longest - len(ids), longest) if padding_side == "left" else slice(0, len(ids))
+        padded[i, span] = torch.tensor(ids)
+        attention_mask[i, span] = 1
+
+    _count_tokens(settings, real=sum(len(ids) for ids in input_ids), padded=padded.numel())
+
+    device = settings["model"].device
+    return {"input_ids": padded.to(device), "attention_mask": attention_mask.to(device)}
+
+
+def _yes_probability(last_hidden, settings: dict) -> list[float]:
+    """
+    Projette l'état caché de la dernière position uniquement sur les lignes
+    "no"/"yes" de la tête LM, sans matérialiser les logits du vocabulaire complet.
+    """
+    batch_scores = last_hidden @ settings["score_head"].T  # [:, 0] = no, [:, 1] = yes
+    batch_scores = torch.nn.functional.log_softmax(batch_scores, dim=1)
+    return batch_scores[:, 1].exp().tolist()
+
+
+@torch.no_grad()
+def _compute_scores(inputs, settings: dict) -> list[float]:
+    model = settings["model"]
+    hidden = model.model(**inputs).last_hidden_state
+    return _yes_probability(hidden[:, -1, :], settings)
+
+
+def _supports_packing(settings: dict) -> bool:
+    """Le packing sans padding nécessite l'attention à longueur variable de flash-attention."""
+    return settings["model"].config._attn_implementation == "flash_attention_2"
+
+
+@torch.no_grad()
+def _compute_scores_packed(input_ids: list[list[int]], settings: dict) -> list[float]:
+    """
+    Concatène les séquences en une seule ligne sans padding. Les position_ids
+    qui repartent de 0 délimitent les séquences pour flash-attention (varlen).
+    """
+    model = settings["model"]
+    lengths = torch.tensor([len(ids) for ids in input_ids])
+
+    flat = torch.tensor([token for ids in input_ids for token in ids], device=model.device)
+    position_ids = torch.cat([torch.arange(n) for n in lengths.tolist()]).to(model.device)
+    _count_tokens(settings, real=flat.numel(), padded=flat.numel())
+
+    hidden = model.model(input_ids=flat[None], position_ids=position_ids[None]).last_hidden_state[0]
+    ends = (lengths.cumsum(0) - 1).to(model.device)
+    return _yes_probability(hidden[ends], settings)
+
+
+@torch.no_grad()
+def _encode_shared_prefixes(shared_prefixes: list[str], settings: dict):
+    """
+    Calcule en un seul passage le cache KV de chaque préfixe partagé
+    (prompt système + instruction + requête). Padding à gauche, donc la
+    fin de chaque préfixe est alignée sur la dernière colonne.
+
+    Returns:
+        (cache KV, attention_mask des préfixes)
+    """
+    tokenizer = settings["tokenizer"]
+    prefix_tokens = settings["prefix_tokens"]
+
+    with stage(settings, "tokenize"):
+        input_ids = [prefix_tokens + tokenizer.encode(p, add_special_tokens=False) for p in shared_prefixes]
+        inputs = _process_inputs(input_ids, settings, padding_side="left")
+    with stage(settings, "forward", shape=list(inputs["input_ids"].shape), prefixes=True):
+        outputs = settings["model"].model(**inputs, use_cache=True)
+    return outputs.past_key_values, inputs["attention_mask"]
+
+
+@torch.no_grad()
+def _compute_scores_with_prefix(inputs: dict, prefix_cache, prefix_mask, prefix_rows: list[int], settings: dict) -> list[float]:
+    """
+    Score les documents d'un batch (padding à droite, les positions suivent
+    directement le préfixe) en réutilisant le cache KV de leur préfixe.
+    """
+    model = settings["model"]
+    rows = torch.tensor(prefix_rows, device=model.device)
+
+    # Le forward étend le cache en place : cache neuf avec les seules lignes du
+    # batch (index_select copie), sans copier les préfixes des autres requêtes
+    cache = DynamicCache()
+    for layer_idx, layer in enumerate(prefix_cache.layers):
+        cache.update(layer.keys.index_select(0, rows), layer.values.index_select(0, rows), layer_idx)
+
+    attention_mask = torch.cat([prefix_mask[rows], inputs["attention_mask"]], dim=1)
+    hidden = model.model(
+        input_ids=inputs["input_ids"], attention_mask=attention_mask, past_key_values=cache,
+    ).last_hidden_state
+
+    last = inputs["attention_mask"].sum(dim=1) - 1
+    return _yes_probability(hidden[torch.arange(len(prefix_rows), device=model.device), last], settings)
+
+
+def score_pairs_torch(pairs: list[tuple[str, str]], settings: dict) -> list[float]:
+    """Branche PyTorch de _score_pairs (voir sa description)."""
+    scores = [0.0] * len(pairs)
+
+    if settings.get("prefix_cache", False):
+        shared_prefixes = list(dict.fromkeys(shared for shared, _ in pairs))
+        prefix_row = {shared: row for row, shared in enumerate(shared_prefixes)}
+        prefix_cache, prefix_mask = _encode_shared_prefixes(shared_prefixes, settings)
+
+        with stage(settings, "tokenize"):
+            input_ids = _tokenize_docs([f" {doc}" for _, doc in pairs], prefix_mask.shape[1], settings)
+        # Chaque ligne attend aussi sur son préfixe : il compte dans le budget de tokens
+        prefix_length = prefix_mask.shape[1]
+        for batch in _make_batches([prefix_length + len(ids) for ids in input_ids], settings):
+            with stage(settings, "tokenize"):
+                inputs = _process_inputs([input_ids[i] for i in batch], settings, padding_side="right")
+            rows = [prefix_row[pairs[i][0]] for i in batch]
+            with stage(settings, "forward", shape=list(inputs["input_ids"].shape), prefix_cache=True):
+                batch_scores = _compute_scores_with_prefix(inputs, prefix_cache, prefix_mask, rows, settings)
+            for i, score in zip(batch, batch_scores):
+                scores[i] = score
+        return scores
+
+    with stage(settings, "tokenize"):
+        input_ids = _tokenize_pairs([f"{shared} {doc}" for shared, doc in pairs], settings)
+    packed = settings.get("packing", False) and _supports_packing(settings)
+    for batch in _make_batches([len(ids) for ids in input_ids], settings, packed=packed):
+        batch_ids = [input_ids[i] for i in batch]
+        if packed:
+            with stage(settings, "forward", sequences=len(batch_ids), packed_tokens=sum(map(len, batch_ids))):
+                batch_scores = _compute_scores_packed(batch_ids, settings)
+        else:
+            with stage(settings, "tokenize"):
+                inputs = _process_inputs(batch_ids, settings)
+            with stage(settings, "forward", shape=list(inputs["input_ids"].shape)):
+                batch_scores = _compute_scores(inputs, settings)
+        for i, score in zip(batch, batch_scores):
+            scores[i] = score
+    return scores
@@ -1,96 +1,278 @@
+"""
+Reranking avec Qwen3-Reranker : préparation des paires, batching, cache de
+scores et sélection. Le calcul PyTorch est dans rerank_torch.py, importé au
+premier score : importer ce module ne charge pas torch.
+"""
+
+import threading
 from dataclasses import replace
 
-import torch
+import numpy as np
 
+from .candidate_store import CandidateStore
+from .timing import stage
 from .types import Candidate
 
 
-def _format_pair(query: str, doc: str, task_instruction: str) -> str:
-    return f"<Instruct>: {task_instruction}\n<Query>: {query}\n<Document>: {doc}"
+def _format_shared_prefix(query: str, task_instruction: str) -> str:
+    """Partie commune à tous les candidats d'une (instruction, requête)."""
+    return f"<Instruct>: {task_instruction}\n<Query>: {query}\n<Document>:"
+
+
+# settings["stats"] est mis à jour par les threads du pipeline et lu par /metrics
+_stats_lock = threading.Lock()
+
+
+def _count_tokens(settings: dict, real: int, padded: int):
+    stats = settings.get("stats")
+    if stats is not None:
+        with _stats_lock:
+            stats["batches"] += 1
+            stats["real_tokens"] += real
+            stats["padded_tokens"] += padded
+
+
+def token_stats(settings: dict, reset: bool = False) -> dict:
+    """Copie cohérente des compteurs de settings["stats"] (batches, tokens réels / paddés)."""
+    stats = settings["stats"]
+    with _stats_lock:
+        snapshot = dict(stats)
+        if reset:
+            stats.update(batches=0, real_tokens=0, padded_tokens=0)
+    return snapshot
+
+
+def padding_efficiency(settings: dict) -> float:
+    """Part des tokens réellement utiles parmi les tokens envoyés au modèle (1.0 = aucun padding)."""
+    stats = token_stats(settings)
+    return stats["real_tokens"] / stats["padded_tokens"] if stats["padded_tokens"] else 1.0
+
+
+def _make_batches(lengths: list[int], settings: dict, packed: bool = False) -> list[list[int]]:
+    """
+    Regroupe les séquences par longueur croissante et remplit chaque batch
+    jusqu'à max_batch_tokens (lignes × plus longue séquence, ou somme des
+    longueurs en mode packing), avec au plus batch_size lignes.
+    Sans max_batch_tokens : tranches fixes de batch_size dans l'ordre d'origine.
+
+    Returns:
+        Listes d'indices dans `lengths`
+    """
+    batch_size = settings.get("batch_size", 10)
+    max_batch_tokens = settings.get("max_batch_tokens")
+
+    if max_batch_tokens is None:
+        return [list(range(i, min(i + batch_size, len(lengths)))) for i in range(0, len(lengths), batch_size)]
+
+    batches = []
+    current = []
+    current_tokens = 0
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # Trié par longueur croissante : la nouvelle séquence est la plus longue du batch
+        tokens = current_tokens + lengths[i] if packed else (len(current) + 1) * lengths[i]
+        if current and (len(current) >= batch_size or tokens > max_batch_tokens):
+            batches.append(current)
+            current = []
+            tokens = lengths[i]
+        current.append(i)
+        current_tokens = tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _candidate_doc(description_fr: str, description_natural: str) -> str:
+    return f"{description_fr}: {description_natural}" if description_fr else f"{description_natural}"
 
 
-def _process_inputs(pairs: list[str], settings: dict):
-    tokenizer = settings["tokenizer"]
+def _score_pairs_onnx(pairs: list[tuple[str, str]], settings: dict) -> list[float]:
+    """Backend ONNX Runtime : séquences complètes, padding à gauche en NumPy."""
+    model = settings["model"]
     prefix_tokens = settings["prefix_tokens"]
     suffix_tokens = settings["suffix_tokens"]
-    max_length = settings["max_length"]
-
-    inputs = tokenizer(
-        pairs, padding=False, truncation='longest_first',
-        return_attention_mask=False,
-        max_length=max_length - len(prefix_tokens) - len(suffix_tokens)
-    )
-    for i, ele in enumerate(inputs['input_ids']):
-        inputs['input_ids'][i] = prefix_tokens + ele + suffix_tokens
-    inputs = tokenizer.pad(inputs, padding=True, return_tensors="pt", max_length=max_length)
-    for key in inputs:
-        inputs[key] = inputs[key].to(settings["model"].device)
-    return inputs
-
-
-@torch.no_grad()
-def _compute_scores(inputs, settings: dict) -> list[float]:
-    model = settings["model"]
-    batch_scores = model(**inputs).logits[:, -1, :]
-    true_vector = batch_scores[:, settings["token_true_id"]]
-    false_vector = batch_scores[:, settings["token_false_id"]]
-    batch_scores = torch.stack([false_vector, true_vector], dim=1)
-    batch_scores = torch.nn.functional.log_softmax(batch_scores, dim=1)
-    return batch_scores[:, 1].exp().tolist()
+    max_length = settings["max_length"] - len(prefix_tokens) - len(suffix_tokens)
+
+    with stage(settings, "tokenize"):
+        input_ids = [
+            prefix_tokens + ids + suffix_tokens
+            for ids in model.tokenize([f"{shared} {doc}" for shared, doc in pairs], max_length)
+        ]
+
+    scores = [0.0] * len(pairs)
+    for batch in _make_batches([len(ids) for ids in input_ids], settings):
+        with stage(settings, "tokenize"):
+            longest = max(len(input_ids[i]) for i in batch)
+            padded = np.full((len(batch), longest), model.config["pad_token_id"], dtype=np.int64)
+            attention_mask = np.zeros((len(batch), longest), dtype=np.int64)
+            for row, i in enumerate(batch):
+                padded[row, longest - len(input_ids[i]):] = input_ids[i]
+                attention_mask[row, longest - len(input_ids[i]):] = 1
+            _count_tokens(settings, real=int(attention_mask.sum()), padded=padded.size)
 
+        with stage(settings, "forward", shape=list(padded.shape)):
+            batch_scores = model.scores(padded, attention_mask)
+        for i, score in zip(batch, batch_scores):
+            scores[i] = score
+    return scores
 
-def _score_candidates(query: str, candidates: list[Candidate], task_instruction: str, settings: dict) -> list[Candidate]:
-    """Score une liste de candidats avec une instruction donnée. Retourne les candidats avec score."""
-    if not candidates:
+
+def _score_pairs(pairs: list[tuple[str, str]], settings: dict) -> list[float]:
+    """
+    Score une liste de paires (préfixe partagé, document).
+
+    Les paires sont tokenisées d'un coup, regroupées en batches par longueur
+    (voir _make_batches), puis les scores sont remis dans l'ordre d'origine.
+    Avec prefix_cache, le préfixe de chaque (instruction, requête) n'est encodé
+    qu'une fois et seuls les tokens document + suffixe passent dans le modèle.
+    Sinon, avec packing et flash-attention, les séquences complètes sont
+    concaténées sans padding. Avec backend="onnx", voir _score_pairs_onnx.
+    """
+    if not pairs:
         return []
 
-    batch_size = settings.get("batch_size", 10)
+    if settings.get("backend") == "onnx":
+        return _score_pairs_onnx(pairs, settings)
 
-    pairs = []
-    for c in candidates:
-        doc = f"{c.description_fr}: {c.description_natural}" if c.description_fr else f"{c.description_natural}"
-        pairs.append(_format_pair(query, doc, task_instruction))
+    # Import ici : torch n'est chargé qu'avec le backend torch, au premier score
+    from .rerank_torch import score_pairs_torch
+    return score_pairs_torch(pairs, settings)
 
-    all_scores = []
-    for i in range(0, len(pairs), batch_size):
-        batch = pairs[i:i + batch_size]
-        inputs = _process_inputs(batch, settings)
-        scores = _compute_scores(inputs, settings)
-        all_scores.extend(scores)
 
-    return [replace(c, score=s) for c, s in zip(candidates, all_scores)]
+def _score_pairs_cached(pairs: list[tuple[str, str]], keys: list[tuple[str, str, str]], settings: dict) -> list[float]:
+    """
+    Comme _score_pairs, en passant par settings["score_cache"] s'il existe :
+    seules les paires absentes du cache vont au modèle.
+
+    Args:
+        keys: (requête, tag, instruction) de chaque paire
+    """
+    cache = settings.get("score_cache")
+    if cache is None:
+        return _score_pairs(pairs, settings)
+
+    cache_keys = [cache.key(*k) for k in keys]
+    scores = cache.get_many(cache_keys)
+    missing = [i for i, score in enumerate(scores) if score is None]
+
+    new_scores = _score_pairs([pairs[i] for i in missing], settings)
+    for i, score in zip(missing, new_scores):
+        scores[i] = score
+    cache.put_many([(cache_keys[i], score) for i, score in zip(missing, new_scores)])
+    return scores
+
+
+def _split_and_top(rows: list[int], scores: dict, usage_count, top_k: int, usage_count_threshold: int) -> list[tuple[int, float, str]]:
+    """Split popular/niche, top_k de chaque groupe. Retourne des (position, score, visibility)."""
+    by_score = sorted(rows, key=lambda i: scores[i], reverse=True)
+    popular = [i for i in by_score if usage_count[i] >= usage_count_threshold][:top_k]
+    niche = [i for i in by_score if usage_count[i] < usage_count_threshold][:top_k]
+    return [(i, scores[i], "popular") for i in popular] + [(i, scores[i], "niche") for i in niche]
+
+
+def _rerank_columns(queries: list[str], columns: list[tuple], settings: dict) -> list[list[tuple[int, float, str]]]:
+    """
+    Cœur de rerank, sur colonnes : les paires de toutes les requêtes et de
+    toutes les catégories sont scorées dans un même flux de batches.
+
+    Args:
+        columns: Par requête, (tags, docs, categories, usage_counts) de ses candidats
+
+    Returns:
+        Par requête, les (position dans ses colonnes, score, visibility) retenus, dans l'ordre de sortie
+    """
+    top_k = settings.get("top_k", 5)
+    usage_count_threshold = settings.get("usage_count_threshold", 10_000)
+    task_instructions = settings["task_instructions"]
+
+    # Une paire par candidat, avec l'instruction de sa catégorie
+    kept = [[i for i, category in enumerate(categories) if category in task_instructions] for _, _, categories, _ in columns]
+    pairs = []
+    keys = []
+    for query, (tags, docs, categories, _), rows in zip(queries, columns, kept):
+        for i in rows:
+            pairs.append((_format_shared_prefix(query, task_instructions[categories[i]]), docs[i]))
+            keys.append((query, tags[i], task_instructions[categories[i]]))
+    all_scores = _score_pairs_cached(pairs, keys, settings)
+
+    results = []
+    offset = 0
+    with stage(settings, "postprocess"):
+        for (_, _, categories, usage_count), rows in zip(columns, kept):
+            scores = dict(zip(rows, all_scores[offset:offset + len(rows)]))
+            offset += len(rows)
+            # Par catégorie, dans l'ordre des instructions (poi, attribute, puis les autres)
+            results.append([
+                entry
+                for category in task_instructions
+                for entry in _split_and_top([i for i in rows if categories[i] == category], scores, usage_count,
+                                            top_k, usage_count_threshold)
+            ])
+    return results
 
 
 def rerank(query: str, candidates: list[Candidate], settings: dict) -> list[Candidate]:
     """
-    Re-rank avec Qwen3-Reranker, par petits batches.
-    Score les POI et attributs séparément avec des instructions adaptées,
-    puis retourne top_k tags populaires + top_k tags niche.
+    Re-rank avec Qwen3-Reranker, en un seul flux de batches.
+    Score les POI et attributs avec des instructions adaptées (portées par
+    chaque paire), puis retourne par catégorie top_k tags populaires + top_k tags niche.
 
     Args:
         query: Requête en français
         candidates: Candidats scorés (sortie de search)
-        settings: {"model", "tokenizer", "token_true_id", "token_false_id",
+        settings: {"model", "tokenizer", "token_true_id", "token_false_id", "score_head",
                    "prefix_tokens", "suffix_tokens", "max_length",
-                   "task_instructions", "top_k", "batch_size", "usage_count_threshold"}
+                   "task_instructions", "top_k", "batch_size", "usage_count_threshold",
+                   "max_batch_tokens", "prefix_cache", "packing", "stats", "score_cache", "backend", "timer"}
     """
-    top_k = settings.get("top_k", 5)
-    usage_count_threshold = settings.get("usage_count_threshold", 10_000)
-    task_instructions = settings["task_instructions"]
+    return rerank_batch([query], [candidates], settings)[0]
+
 
-    # Séparer par catégorie et scorer avec l'instruction adaptée
-    poi_candidates = [c for c in candidates if c.category == "poi"]
-    attr_candidates = [c for c in candidates if c.category == "attribute"]
+def rerank_batch(queries: list[str], candidate_lists: list[list[Candidate]], settings: dict) -> list[list[Candidate]]:
+    """
+    Version batchée de rerank. Le résultat de chaque requête est identique
+    à celui de rerank().
+    """
+    columns = [
+        (
+            [c.tag for c in candidates],
+            [_candidate_doc(c.description_fr, c.description_natural) for c in candidates],
+            [c.category for c in candidates],
+            [c.usage_count for c in candidates],
+        )
+        for candidates in candidate_lists
+    ]
+    ranked = _rerank_columns(queries, columns, settings)
+    return [
+        [replace(candidates[i], score=score, visibility=visibility) for i, score, visibility in selected]
+        for candidates, selected in zip(candidate_lists, ranked)
+    ]
 
-    poi_scored = _score_candidates(query, poi_candidates, task_instructions["poi"], settings)
-    attr_scored = _score_candidates(query, attr_candidates, task_instructions["attribute"], settings)
 
-    # Split popular/niche par catégorie, top_k de chaque groupe
-    def _split_and_top(scored, top_k):
-        popular = sorted([c for c in scored if c.usage_count >= usage_count_threshold], key=lambda c: c.score, reverse=True)[:top_k]
-        niche = sorted([c for c in scored if c.usage_count < usage_count_threshold], key=lambda c: c.score, reverse=True)[:top_k]
-        popular = [replace(c, visibility="popular") for c in popular]
-        niche = [replace(c, visibility="niche") for c in niche]
-        return popular + niche
+def rerank_ids_batch(queries: list[str], hits: list[tuple], store: CandidateStore, settings: dict) -> list[tuple[np.ndarray, np.ndarray, list[str]]]:
+    """
+    Version de rerank_batch sur ids (sortie de search_ids_batch), sans créer
+    de Candidate : voir CandidateStore.materialize pour la sortie.
+
+    Returns:
+        Par requête, (ids, scores, visibilités) dans l'ordre de sortie
+    """
+    columns = []
+    for ids, _ in hits:
+        categories = store.category_codes[ids]
+        columns.append((
+            [store.tags[i] for i in ids],
+            [_candidate_doc(store.descriptions_fr[i], store.descriptions_natural[i]) for i in ids],
+            [store.category_names[code] for code in categories],
+            store.usage_count[ids],
+        ))
+    ranked = _rerank_columns(queries, columns, settings)
 
-    return _split_and_top(poi_scored, top_k) + _split_and_top(attr_scored, top_k)
+    results = []
+    for (ids, _), selected in zip(hits, ranked):
+        positions = [i for i, _, _ in selected]
+        results.append((
+            ids[positions],
+            np.array([score for _, score, _ in selected], dtype=np.float64),
+            [visibility for _, _, visibility in selected],
+        ))
+    return results
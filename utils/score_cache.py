@@ -0,0 +1,195 @@
+"""
+Cache persistant des scores du reranker.
+
+Deux niveaux : un LRU en mémoire devant une table SQLite sur disque, qui
+survit aux redémarrages et peut être partagée entre workers. Les clés
+combinent requête normalisée, tag, instruction et une version
+(modèle de reranking + catalogue) : changer de modèle ou de données
+invalide naturellement les anciennes entrées.
+
+Le fichier étant partagé, le disque ne doit jamais faire échouer un rerank :
+attente de verrou courte, et une erreur SQLite compte comme un échec de
+cache (lecture) ou une écriture sautée. En WAL avec synchronous=NORMAL, un
+commit n'attend pas de fsync (seuls les checkpoints en font) : une coupure
+de courant peut perdre les derniers scores, ce qui ne coûte qu'un recalcul. Les dates d'utilisation (éviction)
+sont mises à jour par lots, avec l'écriture suivante.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Nombre max de paramètres par requête SQL (limite historique de SQLite : 999)
+_SQL_CHUNK = 500
+
+# Attente max d'un verrou tenu par un autre worker, sur le chemin des requêtes
+_BUSY_TIMEOUT_MS = 50
+# Dates d'utilisation en attente au-delà desquelles elles sont écrites sans attendre un put_many
+_MAX_PENDING_TOUCHES = 10_000
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+class ScoreCache:
+    def __init__(self, path: str | None, version: str, memory_size: int = 100_000, disk_size: int = 5_000_000):
+        """
+        Args:
+            path: Fichier SQLite, ou None pour un cache uniquement en mémoire
+            version: Version du modèle et du catalogue, incluse dans chaque clé
+            memory_size: Nombre max d'entrées du LRU en mémoire
+            disk_size: Nombre max d'entrées sur disque (les moins récemment utilisées sont supprimées)
+        """
+        self.version = version
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_errors = 0
+        self._touched = {}  # clé → date d'utilisation, pas encore écrite
+
+        self._db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Au démarrage, on peut attendre les autres workers (timeout par défaut)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # Pas de fsync à chaque commit, qui a lieu sur le thread du reranker
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, score REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+            self._db.commit()
+            self._disk_entries = self._db.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+            self._db.execute(f"PRAGMA busy_timeout = {_BUSY_TIMEOUT_MS}")
+
+    def key(self, query: str, tag: str, task_instruction: str) -> bytes:
+        raw = "\0".join((self.version, normalize_query(query), tag, task_instruction))
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
+
+    def get_many(self, keys: list[bytes]) -> list[float | None]:
+        """Scores en cache (None pour les clés absentes), dans l'ordre de keys."""
+        with self._lock:
+            scores = [None] * len(keys)
+            not_in_memory = []
+            for i, key in enumerate(keys):
+                score = self._memory.get(key)
+                if score is None:
+                    not_in_memory.append(i)
+                else:
+                    self._memory.move_to_end(key)
+                    scores[i] = score
+            self.memory_hits += len(keys) - len(not_in_memory)
+
+            if self._db is not None and not_in_memory:
+                found = {}
+                wanted = [keys[i] for i in not_in_memory]
+                try:
+                    for start in range(0, len(wanted), _SQL_CHUNK):
+                        chunk = wanted[start:start + _SQL_CHUNK]
+                        placeholders = ",".join("?" * len(chunk))
+                        found.update(self._db.execute(f"SELECT key, score FROM scores WHERE key IN ({placeholders})", chunk))
+                except sqlite3.Error as e:
+                    # Base verrouillée par un autre worker... : les clés restantes sont des échecs
+                    self._disk_error("lecture", e)
+                now = time.time()
+                self._touched.update((key, now) for key in found)
+                if len(self._touched) > _MAX_PENDING_TOUCHES:
+                    self._write(lambda: None)
+                for i in not_in_memory:
+                    score = found.get(keys[i])
+                    if score is not None:
+                        scores[i] = score
+                        self._remember(keys[i], score)
+                self.disk_hits += len(found)
+
+            self.misses += sum(1 for s in scores if s is None)
+            return scores
+
+    def put_many(self, items: list[tuple[bytes, float]]):
+        if not items:
+            return
+        with self._lock:
+            for key, score in items:
+                self._remember(key, score)
+
+            if self._db is not None:
+                now = time.time()
+
+                def insert():
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO scores (key, score, last_used) VALUES (?, ?, ?)",
+                        [(key, score, now) for key, score in items],
+                    )
+                    # Approximation : seules des clés absentes sont insérées
+                    self._disk_entries += len(items)
+                    self._evict_disk()
+
+                self._write(insert)
+
+    def _write(self, write):
+        """Une transaction : dates d'utilisation en attente, puis write(). Appelé sous self._lock."""
+        touched, self._touched = self._touched, {}
+        try:
+            if touched:
+                self._db.executemany("UPDATE scores SET last_used = ? WHERE key = ?",
+                                     [(used, key) for key, used in touched.items()])
+            write()
+            self._db.commit()
+        except sqlite3.Error as e:
+            self._db.rollback()
+            self._disk_error("écriture", e)
+
+    def _disk_error(self, operation: str, error: sqlite3.Error):
+        self.disk_errors += 1
+        logger.warning("Cache de scores : %s sur disque ignorée (%s)", operation, error)
+
+    def _remember(self, key: bytes, score: float):
+        self._memory[key] = score
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        if self._disk_entries <= self.disk_size:
+            return
+        (count,) = self._db.execute("SELECT COUNT(*) FROM scores").fetchone()
+        if count > self.disk_size:
+            # Marge de 10% pour ne pas évincer à chaque insertion
+            excess = count - int(self.disk_size * 0.9)
+            self._db.execute(
+                "DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_used LIMIT ?)", (excess,)
+            )
+            count -= excess
+        self._disk_entries = count
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": self._disk_entries if self._db is not None else 0,
+                "disk_errors": self.disk_errors,
+            }
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._write(lambda: None)
+            self._db.close()
+            self._db = None
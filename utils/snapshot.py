@@ -0,0 +1,116 @@
+"""
+Catalogue compilé : les JSON source ne sont analysés qu'une fois, puis
+l'API, search.py, evaluate.py et les benchmarks ouvrent ce snapshot en mmap.
+
+data/catalog/
+    manifest.json                    schéma, nombre de tags, catégories, fichiers du
+                                     snapshot, et pour chaque fichier source :
+                                     taille, mtime et sha256 (null s'il est absent)
+    <colonne>.bin / .offsets.npy     même format que le bundle (bundle.py)
+    category_codes.npy
+    usage_count.npy
+
+Le snapshot contient toutes les catégories, dans l'ordre des JSON ; load_snapshot
+le restreint aux catégories demandées. Il est obsolète dès qu'un fichier source
+change (taille ou sha256 ; le sha256 n'est recalculé que si la date a changé).
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .bundle import _sha256, file_entries, missing_file, read_columns, replace_dir, write_columns
+from .candidate_store import CandidateStore
+from .types import Candidate
+
+SCHEMA_VERSION = 1
+
+
+def _source_entry(path: str) -> dict | None:
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {"bytes": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": _sha256(path)}
+
+
+def _source_unchanged(path: str, entry: dict | None) -> bool:
+    if entry is None or not os.path.exists(path):
+        return entry is None and not os.path.exists(path)
+    stat = os.stat(path)
+    if stat.st_size != entry["bytes"]:
+        return False
+    # Même taille et même date : inutile de relire le fichier
+    return stat.st_mtime_ns == entry["mtime_ns"] or _sha256(path) == entry["sha256"]
+
+
+def write_snapshot(snapshot_dir: str, candidates: list[Candidate], sources: list[str]) -> dict:
+    """
+    Écrit le snapshot dans un dossier temporaire propre au processus puis le met
+    en place ; si plusieurs workers compilent en même temps, le premier gagne.
+    L'ancien snapshot est renommé de côté avant d'être supprimé (replace_dir) :
+    un lecteur ne le voit jamais à moitié effacé (au pire absent, et il recompile).
+    """
+    tmp_dir = f"{snapshot_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    category_names = write_columns(tmp_dir, candidates)
+    manifest = {
+        "schema": SCHEMA_VERSION,
+        "count": len(candidates),
+        "category_names": category_names,
+        "sources": {os.path.basename(path): _source_entry(path) for path in sources},
+        "files": file_entries(tmp_dir),
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    replace_dir(tmp_dir, snapshot_dir)
+    return manifest
+
+
+def select_categories(store: CandidateStore, categories: tuple[str, ...]) -> CandidateStore:
+    """Sous-catalogue des catégories demandées, ids renumérotés dans l'ordre du catalogue."""
+    kept = [code for code, name in enumerate(store.category_names) if name in categories]
+    if len(kept) == len(store.category_names):
+        return store
+
+    ids = np.flatnonzero(np.isin(store.category_codes, kept))
+    recode = np.full(len(store.category_names), -1, dtype=np.int8)
+    recode[kept] = np.arange(len(kept))
+    return CandidateStore.from_columns(
+        tags=store.tags.take(ids),
+        descriptions_fr=store.descriptions_fr.take(ids),
+        descriptions_natural=store.descriptions_natural.take(ids),
+        category_names=tuple(store.category_names[code] for code in kept),
+        category_codes=recode[store.category_codes[ids]],
+        usage_count=np.asarray(store.usage_count[ids]),
+    )
+
+
+def load_snapshot(snapshot_dir: str, sources: list[str], categories: tuple[str, ...] | None = None) -> CandidateStore | None:
+    """
+    Catalogue en mmap restreint à categories (None = toutes), ou None si le
+    snapshot est absent, incomplet, d'un autre schéma ou si une source a changé.
+    """
+    manifest_path = os.path.join(snapshot_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if manifest.get("schema") != SCHEMA_VERSION:
+        return None
+    recorded = manifest["sources"]
+    if set(recorded) != {os.path.basename(path) for path in sources} or not all(
+        _source_unchanged(path, recorded[os.path.basename(path)]) for path in sources
+    ):
+        print(f"Snapshot {snapshot_dir} obsolète (catalogue source modifié), recompilation")
+        return None
+    if missing_file(snapshot_dir, manifest) is not None:
+        return None
+
+    store = read_columns(snapshot_dir, tuple(manifest["category_names"]))
+    return store if categories is None else select_categories(store, categories)
@@ -0,0 +1,39 @@
+"""
+Étages du pipeline de recherche, partagés par l'API, bulk-tag.py et le benchmark.
+
+Un item est une liste de requêtes ; les requêtes de tous les items d'un batch
+passent ensemble dans un seul encode et un seul flux de batches du reranker.
+Chaque batch est un bloc nommé de la trace pendant une capture de profil
+(profiling.span), et avec metrics, les candidats par catégorie à la sortie de
+chaque étage sont comptés.
+"""
+
+from .embedding_search import search_ids_batch
+from .metrics import Metrics
+from .profiling import span
+from .rerank_with_crossencoder import rerank_ids_batch
+from .types import Candidate
+
+
+def make_stages(candidates, search_settings: dict, rerank_settings: dict, metrics: Metrics | None = None):
+    """Étage CPU (encodage E5 + FAISS) et étage reranker (GPU), chacun par batch, à passer à des MicroBatcher."""
+    def search_stage(items: list[list[str]]) -> list[list[tuple]]:
+        queries = [query for item in items for query in item]
+        with span(search_settings, "search_batch", queries=len(queries)):
+            hits = search_ids_batch(queries, candidates, search_settings)
+        if metrics is not None:
+            metrics.observe_candidates("search", candidates, [ids for ids, _ in hits])
+        hits = iter(zip(queries, hits))
+        return [[next(hits) for _ in item] for item in items]
+
+    def rerank_stage(items: list[list[tuple]]) -> list[list[list[Candidate]]]:
+        flat = [pair for item in items for pair in item]
+        with span(rerank_settings, "rerank_batch", queries=len(flat)):
+            ranked = rerank_ids_batch([query for query, _ in flat], [hit for _, hit in flat], candidates, rerank_settings)
+        if metrics is not None:
+            metrics.observe_candidates("rerank", candidates, [ids for ids, _, _ in ranked])
+        ranked = iter(ranked)
+        # Les Candidate ne sont créés qu'ici, pour la réponse
+        return [[candidates.materialize(*next(ranked)) for _ in item] for item in items]
+
+    return search_stage, rerank_stage
@@ -0,0 +1,72 @@
+"""
+Démarrage par étapes du service.
+
+Le processus accepte les connexions tout de suite ; le chargement (catalogue,
+modèles, warm-up) tourne dans un thread de fond. Chaque étape est suivie
+(pending → loading → ready / failed) et chronométrée, pour /ready et pour
+le journal de démarrage.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Horloge de référence : import de ce module, au tout début de api.py
+PROCESS_START = time.perf_counter()
+
+
+class Startup:
+    def __init__(self, stages: list[str]):
+        self.stages = {name: "pending" for name in stages}
+        self.timings = {}
+        self.error = None
+        self.ready = threading.Event()
+        self._thread = None
+
+    def start(self, load: Callable[["Startup"], None]):
+        """Lance load(self) dans un thread de fond ; load appelle run_stage pour chaque étape."""
+        self.timings["boot"] = time.perf_counter() - PROCESS_START
+        self._thread = threading.Thread(target=self._run, args=(load,), name="startup", daemon=True)
+        self._thread.start()
+
+    def run_stage(self, name: str, fn: Callable):
+        self.stages[name] = "loading"
+        t0 = time.perf_counter()
+        try:
+            result = fn()
+        except Exception:
+            self.stages[name] = "failed"
+            raise
+        self.timings[name] = time.perf_counter() - t0
+        self.stages[name] = "ready"
+        logger.info("Démarrage : %s en %.2fs", name, self.timings[name])
+        return result
+
+    def _run(self, load: Callable[["Startup"], None]):
+        try:
+            load(self)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logger.exception("Échec du démarrage")
+            return
+        self.timings["total"] = time.perf_counter() - PROCESS_START
+        self.ready.set()
+        logger.info(
+            "Prêt en %.2fs (%s)", self.timings["total"],
+            ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.timings.items() if name != "total"),
+        )
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready.is_set(),
+            "stages": dict(self.stages),
+            "timings_s": {name: round(seconds, 3) for name, seconds in self.timings.items()},
+            "error": self.error,
+        }
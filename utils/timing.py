@@ -0,0 +1,113 @@
+"""
+Mesure du temps par étape du pipeline : encode, faiss, tokenize, forward, postprocess.
+
+Le code de recherche et de rerank entoure chaque étape de `with stage(settings, nom)`.
+Sans settings["timer"] (le défaut), ce n'est qu'un test ; avec un StageTimer,
+la durée de chaque passage est cumulée. Sur GPU, le timer peut synchroniser le
+device aux bornes des étapes pour mesurer le temps réel des kernels.
+
+Pendant une capture de profil (settings["profiler"], voir profiling.py),
+chaque étape devient aussi un bloc nommé de la trace, avec les détails
+passés à stage() (p. ex. la shape d'un batch du reranker).
+
+Les MicroBatcher qui ont un timer y signalent aussi chaque batch (taille,
+attente en file) ; on_record / on_batch alimentent les métriques (metrics.py).
+"""
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable
+
+from .profiling import span
+
+STAGES = ("encode", "faiss", "tokenize", "forward", "postprocess")
+
+
+def device_sync(device: str) -> Callable[[], None] | None:
+    """Fonction de synchronisation du device (None sur CPU, où les calculs sont synchrones)."""
+    if not device.startswith("cuda"):
+        return None
+    import torch
+    return torch.cuda.synchronize
+
+
+class StageTimer:
+    """Durées cumulées et nombre de passages par étape, partageable entre threads."""
+
+    def __init__(self, sync: Callable[[], None] | None = None,
+                 on_record: Callable[[str, float], None] | None = None,
+                 on_batch: Callable[[str, int, list[float]], None] | None = None):
+        """
+        Args:
+            sync: synchronisation du device (device_sync), None = aucune
+            on_record: appelé avec (étape, secondes) à chaque passage
+            on_batch: appelé avec (nom du MicroBatcher, taille, attentes en file en secondes)
+        """
+        self.sync = sync
+        self.on_record = on_record
+        self.on_batch = on_batch
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+        breakdown = getattr(self._local, "breakdown", None)
+        if breakdown is not None:
+            breakdown[name] = breakdown.get(name, 0.0) + seconds
+        if self.on_record is not None:
+            self.on_record(name, seconds)
+
+    def record_batch(self, name: str, size: int, waits: list[float]):
+        if self.on_batch is not None:
+            self.on_batch(name, size, waits)
+
+    @contextmanager
+    def collect(self):
+        """Durées par étape enregistrées par ce thread pendant le bloc (répartition d'un batch)."""
+        breakdown = {}
+        self._local.breakdown = breakdown
+        try:
+            yield breakdown
+        finally:
+            self._local.breakdown = None
+
+    def reset(self):
+        with self._lock:
+            self.seconds.clear()
+            self.calls.clear()
+
+    def snapshot(self, reset: bool = False) -> dict[str, float]:
+        """Secondes cumulées par étape depuis le dernier reset."""
+        with self._lock:
+            seconds = dict(self.seconds)
+            if reset:
+                self.seconds.clear()
+                self.calls.clear()
+        return seconds
+
+
+@contextmanager
+def stage(settings: dict, name: str, **details):
+    """details : notés dans la trace d'un profil en cours, ignorés sinon."""
+    timer = settings.get("timer")
+    if timer is None:
+        with span(settings, name, **details):
+            yield
+        return
+
+    with span(settings, name, **details):
+        if timer.sync is not None:
+            timer.sync()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            if timer.sync is not None:
+                timer.sync()
+            timer.record(name, time.perf_counter() - t0)
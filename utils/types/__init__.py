@@ -1,7 +1,7 @@
 from dataclasses import dataclass, replace
 
 
-@dataclass
+@dataclass(slots=True)
 class Candidate:
     tag: str                  # "amenity=restaurant"
     description_fr: str       # "Restaurant"